@@ -1,4 +1,6 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, Response, stream_with_context
+from jinja2 import StrictUndefined, TemplateError
+from jinja2.sandbox import SandboxedEnvironment
 import pymysql
 import os
 from werkzeug.utils import secure_filename
@@ -12,7 +14,7 @@ from google.oauth2 import id_token
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport import requests as google_requests
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
 from googleapiclient import http as googleapiclient_http
@@ -24,8 +26,22 @@ import email
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import decode_header
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import click
+import mimetypes
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from urllib.parse import quote
+import heapq
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import shutil
+import tempfile
+import zipfile
+import zlib
 
 app = Flask(__name__)
 
@@ -66,7 +82,18 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_DOCUMENT_EXTENSIONS = {'pdf', 'doc', 'docx'}
 ALLOWED_ID_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_SIZE_MB', '16')) * 1024 * 1024  # 16MB max file size by default
+
+# Let the front-end web server send local upload files (X-Sendfile) instead of the app worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() in ('1', 'true', 'yes')
+
+# Where uploads are kept: 'local' (UPLOAD_FOLDER) or 's3' (any S3-compatible store, e.g. MinIO)
+UPLOAD_STORAGE_BACKEND = os.environ.get('UPLOAD_STORAGE_BACKEND', 'local').lower()
+S3_UPLOAD_BUCKET = os.environ.get('S3_UPLOAD_BUCKET', '')
+S3_UPLOAD_PREFIX = os.environ.get('S3_UPLOAD_PREFIX', 'uploads/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None  # e.g. http://localhost:9000 for MinIO
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_PRESIGNED_URL_SECONDS = int(os.environ.get('S3_PRESIGNED_URL_SECONDS', '300'))
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -210,7 +237,7 @@ def test_db_connection():
         return False
 
 # Schema version for migrations
-SCHEMA_VERSION = 14
+SCHEMA_VERSION = 26
 
 def get_db_connection(use_database=True):
     """Create and return database connection"""
@@ -455,6 +482,7 @@ def create_company_settings_table():
                     ('google_drive_account_name', 'VARCHAR(255)'),
                     ('google_drive_account_picture', 'VARCHAR(500)'),
                     ('google_drive_main_folder_id', 'VARCHAR(255)'),
+                    ('google_drive_token_expiry', 'DATETIME'),
                     ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
                     ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP')
                 ]
@@ -914,6 +942,177 @@ def create_matters_table():
         if connection:
             connection.close()
 
+def create_document_tables():
+    """Create tables that cache Google Drive state locally"""
+    try:
+        connection = get_db_connection()
+        if not connection:
+            return False
+        with connection.cursor() as cursor:
+            # Create drive_folders table ((parent, name) -> folder ID, so folder lookups skip files().list)
+            if not table_exists('drive_folders'):
+                cursor.execute("""
+                    CREATE TABLE drive_folders (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        parent_id VARCHAR(128) NOT NULL,
+                        folder_name VARCHAR(255) NOT NULL,
+                        folder_id VARCHAR(128) NOT NULL,
+                        indexed_at DATETIME,
+                        client_id INT,
+                        document_type VARCHAR(64),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE KEY unique_parent_name (parent_id, folder_name),
+                        INDEX idx_folder_id (folder_id)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Drive folders cache table created")
+            else:
+                print("[OK] Drive folders cache table already exists")
+            
+            # Create drive_upload_jobs table (spooled uploads pushed to Drive by a background worker)
+            if not table_exists('drive_upload_jobs'):
+                cursor.execute("""
+                    CREATE TABLE drive_upload_jobs (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        case_id INT NOT NULL,
+                        file_name VARCHAR(255) NOT NULL,
+                        description TEXT,
+                        mime_type VARCHAR(255),
+                        spool_path VARCHAR(512) NOT NULL,
+                        file_size BIGINT NOT NULL DEFAULT 0,
+                        bytes_uploaded BIGINT NOT NULL DEFAULT 0,
+                        resumable_uri TEXT,
+                        status ENUM('queued', 'uploading', 'completed', 'failed') NOT NULL DEFAULT 'queued',
+                        attempts INT NOT NULL DEFAULT 0,
+                        next_attempt_at DATETIME NOT NULL,
+                        last_error TEXT,
+                        claimed_by VARCHAR(64),
+                        claimed_at DATETIME,
+                        drive_file_id VARCHAR(128),
+                        drive_file_url VARCHAR(512),
+                        created_by_id INT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        completed_at DATETIME,
+                        FOREIGN KEY (case_id) REFERENCES cases(id) ON DELETE CASCADE,
+                        FOREIGN KEY (created_by_id) REFERENCES employees(id) ON DELETE SET NULL,
+                        INDEX idx_status_next_attempt (status, next_attempt_at),
+                        INDEX idx_claimed_by (claimed_by),
+                        INDEX idx_case_id (case_id)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Drive upload jobs table created")
+            else:
+                print("[OK] Drive upload jobs table already exists")
+            
+            # Create documents table (local index of Drive files, so document lists render from MySQL)
+            if not table_exists('documents'):
+                cursor.execute("""
+                    CREATE TABLE documents (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        drive_file_id VARCHAR(128) NOT NULL UNIQUE,
+                        drive_folder_id VARCHAR(128),
+                        client_id INT,
+                        case_id INT,
+                        document_type VARCHAR(64),
+                        file_name VARCHAR(255) NOT NULL,
+                        description TEXT,
+                        mime_type VARCHAR(255),
+                        file_size BIGINT,
+                        sha256 CHAR(64),
+                        web_view_link VARCHAR(512),
+                        uploaded_by_id INT,
+                        drive_created_at DATETIME,
+                        drive_modified_at DATETIME,
+                        trashed BOOLEAN NOT NULL DEFAULT FALSE,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE,
+                        FOREIGN KEY (case_id) REFERENCES cases(id) ON DELETE SET NULL,
+                        FOREIGN KEY (uploaded_by_id) REFERENCES employees(id) ON DELETE SET NULL,
+                        INDEX idx_client_type (client_id, document_type, trashed, drive_modified_at),
+                        INDEX idx_case (case_id, trashed),
+                        INDEX idx_folder (drive_folder_id),
+                        INDEX idx_sha256 (sha256)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Documents table created")
+            else:
+                print("[OK] Documents table already exists")
+            
+            # Create drive_sync_state table (Drive Changes API page tokens)
+            if not table_exists('drive_sync_state'):
+                cursor.execute("""
+                    CREATE TABLE drive_sync_state (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        name VARCHAR(64) NOT NULL UNIQUE,
+                        page_token VARCHAR(255),
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Drive sync state table created")
+            else:
+                print("[OK] Drive sync state table already exists")
+        
+        return True
+    except Exception as e:
+        print(f"Error creating document tables: {e}")
+        return False
+    finally:
+        if connection:
+            connection.close()
+
+def create_upload_tables():
+    """Create tables that track locally stored uploads"""
+    try:
+        connection = get_db_connection()
+        if not connection:
+            return False
+        with connection.cursor() as cursor:
+            # Create stored_files table (one row per distinct upload content, with a reference count)
+            if not table_exists('stored_files'):
+                cursor.execute("""
+                    CREATE TABLE stored_files (
+                        sha256 CHAR(64) PRIMARY KEY,
+                        path VARCHAR(255) NOT NULL,
+                        file_size BIGINT NOT NULL DEFAULT 0,
+                        ref_count INT NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        UNIQUE KEY unique_path (path)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Stored files table created")
+            else:
+                print("[OK] Stored files table already exists")
+            
+            # Create upload_path_aliases table (where files moved by migrate-uploads went)
+            if not table_exists('upload_path_aliases'):
+                cursor.execute("""
+                    CREATE TABLE upload_path_aliases (
+                        legacy_path VARCHAR(255) PRIMARY KEY,
+                        path VARCHAR(255) NOT NULL,
+                        migrated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Upload path aliases table created")
+            else:
+                print("[OK] Upload path aliases table already exists")
+        
+        return True
+    except Exception as e:
+        print(f"Error creating upload tables: {e}")
+        return False
+    finally:
+        if connection:
+            connection.close()
+
 def create_email_tables():
     """Create email_settings and email_accounts tables for email management"""
     try:
@@ -972,6 +1171,142 @@ def create_email_tables():
                 print("[OK] Email accounts table created")
             else:
                 print("[OK] Email accounts table already exists")
+            
+            # Create email_mailbox_state table (per-folder IMAP sync position)
+            if not table_exists('email_mailbox_state'):
+                cursor.execute("""
+                    CREATE TABLE email_mailbox_state (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        account_email VARCHAR(255) NOT NULL,
+                        folder VARCHAR(255) NOT NULL DEFAULT 'INBOX',
+                        uidvalidity BIGINT UNSIGNED,
+                        last_uid BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                        server_message_count INT NOT NULL DEFAULT 0,
+                        last_synced_at DATETIME,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        UNIQUE KEY unique_mailbox (account_email, folder)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Email mailbox state table created")
+            else:
+                print("[OK] Email mailbox state table already exists")
+            
+            # Create email_messages table (local mailbox cache keyed by UIDVALIDITY/UID)
+            if not table_exists('email_messages'):
+                cursor.execute("""
+                    CREATE TABLE email_messages (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        account_email VARCHAR(255) NOT NULL,
+                        folder VARCHAR(255) NOT NULL DEFAULT 'INBOX',
+                        uidvalidity BIGINT UNSIGNED NOT NULL,
+                        uid BIGINT UNSIGNED NOT NULL,
+                        message_id VARCHAR(512),
+                        subject TEXT,
+                        from_header TEXT,
+                        to_header TEXT,
+                        date_header VARCHAR(255),
+                        sent_at DATETIME,
+                        flags VARCHAR(255),
+                        body MEDIUMTEXT,
+                        body_fetched BOOLEAN DEFAULT FALSE,
+                        attachments_json TEXT,
+                        in_reply_to VARCHAR(512),
+                        references_header TEXT,
+                        thread_key CHAR(40),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        UNIQUE KEY unique_message (account_email, folder, uidvalidity, uid),
+                        INDEX idx_mailbox_sent_at (account_email, folder, sent_at),
+                        INDEX idx_message_id (message_id(191)),
+                        INDEX idx_in_reply_to (in_reply_to(191)),
+                        INDEX idx_account_thread (account_email, thread_key)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Email messages cache table created")
+            else:
+                print("[OK] Email messages cache table already exists")
+            
+            # Create email_contacts table (per-mailbox contact index maintained during sync)
+            if not table_exists('email_contacts'):
+                cursor.execute("""
+                    CREATE TABLE email_contacts (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        account_email VARCHAR(255) NOT NULL,
+                        contact_email VARCHAR(255) NOT NULL,
+                        contact_name VARCHAR(255),
+                        message_count INT NOT NULL DEFAULT 0,
+                        last_message_at DATETIME,
+                        last_subject TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        UNIQUE KEY unique_contact (account_email, contact_email),
+                        INDEX idx_account_last_message (account_email, last_message_at)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Email contacts index table created")
+            else:
+                print("[OK] Email contacts index table already exists")
+            
+            # Create email_bulk_jobs table (mail-merge sends; messages live in email_outbox)
+            if not table_exists('email_bulk_jobs'):
+                cursor.execute("""
+                    CREATE TABLE email_bulk_jobs (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        name VARCHAR(255),
+                        source VARCHAR(50) NOT NULL DEFAULT 'recipients',
+                        from_email VARCHAR(255) NOT NULL,
+                        subject_template TEXT NOT NULL,
+                        body_template MEDIUMTEXT NOT NULL,
+                        html_template MEDIUMTEXT,
+                        total_recipients INT NOT NULL DEFAULT 0,
+                        skipped_recipients INT NOT NULL DEFAULT 0,
+                        created_by_id INT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (created_by_id) REFERENCES employees(id) ON DELETE SET NULL,
+                        INDEX idx_created_at (created_at)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Email bulk jobs table created")
+            else:
+                print("[OK] Email bulk jobs table already exists")
+            
+            # Create email_outbox table (persistent queue drained by the outbox worker thread)
+            if not table_exists('email_outbox'):
+                cursor.execute("""
+                    CREATE TABLE email_outbox (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        from_email VARCHAR(255) NOT NULL,
+                        sender_name VARCHAR(255),
+                        to_email TEXT NOT NULL,
+                        subject TEXT,
+                        body MEDIUMTEXT,
+                        html_body MEDIUMTEXT,
+                        status ENUM('queued', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'queued',
+                        attempts INT NOT NULL DEFAULT 0,
+                        next_attempt_at DATETIME NOT NULL,
+                        last_error TEXT,
+                        claimed_by VARCHAR(64),
+                        claimed_at DATETIME,
+                        sent_at DATETIME,
+                        created_by_id INT,
+                        bulk_job_id INT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        FOREIGN KEY (created_by_id) REFERENCES employees(id) ON DELETE SET NULL,
+                        FOREIGN KEY (bulk_job_id) REFERENCES email_bulk_jobs(id) ON DELETE SET NULL,
+                        INDEX idx_status_next_attempt (status, next_attempt_at),
+                        INDEX idx_claimed_by (claimed_by),
+                        INDEX idx_bulk_job_status (bulk_job_id, status)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+                connection.commit()
+                print("[OK] Email outbox table created")
+            else:
+                print("[OK] Email outbox table already exists")
         
         return True
     except Exception as e:
@@ -1367,6 +1702,150 @@ def apply_migrations(current_version):
                 print("Applying migration 14: Creating email management tables...")
                 migrations_applied = True
             
+            # Migration 15: Create local mailbox cache tables (email_mailbox_state, email_messages)
+            if current_version < 15:
+                print("Applying migration 15: Creating mailbox cache tables...")
+                migrations_applied = True
+            
+            # Migration 16: Create email_contacts index table
+            if current_version < 16:
+                print("Applying migration 16: Creating email contacts index table...")
+                migrations_applied = True
+            
+            # Migration 17: Add threading columns to email_messages
+            if current_version < 17:
+                print("Applying migration 17: Adding threading columns to email_messages table...")
+                
+                threading_columns = [
+                    ('in_reply_to', 'VARCHAR(512)', 'idx_in_reply_to', '(in_reply_to(191))'),
+                    ('references_header', 'TEXT', None, None),
+                    ('thread_key', 'CHAR(40)', 'idx_account_thread', '(account_email, thread_key)')
+                ]
+                for column_name, column_def, index_name, index_def in threading_columns:
+                    if not column_exists('email_messages', column_name):
+                        try:
+                            cursor.execute(f"ALTER TABLE email_messages ADD COLUMN {column_name} {column_def}")
+                            if index_name:
+                                cursor.execute(f"ALTER TABLE email_messages ADD INDEX {index_name} {index_def}")
+                            connection.commit()
+                            print(f"[OK] Added column '{column_name}' to email_messages table")
+                        except Exception as e:
+                            print(f"[WARNING] Could not add column '{column_name}': {e}")
+                
+                # Headers cached before this migration lack threading data; refetch them on next sync
+                try:
+                    cursor.execute("DELETE FROM email_messages WHERE thread_key IS NULL")
+                    cursor.execute("DELETE FROM email_mailbox_state")
+                    cursor.execute("DELETE FROM email_contacts")
+                    connection.commit()
+                except Exception as e:
+                    print(f"[WARNING] Could not reset mailbox cache: {e}")
+                
+                migrations_applied = True
+            
+            # Migration 18: Create email_outbox queue table
+            if current_version < 18:
+                print("Applying migration 18: Creating email outbox table...")
+                migrations_applied = True
+            
+            # Migration 19: Create email_bulk_jobs table and link outbox rows to their bulk job
+            if current_version < 19:
+                print("Applying migration 19: Adding bulk email jobs...")
+                
+                if not column_exists('email_outbox', 'bulk_job_id'):
+                    try:
+                        cursor.execute("""
+                            ALTER TABLE email_outbox
+                            ADD COLUMN bulk_job_id INT AFTER created_by_id,
+                            ADD FOREIGN KEY (bulk_job_id) REFERENCES email_bulk_jobs(id) ON DELETE SET NULL,
+                            ADD INDEX idx_bulk_job_status (bulk_job_id, status)
+                        """)
+                        connection.commit()
+                        print("[OK] Added bulk_job_id column to email_outbox table")
+                    except Exception as e:
+                        print(f"[WARNING] Could not add bulk_job_id column: {e}")
+                
+                migrations_applied = True
+            
+            # Migration 20: Store attachment metadata (from BODYSTRUCTURE) alongside cached bodies
+            if current_version < 20:
+                print("Applying migration 20: Adding attachments_json column to email_messages table...")
+                
+                if not column_exists('email_messages', 'attachments_json'):
+                    try:
+                        cursor.execute("ALTER TABLE email_messages ADD COLUMN attachments_json TEXT AFTER body_fetched")
+                        connection.commit()
+                        print("[OK] Added attachments_json column to email_messages table")
+                    except Exception as e:
+                        print(f"[WARNING] Could not add attachments_json column: {e}")
+                
+                # Bodies cached before this migration have no attachment list; reload them lazily
+                try:
+                    cursor.execute("UPDATE email_messages SET body = NULL, body_fetched = FALSE WHERE body_fetched = TRUE")
+                    connection.commit()
+                except Exception as e:
+                    print(f"[WARNING] Could not reset cached email bodies: {e}")
+                
+                migrations_applied = True
+            
+            # Migration 21: Create drive_folders cache table
+            if current_version < 21:
+                print("Applying migration 21: Creating Drive folder cache table...")
+                migrations_applied = True
+            
+            # Migration 22: Create drive_upload_jobs table
+            if current_version < 22:
+                print("Applying migration 22: Creating Drive upload jobs table...")
+                migrations_applied = True
+            
+            # Migration 23: Create documents index and Drive sync state tables
+            if current_version < 23:
+                print("Applying migration 23: Adding document index tables...")
+                
+                if table_exists('drive_folders') and not column_exists('drive_folders', 'indexed_at'):
+                    try:
+                        cursor.execute("ALTER TABLE drive_folders ADD COLUMN indexed_at DATETIME AFTER folder_id")
+                        connection.commit()
+                        print("[OK] Added indexed_at column to drive_folders table")
+                    except Exception as e:
+                        print(f"[WARNING] Could not add indexed_at column: {e}")
+                
+                migrations_applied = True
+            
+            # Migration 24: Record which client and document type each indexed Drive folder holds
+            if current_version < 24:
+                print("Applying migration 24: Adding client_id and document_type columns to drive_folders table...")
+                
+                for column_name, column_def in [('client_id', 'INT AFTER indexed_at'),
+                                                ('document_type', 'VARCHAR(64) AFTER client_id')]:
+                    if table_exists('drive_folders') and not column_exists('drive_folders', column_name):
+                        try:
+                            cursor.execute(f"ALTER TABLE drive_folders ADD COLUMN {column_name} {column_def}")
+                            connection.commit()
+                            print(f"[OK] Added {column_name} column to drive_folders table")
+                        except Exception as e:
+                            print(f"[WARNING] Could not add {column_name} column: {e}")
+                
+                # Folders indexed before this migration are listed again so they get tagged
+                try:
+                    cursor.execute("UPDATE drive_folders SET indexed_at = NULL")
+                    connection.commit()
+                except Exception as e:
+                    print(f"[WARNING] Could not reset indexed Drive folders: {e}")
+                
+                migrations_applied = True
+            
+            # Migration 25: Create stored_files table for content-addressed uploads
+            if current_version < 25:
+                print("Applying migration 25: Creating stored files table...")
+                migrations_applied = True
+            
+            # Migration 26: Create upload_path_aliases table for the sharded upload layout
+            if current_version < 26:
+                print("Applying migration 26: Creating upload path aliases table...")
+                print("  Run 'flask --app app migrate-uploads' to move existing uploads into the sharded layout")
+                migrations_applied = True
+            
             # Migration 1: Ensure all required columns exist (for older versions)
             if current_version < 1:
                 print("Applying migration 1: Schema updates...")
@@ -1435,7 +1914,17 @@ def init_database():
         print("[ERROR] Failed to create/update email tables")
         return False
     
-    # Step 9: Check schema version and apply migrations
+    # Step 9: Create document tables
+    if not create_document_tables():
+        print("[ERROR] Failed to create/update document tables")
+        return False
+    
+    # Step 10: Create upload tables
+    if not create_upload_tables():
+        print("[ERROR] Failed to create/update upload tables")
+        return False
+    
+    # Step 11: Check schema version and apply migrations
     current_version = get_schema_version()
     print(f"Current schema version: {current_version}")
     print(f"Target schema version: {SCHEMA_VERSION}")
@@ -1467,38 +1956,338 @@ def allowed_id_file(filename):
     """Check if ID/passport file extension is allowed (images or PDF)"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_ID_EXTENSIONS
 
-def process_signature_image(image_file):
-    """Process and clean signature/stamp image with optimized algorithms"""
-    try:
-        # Try to use numpy/scipy for advanced processing
-        import numpy as np
-        from scipy import ndimage
-        USE_NUMPY = True
-    except ImportError:
-        USE_NUMPY = False
+# ==================== STORAGE BACKEND ====================
+# Upload paths are relative names like ab/cd/<sha256>.png; these helpers map them to
+# UPLOAD_FOLDER or to keys under S3_UPLOAD_PREFIX depending on UPLOAD_STORAGE_BACKEND.
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Shared boto3 S3 client for the upload bucket (boto3 clients are thread-safe)"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                try:
+                    import boto3
+                except ImportError:
+                    raise RuntimeError("UPLOAD_STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+                _s3_client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+    return _s3_client
+
+def storage_key(relative_path):
+    """S3 object key for an upload path"""
+    return S3_UPLOAD_PREFIX + relative_path
+
+def storage_exists(relative_path):
+    """True if the upload exists in the configured storage backend"""
+    if UPLOAD_STORAGE_BACKEND == 's3':
+        s3 = get_s3_client()
+        try:
+            s3.head_object(Bucket=S3_UPLOAD_BUCKET, Key=storage_key(relative_path))
+            return True
+        except s3.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+    return os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], relative_path))
+
+def storage_put_file(local_file, relative_path, move=False):
+    """Copy (or move) a local file into the storage backend at relative_path"""
+    if UPLOAD_STORAGE_BACKEND == 's3':
+        content_type = mimetypes.guess_type(relative_path)[0] or 'application/octet-stream'
+        get_s3_client().upload_file(local_file, S3_UPLOAD_BUCKET, storage_key(relative_path),
+                                    ExtraArgs={'ContentType': content_type})
+        if move:
+            os.remove(local_file)
+        return
+    target_file = os.path.join(app.config['UPLOAD_FOLDER'], relative_path)
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    if move:
+        os.replace(local_file, target_file)
+    else:
+        try:
+            os.link(local_file, target_file)
+        except OSError:
+            shutil.copy2(local_file, target_file)
+
+@contextmanager
+def storage_open(relative_path):
+    """Open a stored upload for binary reading"""
+    if UPLOAD_STORAGE_BACKEND == 's3':
+        body = get_s3_client().get_object(Bucket=S3_UPLOAD_BUCKET, Key=storage_key(relative_path))['Body']
+        try:
+            yield body
+        finally:
+            body.close()
+    else:
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], relative_path), 'rb') as f:
+            yield f
+
+def storage_delete(relative_path):
+    """Delete a stored upload; missing files are ignored"""
+    if UPLOAD_STORAGE_BACKEND == 's3':
+        get_s3_client().delete_object(Bucket=S3_UPLOAD_BUCKET, Key=storage_key(relative_path))
+        return
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], relative_path)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+def storage_response(relative_path, as_attachment=False):
+    """
+    Response that delivers a stored upload without the app worker proxying S3 bytes:
+    a redirect to a short-lived presigned URL, or send_from_directory for local disk.
+    """
+    if UPLOAD_STORAGE_BACKEND == 's3':
+        params = {'Bucket': S3_UPLOAD_BUCKET, 'Key': storage_key(relative_path)}
+        if as_attachment:
+            params['ResponseContentDisposition'] = f'attachment; filename="{os.path.basename(relative_path)}"'
+        url = get_s3_client().generate_presigned_url('get_object', Params=params, ExpiresIn=S3_PRESIGNED_URL_SECONDS)
+        return redirect(url)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], relative_path, as_attachment=as_attachment)
+
+# ==================== UPLOAD STORAGE ====================
+
+def content_addressed_path(sha256, file_ext):
+    """Upload path relative to UPLOAD_FOLDER for given content: ab/cd/abcd....ext"""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}.{file_ext}"
+
+def store_upload(source, file_ext):
+    """
+    Save an upload in the content-addressed store and count one reference to it.
+    source is a FileStorage or binary file object; returns the path relative to UPLOAD_FOLDER.
+    Identical content uploaded again shares the existing file.
+    """
+    stream = getattr(source, 'stream', source)
+    incoming_dir = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    file_size = 0
+    with tempfile.NamedTemporaryFile(dir=incoming_dir, delete=False) as temp_file:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+            temp_file.write(chunk)
+            file_size += len(chunk)
+    sha256 = digest.hexdigest()
+    relative_path = content_addressed_path(sha256, file_ext)
     
+    connection = get_db_connection()
     try:
-        # Open image with optimization
-        img = Image.open(image_file)
-        
-        # Convert to RGB if necessary (faster than RGBA for initial processing)
-        if img.mode not in ('RGB', 'RGBA'):
-            if img.mode == 'P' and 'transparency' in img.info:
-                img = img.convert('RGBA')
+        if connection:
+            # The row lock taken here is held until the file is in place, so a concurrent
+            # release_upload() of the same content can't delete it underneath us
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO stored_files (sha256, path, file_size, ref_count) VALUES (%s, %s, %s, 1)
+                    ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+                """, (sha256, relative_path, file_size))
+                cursor.execute("SELECT path FROM stored_files WHERE sha256 = %s", (sha256,))
+                relative_path = cursor.fetchone()[0]
+        if storage_exists(relative_path):
+            os.remove(temp_file.name)
+        else:
+            storage_put_file(temp_file.name, relative_path, move=True)
+        if connection:
+            connection.commit()
+    except Exception:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        raise
+    finally:
+        if connection:
+            connection.close()
+    return relative_path
+
+def release_upload(relative_path):
+    """Drop one reference to a stored upload, deleting the file when nothing refers to it any more"""
+    if not relative_path or relative_path.startswith('http'):
+        return
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE stored_files SET ref_count = ref_count - 1 WHERE path = %s", (relative_path,))
+            if cursor.rowcount:
+                cursor.execute("DELETE FROM stored_files WHERE path = %s AND ref_count <= 0", (relative_path,))
+                unreferenced = cursor.rowcount == 1
             else:
-                img = img.convert('RGB')
-        
-        # Resize if too large (max 400x200) - use high-quality resampling
-        max_width, max_height = 400, 200
-        if img.width > max_width or img.height > max_height:
-            # Maintain aspect ratio with high-quality resampling
-            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-        
-        # Convert to grayscale for efficient processing
-        gray = img.convert('L')
-        
-        if USE_NUMPY:
-            # Use numpy for faster processing
+                # Files saved before the content-addressed store belong to a single record
+                unreferenced = True
+            if unreferenced:
+                storage_delete(relative_path)
+        connection.commit()
+    except Exception as e:
+        print(f"Error releasing upload {relative_path}: {e}")
+    finally:
+        connection.close()
+
+def release_uploads(relative_paths):
+    """release_upload() each of several stored paths (None entries are skipped)"""
+    for relative_path in relative_paths:
+        if relative_path:
+            release_upload(relative_path)
+
+def resolve_upload_path(stored_path):
+    """
+    Path relative to UPLOAD_FOLDER for a stored upload name, or None if the file is missing.
+    Names from before migrate-uploads are followed to where the file was moved.
+    """
+    if not stored_path:
+        return None
+    if storage_exists(stored_path):
+        return stored_path
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT path FROM upload_path_aliases WHERE legacy_path = %s", (stored_path,))
+            result = cursor.fetchone()
+    except Exception as e:
+        print(f"Error resolving upload path {stored_path}: {e}")
+        return None
+    finally:
+        connection.close()
+    if result and storage_exists(result[0]):
+        return result[0]
+    return None
+
+# Columns holding UPLOAD_FOLDER file names
+UPLOAD_PATH_COLUMNS = {
+    'employees': ['profile_picture', 'employment_contract', 'id_front', 'id_back', 'signature', 'stamp'],
+    'clients': ['profile_picture', 'id_front', 'id_back', 'cr12_certificate'],
+}
+
+def _migrate_upload_batch(file_names):
+    """Move one batch of flat UPLOAD_FOLDER files into the sharded layout and repoint the DB at them"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    moved = {}
+    sizes = {}
+    for file_name in file_names:
+        legacy_file = os.path.join(upload_folder, file_name)
+        with open(legacy_file, 'rb') as f:
+            sha256 = file_sha256(f)
+        file_ext = file_name.rsplit('.', 1)[1].lower() if '.' in file_name else 'bin'
+        moved[file_name] = (sha256, content_addressed_path(sha256, file_ext))
+        sizes[file_name] = os.path.getsize(legacy_file)
+    
+    connection = get_db_connection()
+    if not connection:
+        raise RuntimeError('Database connection error')
+    try:
+        with connection.cursor() as cursor:
+            placeholders = ', '.join(['%s'] * len(file_names))
+            ref_counts = dict.fromkeys(file_names, 0)
+            for table, columns in UPLOAD_PATH_COLUMNS.items():
+                for column in columns:
+                    cursor.execute(f"""
+                        SELECT {column}, COUNT(*) FROM {table}
+                        WHERE {column} IN ({placeholders}) GROUP BY {column}
+                    """, file_names)
+                    for name, count in cursor.fetchall():
+                        ref_counts[name] += count
+            
+            for file_name, (sha256, new_path) in moved.items():
+                cursor.execute("""
+                    INSERT INTO stored_files (sha256, path, file_size, ref_count) VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE ref_count = ref_count + VALUES(ref_count)
+                """, (sha256, new_path, sizes[file_name], ref_counts[file_name]))
+                cursor.execute("SELECT path FROM stored_files WHERE sha256 = %s", (sha256,))
+                new_path = cursor.fetchone()[0]
+                moved[file_name] = (sha256, new_path)
+                cursor.execute("""
+                    INSERT INTO upload_path_aliases (legacy_path, path) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE path = VALUES(path)
+                """, (file_name, new_path))
+                
+                # Copy rather than move so the old name keeps working until the new paths are committed
+                if not storage_exists(new_path):
+                    storage_put_file(os.path.join(upload_folder, file_name), new_path)
+            
+            case_sql = ' '.join(['WHEN %s THEN %s'] * len(moved))
+            case_params = [value for file_name, (_, new_path) in moved.items() for value in (file_name, new_path)]
+            for table, columns in UPLOAD_PATH_COLUMNS.items():
+                for column in columns:
+                    cursor.execute(f"""
+                        UPDATE {table} SET {column} = CASE {column} {case_sql} END
+                        WHERE {column} IN ({placeholders})
+                    """, case_params + list(file_names))
+        connection.commit()
+    finally:
+        connection.close()
+    
+    for file_name in file_names:
+        os.remove(os.path.join(upload_folder, file_name))
+    return sum(1 for file_name in file_names if ref_counts[file_name] == 0)
+
+def migrate_uploads_to_sharded_layout(batch_size=500):
+    """
+    Move files sitting directly in UPLOAD_FOLDER into the two-level sharded layout
+    used by store_upload(), rewriting employee and client file columns batch by batch.
+    Safe to re-run: files already in a shard directory are left alone.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    migrated = 0
+    unreferenced = 0
+    batch = []
+    with os.scandir(upload_folder) as entries:
+        legacy_files = [entry.name for entry in entries if entry.is_file() and not entry.name.startswith('.')]
+    for file_name in legacy_files:
+        batch.append(file_name)
+        if len(batch) >= batch_size:
+            unreferenced += _migrate_upload_batch(batch)
+            migrated += len(batch)
+            print(f"  Migrated {migrated}/{len(legacy_files)} uploads")
+            batch = []
+    if batch:
+        unreferenced += _migrate_upload_batch(batch)
+        migrated += len(batch)
+        print(f"  Migrated {migrated}/{len(legacy_files)} uploads")
+    return migrated, unreferenced
+
+@app.cli.command('migrate-uploads')
+@click.option('--batch-size', default=500, show_default=True, help='Files moved per database transaction.')
+def migrate_uploads_command(batch_size):
+    """Move existing uploads into the sharded directory layout."""
+    if not create_upload_tables():
+        raise click.ClickException('Could not create upload tables')
+    migrated, unreferenced = migrate_uploads_to_sharded_layout(batch_size)
+    print(f"[OK] Migrated {migrated} uploads ({unreferenced} not referenced by any employee or client)")
+
+def process_signature_image(image_file):
+    """Process and clean signature/stamp image with optimized algorithms"""
+    try:
+        # Try to use numpy/scipy for advanced processing
+        import numpy as np
+        from scipy import ndimage
+        USE_NUMPY = True
+    except ImportError:
+        USE_NUMPY = False
+    
+    try:
+        # Open image with optimization
+        img = Image.open(image_file)
+        
+        # Convert to RGB if necessary (faster than RGBA for initial processing)
+        if img.mode not in ('RGB', 'RGBA'):
+            if img.mode == 'P' and 'transparency' in img.info:
+                img = img.convert('RGBA')
+            else:
+                img = img.convert('RGB')
+        
+        # Resize if too large (max 400x200) - use high-quality resampling
+        max_width, max_height = 400, 200
+        if img.width > max_width or img.height > max_height:
+            # Maintain aspect ratio with high-quality resampling
+            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+        
+        # Convert to grayscale for efficient processing
+        gray = img.convert('L')
+        
+        if USE_NUMPY:
+            # Use numpy for faster processing
             gray_array = np.array(gray, dtype=np.uint8)
             
             # Adaptive thresholding with Gaussian blur for better edge detection
@@ -1756,14 +2545,12 @@ def signup():
                 filename = secure_filename(file.filename)
                 # Create unique filename
                 file_ext = filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"{employee_code}_{secrets.token_hex(8)}.{file_ext}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                profile_picture = unique_filename
+                profile_picture = store_upload(file, file_ext)
         
         # Save to database
         connection = get_db_connection()
         if not connection:
+            release_upload(profile_picture)
             flash('Database connection error. Please try again later.', 'error')
             return render_template('signup.html')
         
@@ -1776,6 +2563,7 @@ def signup():
                     VALUES (%s, %s, %s, %s, %s, %s, 'Employee', 'Pending Approval')
                 """, (full_name, phone_number, work_email, employee_code, password_hash, profile_picture))
                 connection.commit()
+                profile_picture = None
                 flash('Registration successful! Your account is pending approval.', 'success')
                 return redirect(url_for('login'))
         except pymysql.IntegrityError as e:
@@ -1790,6 +2578,8 @@ def signup():
             flash('An error occurred during registration. Please try again.', 'error')
         finally:
             connection.close()
+            # Not referenced by any employee unless the insert committed
+            release_upload(profile_picture)
     
     return render_template('signup.html')
 
@@ -2370,22 +3160,17 @@ def delete_employee():
     
     try:
         with connection.cursor() as cursor:
-            # Get profile picture to delete file
-            cursor.execute("SELECT profile_picture FROM employees WHERE id = %s", (employee_id,))
+            # Get uploaded files to release once the employee is gone
+            upload_columns = UPLOAD_PATH_COLUMNS['employees']
+            cursor.execute(f"SELECT {', '.join(upload_columns)} FROM employees WHERE id = %s", (employee_id,))
             result = cursor.fetchone()
-            if result and result[0]:
-                profile_picture = result[0]
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], profile_picture)
-                if os.path.exists(filepath):
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
             
             # Delete employee
             cursor.execute("DELETE FROM employees WHERE id = %s", (employee_id,))
             connection.commit()
             
+            release_uploads(result or [])
+            
             return {'success': True, 'message': 'Employee deleted successfully'}
     except Exception as e:
         print(f"Error deleting employee: {e}")
@@ -2848,6 +3633,7 @@ def upload_signature_stamp():
     if not connection:
         return jsonify({'success': False, 'error': 'Database connection error'}), 500
     
+    saved_filename = None
     try:
         file_field = 'signature' if upload_type == 'signature' else 'stamp'
         hash_field = 'signature_hash' if upload_type == 'signature' else 'stamp_hash'
@@ -2862,7 +3648,6 @@ def upload_signature_stamp():
         # Check if processed data is available (from frontend)
         processed_data = request.form.get(f'{file_field}_processed', '')
         
-        saved_filename = None
         file_hash = None
         
         if processed_data:
@@ -2882,40 +3667,28 @@ def upload_signature_stamp():
                     # Save processed image
                     filename = secure_filename(file.filename)
                     file_ext = 'png'  # Always save as PNG after processing
-                    unique_filename = f"{file_field}_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    
                     processed_img.seek(0)
-                    with open(filepath, 'wb') as f:
-                        f.write(processed_img.read())
-                    
-                    saved_filename = unique_filename
+                    saved_filename = store_upload(processed_img, file_ext)
             except Exception as e:
                 print(f"Error processing {upload_type}: {e}")
                 # Fallback to original file if processing fails
                 if file.filename and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     file_ext = filename.rsplit('.', 1)[1].lower()
-                    unique_filename = f"{file_field}_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-                    saved_filename = unique_filename
+                    saved_filename = store_upload(file, file_ext)
                     
                     # Generate hash from saved file
-                    with open(filepath, 'rb') as f:
+                    with storage_open(saved_filename) as f:
                         file_hash = generate_signature_hash(f.read())
         else:
             # No processed data, save original file
             if file.filename and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_ext = filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"{file_field}_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                saved_filename = unique_filename
+                saved_filename = store_upload(file, file_ext)
                 
                 # Generate hash from saved file
-                with open(filepath, 'rb') as f:
+                with storage_open(saved_filename) as f:
                     file_hash = generate_signature_hash(f.read())
         
         if not saved_filename:
@@ -2923,6 +3696,8 @@ def upload_signature_stamp():
         
         # Update database
         with connection.cursor() as cursor:
+            cursor.execute(f"SELECT {file_field} FROM employees WHERE id = %s FOR UPDATE", (employee_id,))
+            previous = cursor.fetchone()
             cursor.execute(f"""
                 UPDATE employees 
                 SET {file_field} = %s,
@@ -2930,6 +3705,9 @@ def upload_signature_stamp():
                 WHERE id = %s
             """, (saved_filename, file_hash, employee_id))
             connection.commit()
+        saved_filename = None
+        # The replaced signature/stamp is released only once the new one is committed
+        release_upload(previous[0] if previous else None)
         
         return jsonify({
             'success': True,
@@ -2939,6 +3717,7 @@ def upload_signature_stamp():
     except Exception as e:
         print(f"Error uploading {upload_type}: {e}")
         connection.rollback()
+        release_upload(saved_filename)
         return jsonify({'success': False, 'error': f'Server error: {str(e)}'}), 500
     finally:
         connection.close()
@@ -3637,6 +4416,9 @@ def submit_client_registration():
         flash('Please enter a valid Kenyan phone number (starting with 07)', 'error')
         return redirect(url_for('client_registration'))
     
+    # New uploads are released again if the registration isn't saved
+    stored_uploads = []
+    
     # Handle profile picture upload (optional)
     profile_picture = None
     if 'profile_picture' in request.files:
@@ -3645,10 +4427,8 @@ def submit_client_registration():
             filename = secure_filename(file.filename)
             # Create unique filename
             file_ext = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"client_{session['client_id']}_{secrets.token_hex(8)}.{file_ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            profile_picture = unique_filename
+            profile_picture = store_upload(file, file_ext)
+            stored_uploads.append(profile_picture)
     
     # Handle Individual client requirements (ID front and back)
     id_front = None
@@ -3660,12 +4440,11 @@ def submit_client_registration():
             if file and file.filename and allowed_id_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_ext = filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"id_front_{session['client_id']}_{secrets.token_hex(8)}.{file_ext}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                id_front = unique_filename
+                id_front = store_upload(file, file_ext)
+                stored_uploads.append(id_front)
         
         if not id_front:
+            release_uploads(stored_uploads)
             flash('ID/Passport front image is required for Individual clients', 'error')
             return redirect(url_for('client_registration'))
         
@@ -3675,12 +4454,11 @@ def submit_client_registration():
             if file and file.filename and allowed_id_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_ext = filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"id_back_{session['client_id']}_{secrets.token_hex(8)}.{file_ext}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                id_back = unique_filename
+                id_back = store_upload(file, file_ext)
+                stored_uploads.append(id_back)
         
         if not id_back:
+            release_uploads(stored_uploads)
             flash('ID/Passport back image is required for Individual clients', 'error')
             return redirect(url_for('client_registration'))
     
@@ -3694,18 +4472,18 @@ def submit_client_registration():
             if file and file.filename and allowed_document_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_ext = filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"cr12_{session['client_id']}_{secrets.token_hex(8)}.{file_ext}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                cr12_certificate = unique_filename
+                cr12_certificate = store_upload(file, file_ext)
+                stored_uploads.append(cr12_certificate)
         
         if not cr12_certificate:
+            release_uploads(stored_uploads)
             flash('CR-12 certificate is required for Corporate clients', 'error')
             return redirect(url_for('client_registration'))
         
         # Get post office address
         post_office_address = request.form.get('post_office_address', '').strip()
         if not post_office_address:
+            release_uploads(stored_uploads)
             flash('Post office address is required for Corporate clients', 'error')
             return redirect(url_for('client_registration'))
     
@@ -3713,7 +4491,20 @@ def submit_client_registration():
     connection = get_db_connection()
     if connection:
         try:
-            with connection.cursor() as cursor:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                # Files this submission replaces, released once the update is committed
+                cursor.execute("""
+                    SELECT profile_picture, id_front, id_back, cr12_certificate FROM clients WHERE id = %s FOR UPDATE
+                """, (session['client_id'],))
+                previous = cursor.fetchone() or {}
+                replaced_uploads = []
+                if profile_picture:
+                    replaced_uploads.append(previous.get('profile_picture'))
+                if client_type == 'Individual':
+                    replaced_uploads.extend([previous.get('id_front'), previous.get('id_back')])
+                elif client_type == 'Corporate':
+                    replaced_uploads.append(previous.get('cr12_certificate'))
+                
                 # Build update query based on client type and provided data
                 update_fields = ['phone_number = %s', 'client_type = %s']
                 update_values = [phone_number, client_type]
@@ -3751,6 +4542,12 @@ def submit_client_registration():
                 session['client_type'] = client_type
                 
                 connection.commit()
+                release_uploads(replaced_uploads)
+                stored_uploads = []
+                # Set up the client's Drive folders off the request path
+                threading.Thread(
+                    target=provision_client_drive_folders, args=(session['client_id'],), daemon=True
+                ).start()
                 flash('Registration completed successfully!', 'success')
                 return redirect(url_for('client_dashboard'))
         except Exception as e:
@@ -3759,6 +4556,7 @@ def submit_client_registration():
         finally:
             connection.close()
     
+    release_uploads(stored_uploads)
     return redirect(url_for('client_registration'))
 
 @app.route('/client_profile')
@@ -3808,6 +4606,7 @@ def update_client_profile():
         flash('Database connection error.', 'error')
         return redirect(url_for('client_profile'))
     
+    profile_picture = None
     try:
         full_name = request.form.get('full_name', '').strip().upper()
         phone_number = request.form.get('phone_number', '').strip().replace(' ', '')
@@ -3851,19 +4650,7 @@ def update_client_profile():
                 if file and file.filename and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     file_ext = filename.rsplit('.', 1)[1].lower()
-                    unique_filename = f"client_{session['client_id']}_{secrets.token_hex(8)}.{file_ext}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-                    profile_picture = unique_filename
-                    
-                    # Delete old uploaded profile picture if exists (not Google URL)
-                    if old_profile_picture and not old_profile_picture.startswith('http'):
-                        old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], old_profile_picture)
-                        if os.path.exists(old_filepath):
-                            try:
-                                os.remove(old_filepath)
-                            except Exception as e:
-                                print(f"Error deleting old profile picture: {e}")
+                    profile_picture = store_upload(file, file_ext)
             
             # Update client in database
             if profile_picture:
@@ -3888,6 +4675,10 @@ def update_client_profile():
                         session['client_profile_picture'] = old_profile_picture
             
             connection.commit()
+            if profile_picture:
+                # Release the replaced picture (Google URLs are skipped)
+                release_upload(old_profile_picture)
+                profile_picture = None
             
             # Update session
             session['client_name'] = full_name
@@ -3896,6 +4687,7 @@ def update_client_profile():
             flash('Profile updated successfully!', 'success')
             return redirect(url_for('client_profile'))
     except Exception as e:
+        release_upload(profile_picture)
         print(f"Error updating client profile: {e}")
         flash('An error occurred while updating your profile. Please try again.', 'error')
         return redirect(url_for('client_profile'))
@@ -3966,6 +4758,9 @@ def update_profile():
         flash('Database connection error.', 'error')
         return redirect(url_for('profile'))
     
+    # A newly stored picture is released again unless the update commits
+    profile_picture = None
+    old_profile_picture = None
     try:
         full_name = request.form.get('full_name', '').strip()
         phone_number = request.form.get('phone_number', '').strip()
@@ -3996,32 +4791,16 @@ def update_profile():
                 return redirect(url_for('profile'))
             
             # Handle profile picture upload
-            profile_picture = None
             if 'profile_picture' in request.files:
                 file = request.files['profile_picture']
                 if file and file.filename and allowed_file(file.filename):
-                    # Get current employee code for filename
-                    cursor.execute("SELECT employee_code FROM employees WHERE id = %s", (session['employee_id'],))
-                    emp_data = cursor.fetchone()
-                    employee_code = emp_data['employee_code'] if emp_data else 'user'
-                    
                     filename = secure_filename(file.filename)
                     file_ext = filename.rsplit('.', 1)[1].lower()
-                    unique_filename = f"{employee_code}_{secrets.token_hex(8)}.{file_ext}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-                    profile_picture = unique_filename
-                    
-                    # Delete old profile picture if exists
+                    # Old profile picture is released after the update commits
                     cursor.execute("SELECT profile_picture FROM employees WHERE id = %s", (session['employee_id'],))
                     old_pic = cursor.fetchone()
-                    if old_pic and old_pic['profile_picture']:
-                        old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], old_pic['profile_picture'])
-                        if os.path.exists(old_filepath):
-                            try:
-                                os.remove(old_filepath)
-                            except:
-                                pass
+                    old_profile_picture = old_pic['profile_picture'] if old_pic else None
+                    profile_picture = store_upload(file, file_ext)
             
             # Handle password change
             current_password = request.form.get('current_password', '').strip()
@@ -4083,6 +4862,9 @@ def update_profile():
                 """, (full_name, phone_number, work_email, session['employee_id']))
             
             connection.commit()
+            if profile_picture:
+                release_upload(old_profile_picture)
+                profile_picture = None
             
             # Update session
             session['employee_name'] = full_name
@@ -4103,6 +4885,7 @@ def update_profile():
         flash('An error occurred while updating profile', 'error')
     finally:
         connection.close()
+        release_upload(profile_picture)
     
     return redirect(url_for('profile'))
 
@@ -4290,33 +5073,8 @@ def employee_communications():
     email_accounts = get_email_accounts_from_db()
     email_settings = get_email_settings()
     
-    # Also fetch from cPanel if settings are configured
-    cpanel_emails = []
-    if email_settings:
-        try:
-            result = list_email_accounts(
-                email_settings['cpanel_api_token'],
-                email_settings['cpanel_domain'],
-                email_settings['cpanel_user'],
-                email_settings['cpanel_api_port']
-            )
-            if result.get('status') == 1 and 'data' in result:
-                for account in result['data']:
-                    email_addr = account.get('email', '')
-                    if email_addr:
-                        # Check if already in email_accounts
-                        if not any(ea.get('email_address') == email_addr for ea in email_accounts):
-                            cpanel_emails.append({
-                                'email_address': email_addr,
-                                'is_cpanel': True,
-                                'disk_used': account.get('humandiskused', '0 MB'),
-                                'disk_quota': account.get('humandiskquota', '250 MB')
-                            })
-        except Exception as e:
-            print(f"Error fetching cPanel emails: {e}")
-    
-    # Combine all emails
-    all_emails = email_accounts + cpanel_emails
+    # Also include cPanel-only mailboxes (cached listing, refreshed in the background)
+    all_emails = merge_cpanel_email_accounts(email_accounts, get_cpanel_email_accounts(email_settings))
     
     company_settings = get_company_settings()
     if not company_settings:
@@ -4349,10 +5107,13 @@ def employee_email_conversation(employee_id, contact_email):
     
     # Decode the email
     contact_email = contact_email.replace('%40', '@')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 50
     
     connection = get_db_connection()
     employee = None
     emails = []
+    total_messages = 0
     
     if connection:
         try:
@@ -4376,24 +5137,24 @@ def employee_email_conversation(employee_id, contact_email):
                         if account and account.get('email_password'):
                             password = account['email_password']
                         
-                        # Fetch all emails
-                        all_emails = fetch_emails_from_imap(
+                        # Filter on the server (INBOX and Sent) and fetch only this page of matches,
+                        # already ordered newest first by INTERNALDATE
+                        emails, total_messages = fetch_contact_conversation(
                             employee['work_email'], password,
                             email_settings['imap_host'], email_settings['imap_port'],
-                            email_settings['imap_use_ssl'], 200
+                            email_settings['imap_use_ssl'], contact_email,
+                            page=page, per_page=per_page
                         )
                         
-                        # Filter emails for this contact (both sent and received)
-                        contact_email_lower = contact_email.lower()
-                        for email in all_emails:
-                            email_from = email.get('from', '').lower()
-                            email_to = email.get('to', '').lower()
-                            # Check if email is from or to this contact
-                            if contact_email_lower in email_from or contact_email_lower in email_to:
-                                emails.append(email)
+                        # Load bodies lazily, only for the messages in this conversation
+                        load_cached_email_bodies(
+                            emails, password,
+                            email_settings['imap_host'], email_settings['imap_port'],
+                            email_settings['imap_use_ssl']
+                        )
                         
-                        # Sort by date (newest first)
-                        emails.sort(key=lambda x: x.get('date', ''), reverse=True)
+                        # Render as threads (Message-ID/In-Reply-To/References) instead of a flat list
+                        emails = order_emails_by_thread(emails)
         except Exception as e:
             print(f"Error fetching email conversation: {e}")
             import traceback
@@ -4410,7 +5171,10 @@ def employee_email_conversation(employee_id, contact_email):
                          company_settings=company_settings,
                          employee=employee,
                          contact_email=contact_email,
-                         emails=emails)
+                         emails=emails,
+                         page=page,
+                         per_page=per_page,
+                         total_messages=total_messages)
 
 @app.route('/onboarding_approvals')
 def onboarding_approvals():
@@ -4536,10 +5300,7 @@ def submit_onboarding():
             filename = secure_filename(file.filename)
             # Create unique filename
             file_ext = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"contract_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            employment_contract = unique_filename
+            employment_contract = store_upload(file, file_ext)
     
     if not employment_contract:
         flash('Employment contract upload is required', 'error')
@@ -4553,12 +5314,10 @@ def submit_onboarding():
             filename = secure_filename(file.filename)
             # Create unique filename
             file_ext = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"id_front_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            id_front = unique_filename
+            id_front = store_upload(file, file_ext)
     
     if not id_front:
+        release_upload(employment_contract)
         flash('ID/Passport front upload is required', 'error')
         return redirect(url_for('onboarding'))
     
@@ -4570,12 +5329,10 @@ def submit_onboarding():
             filename = secure_filename(file.filename)
             # Create unique filename
             file_ext = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"id_back_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            id_back = unique_filename
+            id_back = store_upload(file, file_ext)
     
     if not id_back:
+        release_uploads([employment_contract, id_front])
         flash('ID/Passport back upload is required', 'error')
         return redirect(url_for('onboarding'))
     
@@ -4605,27 +5362,18 @@ def submit_onboarding():
                         # Save processed signature
                         filename = secure_filename(file.filename)
                         file_ext = 'png'  # Always save as PNG after processing
-                        unique_filename = f"signature_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        
                         processed_img.seek(0)
-                        with open(filepath, 'wb') as f:
-                            f.write(processed_img.read())
-                        
-                        signature = unique_filename
+                        signature = store_upload(processed_img, file_ext)
                 except Exception as e:
                     print(f"Error processing signature: {e}")
                     # Fallback to original file if processing fails
                     if file.filename and allowed_file(file.filename):
                         filename = secure_filename(file.filename)
                         file_ext = filename.rsplit('.', 1)[1].lower()
-                        unique_filename = f"signature_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        file.save(filepath)
-                        signature = unique_filename
+                        signature = store_upload(file, file_ext)
                         
                         # Generate hash from saved file
-                        with open(filepath, 'rb') as f:
+                        with storage_open(signature) as f:
                             signature_hash = generate_signature_hash(f.read())
     
     # Handle stamp upload (optional)
@@ -4654,32 +5402,27 @@ def submit_onboarding():
                         # Save processed stamp
                         filename = secure_filename(file.filename)
                         file_ext = 'png'  # Always save as PNG after processing
-                        unique_filename = f"stamp_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        
                         processed_img.seek(0)
-                        with open(filepath, 'wb') as f:
-                            f.write(processed_img.read())
-                        
-                        stamp = unique_filename
+                        stamp = store_upload(processed_img, file_ext)
                 except Exception as e:
                     print(f"Error processing stamp: {e}")
                     # Fallback to original file if processing fails
                     if file.filename and allowed_file(file.filename):
                         filename = secure_filename(file.filename)
                         file_ext = filename.rsplit('.', 1)[1].lower()
-                        unique_filename = f"stamp_{employee_id}_{secrets.token_hex(8)}.{file_ext}"
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        file.save(filepath)
-                        stamp = unique_filename
+                        stamp = store_upload(file, file_ext)
                         
                         # Generate hash from saved file
-                        with open(filepath, 'rb') as f:
+                        with storage_open(stamp) as f:
                             stamp_hash = generate_signature_hash(f.read())
     
+    # Released again if the submission isn't saved
+    stored_uploads = [employment_contract, id_front, id_back, signature, stamp]
+    
     # Save to database
     connection = get_db_connection()
     if not connection:
+        release_uploads(stored_uploads)
         flash('Database connection error. Please try again later.', 'error')
         return redirect(url_for('onboarding'))
     
@@ -4709,6 +5452,12 @@ def submit_onboarding():
         
         # Now perform the update
         with connection.cursor() as cursor:
+            # Files this submission replaces, released once the update is committed
+            cursor.execute("""
+                SELECT employment_contract, id_front, id_back, signature, stamp
+                FROM employees WHERE id = %s FOR UPDATE
+            """, (employee_id,))
+            replaced_uploads = cursor.fetchone() or []
             cursor.execute("""
                 UPDATE employees 
                 SET account_number = %s,
@@ -4735,10 +5484,13 @@ def submit_onboarding():
                   employment_contract, id_front, id_back, signature, signature_hash, 
                   stamp, stamp_hash, employee_id))
             connection.commit()
+            stored_uploads = []
+            release_uploads(replaced_uploads)
             flash('Onboarding information submitted successfully!', 'success')
             return redirect(url_for('dashboard'))
     except Exception as e:
         print(f"Onboarding submission error: {e}")
+        release_uploads(stored_uploads)
         flash('An error occurred during submission. Please try again.', 'error')
         return redirect(url_for('onboarding'))
     finally:
@@ -5252,51 +6004,17 @@ def case_documents(case_id):
                 flash('Case not found', 'error')
                 return redirect(url_for('case_management'))
             
-            # Check if Google Drive is connected and load credentials
-            google_drive_connected = False
-            if 'google_drive_credentials' in session:
-                google_drive_connected = True
-            else:
-                # Check database and load credentials
-                cursor.execute("""
-                    SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                           google_drive_scopes
-                    FROM company_settings 
-                    ORDER BY id DESC LIMIT 1
-                """)
-                settings = cursor.fetchone()
-                if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                    google_drive_connected = True
-                    # Load credentials into session for document fetching
-                    scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                    session['google_drive_credentials'] = {
-                        'token': settings['google_drive_token'],
-                        'refresh_token': settings['google_drive_refresh_token'],
-                        'token_uri': settings.get('google_drive_token_uri'),
-                        'client_id': GOOGLE_CLIENT_ID,
-                        'client_secret': GOOGLE_CLIENT_SECRET,
-                        'scopes': scopes
-                    }
-            
-            # Fetch documents from Google Drive if connected
+            # Check if Google Drive is connected
+            google_drive_connected = get_drive_settings() is not None
+            
+            # Keep the local document index current if Google Drive is connected
             documents = []
             if google_drive_connected:
                 try:
                     service = get_google_drive_service()
                     
                     if service:
-                        # Get main folder ID
-                        main_folder_id = session.get('google_drive_main_folder_id')
-                        if not main_folder_id:
-                            cursor.execute("""
-                                SELECT google_drive_main_folder_id
-                                FROM company_settings 
-                                ORDER BY id DESC LIMIT 1
-                            """)
-                            settings = cursor.fetchone()
-                            if settings and settings.get('google_drive_main_folder_id'):
-                                main_folder_id = settings['google_drive_main_folder_id']
-                                session['google_drive_main_folder_id'] = main_folder_id
+                        main_folder_id = get_drive_main_folder_id()
                         
                         if main_folder_id and case_data.get('client_table_id'):
                             # Get client folder
@@ -5306,97 +6024,27 @@ def case_documents(case_id):
                                 'client'
                             )
                             
-                            # Escape single quotes in folder name for query
-                            escaped_folder_name = client_folder_name.replace("'", "\\'")
-                            
-                            # Find client folder
-                            query = f"name='{escaped_folder_name}' and '{main_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-                            results = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-                            client_folders = results.get('files', [])
-                            
-                            if client_folders:
-                                client_folder_id = client_folders[0]['id']
-                            else:
-                                # Create client folder if it doesn't exist
-                                print(f"INFO: Creating client folder: {client_folder_name}")
-                                client_folder_id = get_or_create_folder(service, main_folder_id, client_folder_name)
-                            
-                            # Find or create CLIENT_CASE_DOCUMENT folder
-                            query = f"name='CLIENT_CASE_DOCUMENT' and '{client_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-                            results = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-                            case_doc_folders = results.get('files', [])
-                            
-                            if case_doc_folders:
-                                case_doc_folder_id = case_doc_folders[0]['id']
-                            else:
-                                # Create CLIENT_CASE_DOCUMENT folder if it doesn't exist
-                                print(f"INFO: Creating CLIENT_CASE_DOCUMENT folder")
-                                case_doc_folder_id = get_or_create_folder(service, client_folder_id, 'CLIENT_CASE_DOCUMENT')
+                            # Resolve the client and CLIENT_CASE_DOCUMENT folders (cached, created if missing)
+                            client_folder_id = get_or_create_folder(service, main_folder_id, client_folder_name)
+                            case_doc_folder_id = get_or_create_folder(service, client_folder_id, 'CLIENT_CASE_DOCUMENT')
                             
-                            if case_doc_folder_id:
-                                # List all files in the folder
-                                query = f"'{case_doc_folder_id}' in parents and trashed=false"
-                                results = service.files().list(
-                                    q=query,
-                                    spaces='drive',
-                                    fields='files(id, name, createdTime, modifiedTime, webViewLink, size, mimeType)',
-                                    orderBy='modifiedTime desc'
-                                ).execute()
-                                
-                                files = results.get('files', [])
-                                for file in files:
-                                    # Skip folders
-                                    if file.get('mimeType') == 'application/vnd.google-apps.folder':
-                                        continue
-                                    
-                                    # Format dates
-                                    created_time = file.get('createdTime', '')
-                                    modified_time = file.get('modifiedTime', '')
-                                    if created_time:
-                                        try:
-                                            from datetime import datetime
-                                            dt = datetime.fromisoformat(created_time.replace('Z', '+00:00'))
-                                            created_time = dt.strftime('%Y-%m-%d %H:%M:%S')
-                                        except:
-                                            pass
-                                    if modified_time:
-                                        try:
-                                            from datetime import datetime
-                                            dt = datetime.fromisoformat(modified_time.replace('Z', '+00:00'))
-                                            modified_time = dt.strftime('%Y-%m-%d %H:%M:%S')
-                                        except:
-                                            pass
-                                    
-                                    # Format file size
-                                    size = file.get('size', '0')
-                                    if size:
-                                        try:
-                                            size_int = int(size)
-                                            if size_int < 1024:
-                                                size_str = f"{size_int} B"
-                                            elif size_int < 1024 * 1024:
-                                                size_str = f"{size_int / 1024:.2f} KB"
-                                            else:
-                                                size_str = f"{size_int / (1024 * 1024):.2f} MB"
-                                        except:
-                                            size_str = "Unknown"
-                                    else:
-                                        size_str = "Unknown"
-                                    
-                                    documents.append({
-                                        'id': file.get('id'),
-                                        'name': file.get('name', 'Unknown'),
-                                        'created_time': created_time,
-                                        'modified_time': modified_time,
-                                        'url': file.get('webViewLink', ''),
-                                        'size': size_str,
-                                        'mime_type': file.get('mimeType', '')
-                                    })
+                            # Index the folder on first visit; later Drive edits arrive through the changes consumer
+                            ensure_drive_folder_indexed(service, case_doc_folder_id, case_data['client_table_id'], 'CLIENT_CASE_DOCUMENT')
                 except Exception as e:
                     print(f"Error fetching documents from Google Drive: {e}")
                     import traceback
                     traceback.print_exc()
             
+            # Document list comes from the local index, filtered and sorted in MySQL
+            if case_data.get('client_table_id'):
+                documents = get_indexed_documents(
+                    case_data['client_table_id'],
+                    'CLIENT_CASE_DOCUMENT',
+                    search=request.args.get('q', '').strip(),
+                    sort=request.args.get('sort', 'modified'),
+                    order=request.args.get('order', 'desc')
+                )
+            
             company_settings = get_company_settings()
             if not company_settings:
                 company_settings = {'company_name': 'BAUNI LAW GROUP'}
@@ -7386,6 +8034,7 @@ def google_drive_callback():
                             google_drive_refresh_token = %s,
                             google_drive_token_uri = %s,
                             google_drive_scopes = %s,
+                            google_drive_token_expiry = %s,
                             google_drive_account_email = %s,
                             google_drive_account_name = %s,
                             google_drive_account_picture = %s,
@@ -7396,6 +8045,7 @@ def google_drive_callback():
                         credentials.refresh_token,
                         credentials.token_uri,
                         json.dumps(credentials.scopes) if credentials.scopes else None,
+                        credentials.expiry,
                         id_info.get('email'),
                         id_info.get('name'),
                         id_info.get('picture')
@@ -7407,23 +8057,9 @@ def google_drive_callback():
             finally:
                 connection.close()
         
-        # Also store in session for immediate use
-        session['google_drive_credentials'] = {
-            'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }
-        session['google_drive_account'] = {
-            'email': id_info.get('email'),
-            'name': id_info.get('name'),
-            'picture': id_info.get('picture')
-        }
-        
-        # Clear state
+        # Clear state (and settings/clients cached for a previously connected account)
         session.pop('google_drive_oauth_state', None)
+        clear_drive_client_cache()
         
         # Send success message to opener window
         account_data = {
@@ -7458,63 +8094,11 @@ def google_drive_status():
     if 'employee_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    # First check database for persistent credentials
-    connection = get_db_connection()
-    if connection:
-        try:
-            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                cursor.execute("""
-                    SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                           google_drive_scopes, google_drive_account_email, google_drive_account_name,
-                           google_drive_account_picture, google_drive_main_folder_id
-                    FROM company_settings 
-                    ORDER BY id DESC LIMIT 1
-                """)
-                settings = cursor.fetchone()
-                
-                if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                    # Load credentials into session for use
-                    scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                    session['google_drive_credentials'] = {
-                        'token': settings['google_drive_token'],
-                        'refresh_token': settings['google_drive_refresh_token'],
-                        'token_uri': settings.get('google_drive_token_uri'),
-                        'client_id': GOOGLE_CLIENT_ID,
-                        'client_secret': GOOGLE_CLIENT_SECRET,
-                        'scopes': scopes
-                    }
-                    session['google_drive_account'] = {
-                        'email': settings.get('google_drive_account_email'),
-                        'name': settings.get('google_drive_account_name'),
-                        'picture': settings.get('google_drive_account_picture')
-                    }
-                    if settings.get('google_drive_main_folder_id'):
-                        session['google_drive_main_folder_id'] = settings['google_drive_main_folder_id']
-                    
-                    return jsonify({
-                        'connected': True,
-                        'account': {
-                            'email': settings.get('google_drive_account_email'),
-                            'name': settings.get('google_drive_account_name'),
-                            'picture': settings.get('google_drive_account_picture')
-                        }
-                    })
-        except Exception as e:
-            print(f"Error checking Google Drive status from database: {e}")
-        finally:
-            connection.close()
-    
-    # Fallback to session check
-    if 'google_drive_credentials' in session and 'google_drive_account' in session:
-        return jsonify({
-            'connected': True,
-            'account': session['google_drive_account']
-        })
-    else:
-        return jsonify({
-            'connected': False,
-            'account': None
-        })
+    settings = get_drive_settings(force_refresh=True)
+    return jsonify({
+        'connected': settings is not None,
+        'account': settings['account'] if settings else None
+    })
 
 @app.route('/api/auth/google-drive/disconnect', methods=['POST'])
 def google_drive_disconnect():
@@ -7547,10 +8131,11 @@ def google_drive_disconnect():
         finally:
             connection.close()
     
-    # Clear from session
+    # Clear the per-process settings and client caches (and values older versions kept in the session)
     session.pop('google_drive_credentials', None)
     session.pop('google_drive_account', None)
     session.pop('google_drive_main_folder_id', None)
+    clear_drive_client_cache()
     
     return jsonify({
         'success': True,
@@ -7586,54 +8171,233 @@ def get_user_folder_name(phone_number, full_name, user_type='client'):
         # If no phone number, use just the name
         return full_name
 
-def get_google_drive_service():
-    """Get Google Drive service from stored credentials (database or session)"""
-    # First try to load from database if not in session
-    if 'google_drive_credentials' not in session:
-        connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                               google_drive_scopes
-                        FROM company_settings 
-                        ORDER BY id DESC LIMIT 1
-                    """)
-                    settings = cursor.fetchone()
-                    
-                    if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                        scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                        session['google_drive_credentials'] = {
-                            'token': settings['google_drive_token'],
-                            'refresh_token': settings['google_drive_refresh_token'],
-                            'token_uri': settings.get('google_drive_token_uri'),
-                            'client_id': GOOGLE_CLIENT_ID,
-                            'client_secret': GOOGLE_CLIENT_SECRET,
-                            'scopes': scopes
-                        }
-            except Exception as e:
-                print(f"Error loading Google Drive credentials from database: {e}")
-            finally:
-                connection.close()
-    
-    if 'google_drive_credentials' not in session:
+# ==================== GOOGLE DRIVE CLIENT CACHE ====================
+
+# Parsed once per process from the discovery document bundled with google-api-python-client
+_drive_discovery_doc = None
+_drive_discovery_lock = threading.Lock()
+# refresh_token -> Credentials; shared so a token refreshed by one request is reused by the next
+_drive_credentials_cache = {}
+_drive_credentials_lock = threading.Lock()
+# httplib2.Http (inside each service object) is not thread-safe, so services are cached per thread
+_drive_thread_local = threading.local()
+# company_settings Drive columns, re-read at most this often (credentials never travel in the session cookie)
+DRIVE_SETTINGS_CACHE_SECONDS = 60
+_drive_settings_cache = {}
+_drive_settings_lock = threading.Lock()
+# Access tokens are refreshed this long before they expire
+DRIVE_TOKEN_REFRESH_MARGIN_SECONDS = 300
+_drive_refresh_lock = threading.Lock()
+# After a failed refresh, keep using the current token for this long before asking Google again
+DRIVE_TOKEN_REFRESH_FAILURE_COOLDOWN_SECONDS = 60
+# How long a process waits for another process's refresh (cross-process MySQL named lock)
+DRIVE_TOKEN_REFRESH_LOCK_WAIT_SECONDS = 10
+_drive_refresh_failed_at = None
+
+def get_drive_discovery_document():
+    """Drive v3 discovery document as a dict, loaded from the bundled static copy once per process"""
+    global _drive_discovery_doc
+    if _drive_discovery_doc is None:
+        with _drive_discovery_lock:
+            if _drive_discovery_doc is None:
+                from googleapiclient.discovery_cache import get_static_doc
+                content = get_static_doc('drive', 'v3')
+                _drive_discovery_doc = json.loads(content) if content else {}
+    return _drive_discovery_doc
+
+def get_drive_settings(force_refresh=False):
+    """
+    Google Drive connection from company_settings (token set, account and main folder ID), or None
+    when Drive is not connected. Cached per process for DRIVE_SETTINGS_CACHE_SECONDS.
+    """
+    with _drive_settings_lock:
+        cached = _drive_settings_cache.get('settings')
+        if not force_refresh and cached is not None and time.monotonic() - _drive_settings_cache['loaded_at'] < DRIVE_SETTINGS_CACHE_SECONDS:
+            return cached or None
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
+                       google_drive_scopes, google_drive_token_expiry, google_drive_account_email,
+                       google_drive_account_name, google_drive_account_picture, google_drive_main_folder_id
+                FROM company_settings 
+                ORDER BY id DESC LIMIT 1
+            """)
+            row = cursor.fetchone()
+    except Exception as e:
+        print(f"Error loading Google Drive settings from database: {e}")
         return None
+    finally:
+        connection.close()
     
+    settings = {}
+    if row and row.get('google_drive_token') and row.get('google_drive_refresh_token'):
+        settings = {
+            'credentials': {
+                'token': row['google_drive_token'],
+                'refresh_token': row['google_drive_refresh_token'],
+                'token_uri': row.get('google_drive_token_uri'),
+                'client_id': GOOGLE_CLIENT_ID,
+                'client_secret': GOOGLE_CLIENT_SECRET,
+                'scopes': json.loads(row['google_drive_scopes']) if row.get('google_drive_scopes') else [],
+                'expiry': row.get('google_drive_token_expiry')
+            },
+            'account': {
+                'email': row.get('google_drive_account_email'),
+                'name': row.get('google_drive_account_name'),
+                'picture': row.get('google_drive_account_picture')
+            },
+            'main_folder_id': row.get('google_drive_main_folder_id')
+        }
+    with _drive_settings_lock:
+        _drive_settings_cache['settings'] = settings
+        _drive_settings_cache['loaded_at'] = time.monotonic()
+    return settings or None
+
+def get_cached_drive_credentials(creds_dict):
+    """Process-wide Credentials for a stored token set; google-auth refreshes them in place on expiry"""
+    refresh_token = creds_dict.get('refresh_token')
+    with _drive_credentials_lock:
+        credentials = _drive_credentials_cache.get(refresh_token)
+        if credentials is None:
+            credentials = Credentials(
+                token=creds_dict.get('token'),
+                refresh_token=refresh_token,
+                token_uri=creds_dict.get('token_uri'),
+                client_id=creds_dict.get('client_id'),
+                client_secret=creds_dict.get('client_secret'),
+                scopes=creds_dict.get('scopes')
+            )
+            credentials.expiry = creds_dict.get('expiry')
+            _drive_credentials_cache[refresh_token] = credentials
+        return credentials
+
+def save_refreshed_drive_token(credentials):
+    """Write a refreshed access token back to company_settings so other processes reuse it"""
+    connection = get_db_connection()
+    if not connection:
+        return
     try:
-        creds_dict = session['google_drive_credentials']
-        credentials = Credentials(
-            token=creds_dict.get('token'),
-            refresh_token=creds_dict.get('refresh_token'),
-            token_uri=creds_dict.get('token_uri'),
-            client_id=creds_dict.get('client_id'),
-            client_secret=creds_dict.get('client_secret'),
-            scopes=creds_dict.get('scopes')
-        )
-        
-        # Build and return the Drive service
-        service = build('drive', 'v3', credentials=credentials)
-        return service
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE company_settings
+                SET google_drive_token = %s, google_drive_token_expiry = %s
+                WHERE google_drive_refresh_token = %s
+            """, (credentials.token, credentials.expiry, credentials.refresh_token))
+        connection.commit()
+    except Exception as e:
+        print(f"Error saving refreshed Google Drive token: {e}")
+    finally:
+        connection.close()
+    with _drive_settings_lock:
+        _drive_settings_cache.clear()
+
+def _adopt_persisted_drive_token(credentials, refresh_at):
+    """Take over an access token another process refreshed and saved; True if it is still fresh"""
+    settings = get_drive_settings(force_refresh=True)
+    stored = settings['credentials'] if settings else {}
+    if (stored.get('refresh_token') == credentials.refresh_token and stored.get('expiry')
+            and stored['expiry'] > refresh_at):
+        credentials.token = stored['token']
+        credentials.expiry = stored['expiry']
+        return True
+    return False
+
+def get_drive_credentials():
+    """
+    Credentials for the connected Drive account (None if not connected). The access token is
+    refreshed shortly before it expires by one process at a time (others pick up the token it
+    writes back to company_settings); a failed refresh is not retried for a short cooldown.
+    """
+    global _drive_refresh_failed_at
+    settings = get_drive_settings()
+    if not settings:
+        return None
+    credentials = get_cached_drive_credentials(settings['credentials'])
+    refresh_at = datetime.utcnow() + timedelta(seconds=DRIVE_TOKEN_REFRESH_MARGIN_SECONDS)
+    if credentials.expiry is None or credentials.expiry <= refresh_at:
+        with _drive_refresh_lock:
+            # Another thread may have refreshed while we waited
+            if credentials.expiry is not None and credentials.expiry > refresh_at:
+                return credentials
+            if (_drive_refresh_failed_at is not None and
+                    time.monotonic() - _drive_refresh_failed_at < DRIVE_TOKEN_REFRESH_FAILURE_COOLDOWN_SECONDS):
+                return credentials
+            if _adopt_persisted_drive_token(credentials, refresh_at):
+                return credentials
+            with mysql_named_lock('drive_token_refresh', DRIVE_TOKEN_REFRESH_LOCK_WAIT_SECONDS) as acquired:
+                # The lock holder before us may just have saved a new token
+                if not acquired or _adopt_persisted_drive_token(credentials, refresh_at):
+                    return credentials
+                try:
+                    credentials.refresh(google_requests.Request())
+                    save_refreshed_drive_token(credentials)
+                    _drive_refresh_failed_at = None
+                except Exception as e:
+                    # Fall back to the current token; google-auth retries the refresh on a 401
+                    _drive_refresh_failed_at = time.monotonic()
+                    print(f"Error refreshing Google Drive token: {e}")
+    return credentials
+
+def build_drive_service(credentials):
+    """Drive v3 client for the calling thread, built once per thread and credentials object"""
+    services = getattr(_drive_thread_local, 'services', None)
+    if services is None:
+        services = _drive_thread_local.services = {}
+    cached = services.get(credentials.refresh_token)
+    if cached and cached[0] is credentials:
+        return cached[1]
+    
+    document = get_drive_discovery_document()
+    if document:
+        service = build_from_document(document, credentials=credentials)
+    else:
+        service = build('drive', 'v3', credentials=credentials, static_discovery=True, cache_discovery=False)
+    services[credentials.refresh_token] = (credentials, service)
+    return service
+
+def clear_drive_client_cache():
+    """Forget cached settings and credentials (e.g. after Google Drive is disconnected or reconnected)"""
+    with _drive_credentials_lock:
+        _drive_credentials_cache.clear()
+    with _drive_settings_lock:
+        _drive_settings_cache.clear()
+
+def get_drive_main_folder_id():
+    """ID of the SHERIA CENTRIC folder saved in company_settings"""
+    settings = get_drive_settings()
+    return settings.get('main_folder_id') if settings else None
+
+def save_drive_main_folder_id(folder_id):
+    """Store the SHERIA CENTRIC folder ID in company_settings"""
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE company_settings 
+                SET google_drive_main_folder_id = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = (SELECT id FROM (SELECT id FROM company_settings ORDER BY id DESC LIMIT 1) AS sub)
+            """, (folder_id,))
+        connection.commit()
+    finally:
+        connection.close()
+    with _drive_settings_lock:
+        _drive_settings_cache.clear()
+
+def get_google_drive_service():
+    """Get Google Drive service for the connected account (None if Drive is not connected)"""
+    try:
+        credentials = get_drive_credentials()
+        if not credentials:
+            return None
+        # Cached per thread; no discovery document parsing after the first call
+        return build_drive_service(credentials)
     except Exception as e:
         print(f"Error building Google Drive service: {e}")
         return None
@@ -7644,45 +8408,7 @@ def create_main_folder():
     if 'employee_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    # Check if Google Drive is connected (try loading from database first)
-    if 'google_drive_credentials' not in session:
-        # Try to load from database
-        connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                               google_drive_scopes, google_drive_account_email, google_drive_account_name,
-                               google_drive_account_picture, google_drive_main_folder_id
-                        FROM company_settings 
-                        ORDER BY id DESC LIMIT 1
-                    """)
-                    settings = cursor.fetchone()
-                    
-                    if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                        scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                        session['google_drive_credentials'] = {
-                            'token': settings['google_drive_token'],
-                            'refresh_token': settings['google_drive_refresh_token'],
-                            'token_uri': settings.get('google_drive_token_uri'),
-                            'client_id': GOOGLE_CLIENT_ID,
-                            'client_secret': GOOGLE_CLIENT_SECRET,
-                            'scopes': scopes
-                        }
-                        session['google_drive_account'] = {
-                            'email': settings.get('google_drive_account_email'),
-                            'name': settings.get('google_drive_account_name'),
-                            'picture': settings.get('google_drive_account_picture')
-                        }
-                        if settings.get('google_drive_main_folder_id'):
-                            session['google_drive_main_folder_id'] = settings['google_drive_main_folder_id']
-            except Exception as e:
-                print(f"Error loading Google Drive credentials: {e}")
-            finally:
-                connection.close()
-    
-    if 'google_drive_credentials' not in session:
+    if not get_drive_settings():
         return jsonify({'error': 'Google Drive not connected'}), 400
     
     try:
@@ -7690,46 +8416,27 @@ def create_main_folder():
         if not service:
             return jsonify({'error': 'Failed to initialize Google Drive service'}), 500
         
-        # Check if folder already exists (check database first, then session)
+        # Check if folder already exists
         folder_name = 'SHERIA CENTRIC'
-        existing_folder_id = None
-        
-        # Check database
-        connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT google_drive_main_folder_id
-                        FROM company_settings 
-                        ORDER BY id DESC LIMIT 1
-                    """)
-                    settings = cursor.fetchone()
-                    if settings and settings.get('google_drive_main_folder_id'):
-                        existing_folder_id = settings['google_drive_main_folder_id']
-                        session['google_drive_main_folder_id'] = existing_folder_id
-            except Exception as e:
-                print(f"Error checking folder ID in database: {e}")
-            finally:
-                connection.close()
-        
-        # Fallback to session
-        if not existing_folder_id:
-            existing_folder_id = session.get('google_drive_main_folder_id')
+        existing_folder_id = get_drive_main_folder_id()
         
         if existing_folder_id:
-            # Verify folder still exists
+            # Verify the folder and the client folders cached under it, 100 per batch round trip
             try:
-                folder = service.files().get(fileId=existing_folder_id).execute()
-                folder_url = f"https://drive.google.com/drive/folders/{existing_folder_id}"
-                return jsonify({
-                    'success': True,
-                    'message': 'Folder already exists',
-                    'folder_id': existing_folder_id,
-                    'folder_url': folder_url
-                })
+                cached_child_ids = get_cached_child_folder_ids(existing_folder_id)
+                missing_ids = find_missing_drive_folders(service, [existing_folder_id] + cached_child_ids)
+                for missing_id in missing_ids:
+                    forget_drive_folder(missing_id)
+                if existing_folder_id not in missing_ids:
+                    folder_url = f"https://drive.google.com/drive/folders/{existing_folder_id}"
+                    return jsonify({
+                        'success': True,
+                        'message': 'Folder already exists',
+                        'folder_id': existing_folder_id,
+                        'folder_url': folder_url
+                    })
             except HttpError:
-                # Folder doesn't exist, create new one
+                # Folder can't be checked, create new one
                 pass
         
         # Create the folder
@@ -7746,25 +8453,11 @@ def create_main_folder():
         folder_id = folder.get('id')
         folder_url = folder.get('webViewLink', f"https://drive.google.com/drive/folders/{folder_id}")
         
-        # Store folder ID in session and database
-        session['google_drive_main_folder_id'] = folder_id
-        
-        # Also save to database
-        connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE company_settings 
-                        SET google_drive_main_folder_id = %s,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE id = (SELECT id FROM (SELECT id FROM company_settings ORDER BY id DESC LIMIT 1) AS sub)
-                    """, (folder_id,))
-                    connection.commit()
-            except Exception as e:
-                print(f"Error saving folder ID to database: {e}")
-            finally:
-                connection.close()
+        # Save folder ID to database
+        try:
+            save_drive_main_folder_id(folder_id)
+        except Exception as e:
+            print(f"Error saving folder ID to database: {e}")
         
         return jsonify({
             'success': True,
@@ -7788,33 +8481,943 @@ def create_main_folder():
             'details': str(e)
         }), 500
 
-def get_or_create_folder(service, parent_folder_id, folder_name):
-    """Get or create a folder in Google Drive"""
-    try:
-        # Escape single quotes in folder name for query
-        escaped_folder_name = folder_name.replace("'", "\\'")
-        
-        # Search for existing folder
-        query = f"name='{escaped_folder_name}' and '{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        results = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-        folders = results.get('files', [])
-        
-        if folders:
-            return folders[0]['id']
-        
-        # Create folder if it doesn't exist
-        file_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [parent_folder_id]
-        }
-        folder = service.files().create(body=file_metadata, fields='id, name').execute()
-        return folder.get('id')
-    except Exception as e:
-        print(f"Error getting/creating folder {folder_name}: {e}")
-        raise
+# ==================== DRIVE BATCH REQUESTS ====================
 
-@app.route('/api/case/<int:case_id>/upload-document', methods=['POST'])
+# Drive accepts at most 100 calls in one batch HTTP request
+DRIVE_BATCH_MAX_REQUESTS = 100
+
+def execute_drive_batch(service, requests_list):
+    """
+    Run Drive API requests through batch HTTP round trips of up to 100 calls each.
+    Returns [(response, error)] in the order of requests_list; errors are returned, not raised.
+    """
+    results = [(None, None)] * len(requests_list)
+    
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+    
+    for start in range(0, len(requests_list), DRIVE_BATCH_MAX_REQUESTS):
+        batch = service.new_batch_http_request(callback=callback)
+        for index, api_request in enumerate(requests_list[start:start + DRIVE_BATCH_MAX_REQUESTS], start):
+            batch.add(api_request, request_id=str(index))
+        batch.execute()
+    return results
+
+# ==================== DRIVE FOLDER CACHE ====================
+
+# (parent_id, folder_name) -> folder_id, in an in-process LRU backed by the drive_folders table.
+# Cached IDs are not re-checked; callers drop them with forget_drive_folder() when Drive answers 404.
+DRIVE_FOLDER_CACHE_SIZE = 2048
+_drive_folder_lru = OrderedDict()
+_drive_folder_lru_lock = threading.Lock()
+
+def is_drive_not_found(error):
+    """True for a Drive 404 (file or folder deleted, or no longer shared with us)"""
+    return isinstance(error, HttpError) and getattr(error.resp, 'status', None) == 404
+
+def _remember_drive_folder_locally(parent_id, folder_name, folder_id):
+    with _drive_folder_lru_lock:
+        _drive_folder_lru[(parent_id, folder_name)] = folder_id
+        _drive_folder_lru.move_to_end((parent_id, folder_name))
+        while len(_drive_folder_lru) > DRIVE_FOLDER_CACHE_SIZE:
+            _drive_folder_lru.popitem(last=False)
+
+def lookup_cached_drive_folder(parent_id, folder_name):
+    """Cached folder ID for (parent_id, folder_name): process LRU first, then the drive_folders table"""
+    with _drive_folder_lru_lock:
+        folder_id = _drive_folder_lru.get((parent_id, folder_name))
+        if folder_id:
+            _drive_folder_lru.move_to_end((parent_id, folder_name))
+            return folder_id
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT folder_id FROM drive_folders WHERE parent_id = %s AND folder_name = %s
+            """, (parent_id, folder_name))
+            row = cursor.fetchone()
+    except Exception as e:
+        print(f"Error reading Drive folder cache: {e}")
+        row = None
+    finally:
+        connection.close()
+    if row:
+        _remember_drive_folder_locally(parent_id, folder_name, row['folder_id'])
+        return row['folder_id']
+    return None
+
+def remember_drive_folder(parent_id, folder_name, folder_id):
+    """Store a resolved folder ID in the process LRU and the drive_folders table"""
+    _remember_drive_folder_locally(parent_id, folder_name, folder_id)
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO drive_folders (parent_id, folder_name, folder_id)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE folder_id = VALUES(folder_id)
+            """, (parent_id, folder_name, folder_id))
+        connection.commit()
+    except Exception as e:
+        print(f"Error saving Drive folder cache: {e}")
+    finally:
+        connection.close()
+
+def forget_drive_folder(folder_id):
+    """Drop a folder ID that Drive no longer knows, along with cached children beneath it"""
+    with _drive_folder_lru_lock:
+        for key in [k for k, v in _drive_folder_lru.items() if v == folder_id or k[0] == folder_id]:
+            del _drive_folder_lru[key]
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM drive_folders WHERE folder_id = %s OR parent_id = %s", (folder_id, folder_id))
+        connection.commit()
+    except Exception as e:
+        print(f"Error clearing Drive folder cache: {e}")
+    finally:
+        connection.close()
+
+def get_or_create_folders(service, parent_folder_id, folder_names):
+    """
+    Get or create several sibling folders in Google Drive; returns {folder_name: folder_id}.
+    Cached names cost nothing, the rest are found with one files().list query and
+    any still missing are created together in one batch request.
+    """
+    folder_ids = {}
+    missing = []
+    for folder_name in dict.fromkeys(folder_names):
+        cached_folder_id = lookup_cached_drive_folder(parent_folder_id, folder_name)
+        if cached_folder_id:
+            folder_ids[folder_name] = cached_folder_id
+        else:
+            missing.append(folder_name)
+    if not missing:
+        return folder_ids
+    try:
+        for start in range(0, len(missing), DRIVE_BATCH_MAX_REQUESTS):
+            chunk = missing[start:start + DRIVE_BATCH_MAX_REQUESTS]
+            # Escape single quotes in folder names for query
+            name_clauses = ' or '.join("name='{}'".format(name.replace("'", "\\'")) for name in chunk)
+            query = f"({name_clauses}) and '{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
+            results = service.files().list(q=query, spaces='drive', fields='files(id, name)', pageSize=1000).execute()
+            for folder in results.get('files', []):
+                if folder['name'] in chunk and folder['name'] not in folder_ids:
+                    folder_ids[folder['name']] = folder['id']
+        
+        # Create folders that don't exist
+        to_create = [name for name in missing if name not in folder_ids]
+        create_requests = [
+            service.files().create(body={
+                'name': folder_name,
+                'mimeType': 'application/vnd.google-apps.folder',
+                'parents': [parent_folder_id]
+            }, fields='id, name')
+            for folder_name in to_create
+        ]
+        for folder_name, (folder, error) in zip(to_create, execute_drive_batch(service, create_requests)):
+            if error:
+                raise error
+            folder_ids[folder_name] = folder.get('id')
+        
+        for folder_name in missing:
+            remember_drive_folder(parent_folder_id, folder_name, folder_ids[folder_name])
+        return folder_ids
+    except Exception as e:
+        print(f"Error getting/creating folders {', '.join(missing)}: {e}")
+        raise
+
+def get_or_create_folder(service, parent_folder_id, folder_name):
+    """Get or create a folder in Google Drive (cached by parent and name)"""
+    return get_or_create_folders(service, parent_folder_id, [folder_name])[folder_name]
+
+def find_missing_drive_folders(service, folder_ids):
+    """IDs among folder_ids that Drive reports as deleted, trashed or inaccessible (checked 100 per round trip)"""
+    folder_ids = list(dict.fromkeys(folder_ids))
+    requests_list = [service.files().get(fileId=folder_id, fields='id, trashed') for folder_id in folder_ids]
+    missing = []
+    for folder_id, (folder, error) in zip(folder_ids, execute_drive_batch(service, requests_list)):
+        if error is not None:
+            if not is_drive_not_found(error):
+                raise error
+            missing.append(folder_id)
+        elif folder.get('trashed'):
+            missing.append(folder_id)
+    return missing
+
+def get_cached_child_folder_ids(parent_folder_id):
+    """Folder IDs cached in drive_folders directly under a parent"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT folder_id FROM drive_folders WHERE parent_id = %s", (parent_folder_id,))
+            return [row['folder_id'] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+CLIENT_DRIVE_SUBFOLDERS = ['CLIENT_PERSONAL_DOCUMENT', 'CLIENT_CASE_DOCUMENT']
+
+def provision_client_drive_folders(client_id):
+    """Create a client's Drive folder and its document subfolders (two round trips for a new client)"""
+    credentials = get_drive_credentials()
+    main_folder_id = get_drive_main_folder_id()
+    if not credentials or not main_folder_id:
+        return None
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT full_name, phone_number FROM clients WHERE id = %s", (client_id,))
+            client = cursor.fetchone()
+    finally:
+        connection.close()
+    if not client:
+        return None
+    try:
+        service = build_drive_service(credentials)
+        client_folder_id = get_or_create_folder(
+            service, main_folder_id, get_user_folder_name(client.get('phone_number'), client.get('full_name'), 'client')
+        )
+        get_or_create_folders(service, client_folder_id, CLIENT_DRIVE_SUBFOLDERS)
+        return client_folder_id
+    except Exception as e:
+        print(f"Error provisioning Drive folders for client {client_id}: {e}")
+        return None
+
+# ==================== DOCUMENT INDEX ====================
+
+# Drive file fields stored in the documents table
+DRIVE_DOCUMENT_FIELDS = 'id, name, description, parents, trashed, size, mimeType, createdTime, modifiedTime, webViewLink'
+DOCUMENT_SORT_COLUMNS = {
+    'name': 'file_name',
+    'size': 'file_size',
+    'created': 'drive_created_at',
+    'modified': 'drive_modified_at'
+}
+
+def file_sha256(stream):
+    """SHA-256 hex digest of a seekable file object, read in chunks and rewound afterwards"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def parse_drive_time(value):
+    """Drive RFC 3339 timestamp -> naive UTC datetime"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+def format_file_size(size):
+    """Human-readable file size"""
+    if size is None:
+        return "Unknown"
+    size = int(size)
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.2f} KB"
+    return f"{size / (1024 * 1024):.2f} MB"
+
+def _upsert_document(cursor, drive_file, folder_id=None, client_id=None, case_id=None, document_type=None,
+                     sha256=None, uploaded_by_id=None):
+    """Insert or refresh a documents row from a Drive file resource (known client/case/uploader are kept)"""
+    cursor.execute("""
+        INSERT INTO documents
+        (drive_file_id, drive_folder_id, client_id, case_id, document_type, file_name, description, mime_type,
+         file_size, sha256, web_view_link, uploaded_by_id, drive_created_at, drive_modified_at, trashed)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            drive_folder_id = COALESCE(VALUES(drive_folder_id), drive_folder_id),
+            client_id = COALESCE(VALUES(client_id), client_id),
+            case_id = COALESCE(VALUES(case_id), case_id),
+            document_type = COALESCE(VALUES(document_type), document_type),
+            file_name = VALUES(file_name),
+            description = VALUES(description),
+            mime_type = VALUES(mime_type),
+            file_size = VALUES(file_size),
+            sha256 = COALESCE(VALUES(sha256), sha256),
+            web_view_link = VALUES(web_view_link),
+            uploaded_by_id = COALESCE(VALUES(uploaded_by_id), uploaded_by_id),
+            drive_modified_at = VALUES(drive_modified_at),
+            trashed = VALUES(trashed)
+    """, (
+        drive_file['id'],
+        folder_id or (drive_file.get('parents') or [None])[0],
+        client_id,
+        case_id,
+        document_type,
+        drive_file.get('name', 'Unknown'),
+        drive_file.get('description'),
+        drive_file.get('mimeType'),
+        int(drive_file['size']) if drive_file.get('size') else None,
+        sha256,
+        drive_file.get('webViewLink') or f"https://drive.google.com/file/d/{drive_file['id']}/view",
+        uploaded_by_id,
+        parse_drive_time(drive_file.get('createdTime')),
+        parse_drive_time(drive_file.get('modifiedTime')),
+        bool(drive_file.get('trashed'))
+    ))
+
+def record_uploaded_document(drive_file, folder_id, client_id, case_id=None, document_type='CLIENT_CASE_DOCUMENT',
+                             sha256=None, uploaded_by_id=None):
+    """Add a file just uploaded to Drive to the documents index"""
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            _upsert_document(cursor, drive_file, folder_id, client_id, case_id, document_type, sha256, uploaded_by_id)
+        connection.commit()
+    except Exception as e:
+        print(f"Error indexing uploaded document {drive_file.get('id')}: {e}")
+    finally:
+        connection.close()
+
+def ensure_drive_folder_indexed(service, folder_id, client_id, document_type):
+    """List a folder into the documents index once (files uploaded before the index existed)"""
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT indexed_at FROM drive_folders WHERE folder_id = %s LIMIT 1", (folder_id,))
+            row = cursor.fetchone()
+            if row and row.get('indexed_at'):
+                return
+            page_token = None
+            while True:
+                results = service.files().list(
+                    q=f"'{folder_id}' in parents and trashed=false and mimeType!='application/vnd.google-apps.folder'",
+                    spaces='drive',
+                    fields=f'nextPageToken, files({DRIVE_DOCUMENT_FIELDS})',
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+                for drive_file in results.get('files', []):
+                    _upsert_document(cursor, drive_file, folder_id, client_id, None, document_type)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+            # Tag the folder so the changes consumer can index files added to it directly in Drive
+            cursor.execute("""
+                UPDATE drive_folders SET indexed_at = UTC_TIMESTAMP(), client_id = %s, document_type = %s
+                WHERE folder_id = %s
+            """, (client_id, document_type, folder_id))
+        connection.commit()
+    finally:
+        connection.close()
+
+def get_drive_sync_token(name):
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT page_token FROM drive_sync_state WHERE name = %s", (name,))
+            row = cursor.fetchone()
+            return row['page_token'] if row else None
+    finally:
+        connection.close()
+
+def save_drive_sync_token(name, page_token):
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO drive_sync_state (name, page_token) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE page_token = VALUES(page_token)
+            """, (name, page_token))
+        connection.commit()
+    finally:
+        connection.close()
+
+def _apply_drive_changes(cursor, changes):
+    """
+    Apply one changes.list page to the documents index and folder cache with a couple of
+    IN queries per page. Files added to a tagged folder are indexed, files moved out of
+    every tagged folder are hidden, and renamed or deleted folders leave the folder cache.
+    """
+    file_ids = {change.get('fileId') for change in changes if change.get('fileId')}
+    parent_ids = {parent for change in changes for parent in ((change.get('file') or {}).get('parents') or [])}
+    if not file_ids:
+        return 0
+    
+    cursor.execute(
+        f"SELECT folder_id, folder_name, client_id, document_type FROM drive_folders WHERE folder_id IN ({', '.join(['%s'] * len(file_ids | parent_ids))})",
+        tuple(file_ids | parent_ids)
+    )
+    cached_folders = {}
+    for row in cursor.fetchall():
+        cached_folders.setdefault(row['folder_id'], row)
+    cursor.execute(
+        f"SELECT drive_file_id FROM documents WHERE drive_file_id IN ({', '.join(['%s'] * len(file_ids))})",
+        tuple(file_ids)
+    )
+    indexed_ids = {row['drive_file_id'] for row in cursor.fetchall()}
+    
+    updated = 0
+    for change in changes:
+        file_id = change.get('fileId')
+        drive_file = change.get('file')
+        removed = change.get('removed') or not drive_file or drive_file.get('trashed')
+        
+        if file_id in cached_folders:
+            # Cached folder deleted, trashed or renamed: its (parent, name) entry no longer holds
+            if removed or drive_file.get('name') != cached_folders[file_id]['folder_name']:
+                forget_drive_folder(file_id)
+            continue
+        if drive_file and drive_file.get('mimeType') == 'application/vnd.google-apps.folder':
+            continue
+        
+        if removed:
+            if file_id in indexed_ids:
+                cursor.execute("UPDATE documents SET trashed = TRUE WHERE drive_file_id = %s", (file_id,))
+                updated += 1
+            continue
+        
+        folder = next((cached_folders[p] for p in (drive_file.get('parents') or [])
+                       if cached_folders.get(p, {}).get('client_id')), None)
+        if folder:
+            _upsert_document(cursor, drive_file, folder['folder_id'], folder['client_id'], None, folder['document_type'])
+            updated += 1
+        elif file_id in indexed_ids:
+            # Moved out of every client folder we track
+            cursor.execute("UPDATE documents SET trashed = TRUE WHERE drive_file_id = %s", (file_id,))
+            updated += 1
+    return updated
+
+def sync_drive_document_changes(service):
+    """
+    Follow the Drive Changes API from the stored page token and apply each page to the local
+    index; the token is saved after every page so an interrupted run resumes where it stopped.
+    Returns how many documents rows were added or updated.
+    """
+    page_token = get_drive_sync_token('documents')
+    if not page_token:
+        # First run: start following changes from now (folders are indexed as they are first opened)
+        save_drive_sync_token('documents', service.changes().getStartPageToken().execute().get('startPageToken'))
+        return 0
+    updated = 0
+    connection = get_db_connection()
+    if not connection:
+        return 0
+    try:
+        while page_token:
+            response = service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=1000,
+                fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({DRIVE_DOCUMENT_FIELDS}))'
+            ).execute()
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                updated += _apply_drive_changes(cursor, response.get('changes', []))
+            connection.commit()
+            if response.get('newStartPageToken'):
+                save_drive_sync_token('documents', response['newStartPageToken'])
+                break
+            page_token = response.get('nextPageToken')
+            save_drive_sync_token('documents', page_token)
+    finally:
+        connection.close()
+    return updated
+
+def get_indexed_documents(client_id, document_type, search=None, sort='modified', order='desc'):
+    """Documents for a client and folder type from the local index, filtered and sorted in MySQL"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    sort_column = DOCUMENT_SORT_COLUMNS.get(sort, 'drive_modified_at')
+    direction = 'ASC' if str(order).lower() == 'asc' else 'DESC'
+    query = """
+        SELECT drive_file_id, case_id, file_name, description, mime_type, file_size, web_view_link,
+               uploaded_by_id, drive_created_at, drive_modified_at
+        FROM documents
+        WHERE client_id = %s AND document_type = %s AND trashed = FALSE
+    """
+    params = [client_id, document_type]
+    if search:
+        query += " AND file_name LIKE %s"
+        params.append(f"%{search}%")
+    query += f" ORDER BY {sort_column} {direction}, id DESC"
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+    finally:
+        connection.close()
+    return [{
+        'id': row['drive_file_id'],
+        'case_id': row['case_id'],
+        'name': row['file_name'],
+        'description': row['description'],
+        'created_time': row['drive_created_at'].strftime('%Y-%m-%d %H:%M:%S') if row['drive_created_at'] else '',
+        'modified_time': row['drive_modified_at'].strftime('%Y-%m-%d %H:%M:%S') if row['drive_modified_at'] else '',
+        'url': row['web_view_link'] or '',
+        'size': format_file_size(row['file_size']),
+        'mime_type': row['mime_type'] or ''
+    } for row in rows]
+
+# ==================== DRIVE CHANGES CONSUMER ====================
+
+DRIVE_CHANGES_POLL_SECONDS = int(os.getenv('DRIVE_CHANGES_POLL_SECONDS', '60'))
+
+@contextmanager
+def mysql_named_lock(name, timeout=0):
+    """Hold a MySQL GET_LOCK for the block; yields False if another process still holds it after timeout seconds"""
+    connection = get_db_connection()
+    if not connection:
+        yield False
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+            acquired = cursor.fetchone()[0] == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+    finally:
+        connection.close()
+
+def _drive_changes_consumer_loop():
+    while True:
+        try:
+            credentials = get_drive_credentials()
+            if credentials:
+                # One process per poll does the work; the others skip this round
+                with mysql_named_lock('drive_changes_consumer') as acquired:
+                    if acquired:
+                        service = build_drive_service(credentials)
+                        updated = sync_drive_document_changes(service)
+                        if updated:
+                            print(f"[OK] Applied {updated} Drive document changes")
+        except Exception as e:
+            print(f"Drive changes consumer error: {e}")
+        time.sleep(DRIVE_CHANGES_POLL_SECONDS)
+
+def start_drive_changes_consumer():
+    """Keep the documents index in step with edits made directly in Drive, on a daemon thread"""
+    start_background_thread('drive-changes-consumer', _drive_changes_consumer_loop)
+
+# ==================== DRIVE UPLOADS ====================
+
+# Resumable upload chunk size; Drive requires a multiple of 256 KB. Peak memory per upload is about one chunk.
+DRIVE_UPLOAD_CHUNK_SIZE = max(1, int(os.getenv('DRIVE_UPLOAD_CHUNK_MB', '8')) * 4) * 256 * 1024
+
+DRIVE_DOCUMENT_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png'
+}
+
+def document_mime_type(file_name):
+    """MIME type for an uploaded document, from its extension"""
+    file_ext = file_name.rsplit('.', 1)[1].lower() if '.' in file_name else ''
+    return DRIVE_DOCUMENT_MIME_TYPES.get(file_ext, 'application/octet-stream')
+
+def upload_stream_to_drive(service, stream, file_metadata, mime_type, fields=DRIVE_DOCUMENT_FIELDS):
+    """Upload a seekable file object to Drive in resumable chunks without reading it into memory.
+    
+    Werkzeug spools large request files to a temporary file, so passing FileStorage.stream here keeps
+    worker memory at one chunk regardless of document size.
+    """
+    stream.seek(0)
+    media = MediaIoBaseUpload(
+        stream,
+        mimetype=mime_type,
+        chunksize=DRIVE_UPLOAD_CHUNK_SIZE,
+        resumable=True
+    )
+    upload_request = service.files().create(body=file_metadata, media_body=media, fields=fields)
+    response = None
+    while response is None:
+        _, response = upload_request.next_chunk()
+    return response
+
+# ==================== ASYNC DRIVE UPLOADS ====================
+
+# Request handlers spool the file to local disk and insert a drive_upload_jobs row; a per-process
+# worker pool pushes it to Drive, retrying with backoff and resuming the Drive upload session
+DRIVE_UPLOAD_SPOOL_DIR = os.environ.get(
+    'DRIVE_UPLOAD_SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_spool')
+)
+DRIVE_UPLOAD_WORKERS = int(os.getenv('DRIVE_UPLOAD_WORKERS', '2'))
+DRIVE_UPLOAD_MAX_ATTEMPTS = int(os.getenv('DRIVE_UPLOAD_MAX_ATTEMPTS', '8'))
+DRIVE_UPLOAD_RETRY_BASE_SECONDS = 30
+DRIVE_UPLOAD_RETRY_MAX_SECONDS = 3600
+DRIVE_UPLOAD_POLL_SECONDS = 15
+# A job stuck in 'uploading' this long belongs to a worker that died mid-transfer
+DRIVE_UPLOAD_CLAIM_TIMEOUT_MINUTES = 30
+
+_drive_upload_wakeup = threading.Event()
+
+def get_case_client(case_id):
+    """Client of a case (None if the case or client is missing)"""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT cl.id as client_table_id, cl.full_name as client_full_name, cl.phone_number as client_phone
+                FROM cases c
+                LEFT JOIN clients cl ON c.client_id = cl.id
+                WHERE c.id = %s
+            """, (case_id,))
+            case_data = cursor.fetchone()
+    finally:
+        connection.close()
+    if not case_data or not case_data.get('client_table_id'):
+        return None
+    return case_data
+
+def get_case_client_folder_name(case_id):
+    """Drive folder name of the client a case belongs to (None if the case or client is missing)"""
+    case_data = get_case_client(case_id)
+    if not case_data:
+        return None
+    return get_user_folder_name(case_data.get('client_phone'), case_data.get('client_full_name'), 'client')
+
+def enqueue_drive_upload(case_id, file, file_name, description=None, created_by_id=None):
+    """Spool an uploaded file to local disk and queue it for Drive; returns the drive_upload_jobs id"""
+    os.makedirs(DRIVE_UPLOAD_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(DRIVE_UPLOAD_SPOOL_DIR, secrets.token_hex(16))
+    # FileStorage.save copies the (already spooled) request stream in chunks
+    file.save(spool_path)
+    connection = get_db_connection()
+    if not connection:
+        os.remove(spool_path)
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO drive_upload_jobs
+                (case_id, file_name, description, mime_type, spool_path, file_size, created_by_id, next_attempt_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP())
+            """, (case_id, file_name, description or None, document_mime_type(file_name), spool_path,
+                  os.path.getsize(spool_path), created_by_id))
+            job_id = cursor.lastrowid
+        connection.commit()
+    except Exception as e:
+        print(f"Error queueing Drive upload: {e}")
+        os.remove(spool_path)
+        return None
+    finally:
+        connection.close()
+    start_drive_upload_worker()
+    _drive_upload_wakeup.set()
+    return job_id
+
+def get_drive_upload_status(job_id):
+    """Progress of a queued Drive upload"""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT id, case_id, file_name, file_size, bytes_uploaded, status, attempts, last_error,
+                       next_attempt_at, drive_file_id, drive_file_url, created_by_id, created_at, completed_at
+                FROM drive_upload_jobs WHERE id = %s
+            """, (job_id,))
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+def _claim_drive_upload_jobs(cursor, claim_token):
+    """Atomically claim due upload jobs for this worker (safe with several Passenger processes polling)"""
+    cursor.execute("""
+        UPDATE drive_upload_jobs
+        SET status = 'uploading', claimed_by = %s, claimed_at = UTC_TIMESTAMP()
+        WHERE (status = 'queued' AND next_attempt_at <= UTC_TIMESTAMP())
+           OR (status = 'uploading' AND claimed_at < UTC_TIMESTAMP() - INTERVAL %s MINUTE)
+        ORDER BY next_attempt_at
+        LIMIT %s
+    """, (claim_token, DRIVE_UPLOAD_CLAIM_TIMEOUT_MINUTES, max(DRIVE_UPLOAD_WORKERS, 1)))
+    cursor.execute("""
+        SELECT * FROM drive_upload_jobs
+        WHERE claimed_by = %s AND status = 'uploading'
+        ORDER BY id
+    """, (claim_token,))
+    return cursor.fetchall()
+
+def _save_drive_upload_progress(job, resumable_uri, bytes_uploaded):
+    """Record upload progress; refreshing claimed_at keeps long uploads from being reclaimed by another worker"""
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE drive_upload_jobs
+                SET resumable_uri = %s, bytes_uploaded = %s, claimed_at = UTC_TIMESTAMP()
+                WHERE id = %s AND claimed_by = %s
+            """, (resumable_uri, bytes_uploaded, job['id'], job['claimed_by']))
+        connection.commit()
+    finally:
+        connection.close()
+
+def query_drive_upload_session(credentials, resumable_uri, total_size):
+    """
+    Ask Drive how much of a resumable upload session it holds (empty PUT with Content-Range: bytes */size).
+    Returns (bytes_received, file_resource): the resource is set once the upload already completed,
+    and bytes_received is None when the session has expired and the upload must start over.
+    """
+    http_session = google_requests.AuthorizedSession(credentials)
+    reply = http_session.put(resumable_uri, data=b'', headers={
+        'Content-Range': f'bytes */{total_size}',
+        'Content-Length': '0'
+    }, timeout=60)
+    if reply.status_code in (200, 201):
+        return total_size, reply.json()
+    if reply.status_code == 308:
+        # "Range: bytes=0-N" lists what Drive has; no header means nothing arrived yet
+        received = reply.headers.get('Range')
+        return (int(received.rsplit('-', 1)[1]) + 1 if received else 0), None
+    if reply.status_code in (404, 410):
+        return None, None
+    reply.raise_for_status()
+    raise RuntimeError(f"Unexpected upload status reply from Drive: HTTP {reply.status_code}")
+
+def _is_permanent_drive_upload_failure(error):
+    """Missing case/client, a vanished spool file and 400/403 (other than rate limits) won't succeed on retry"""
+    if isinstance(error, (LookupError, FileNotFoundError)):
+        return True
+    if isinstance(error, HttpError):
+        status = getattr(error.resp, 'status', None)
+        if status == 400:
+            return True
+        if status == 403:
+            reasons = {detail.get('reason') for detail in (error.error_details or []) if isinstance(detail, dict)}
+            return not reasons & {'rateLimitExceeded', 'userRateLimitExceeded'}
+    return False
+
+def _upload_drive_job(job):
+    """Push one spooled file to the case's CLIENT_CASE_DOCUMENT folder; returns the Drive file resource"""
+    credentials = get_drive_credentials()
+    if not credentials:
+        raise RuntimeError('Google Drive not connected')
+    main_folder_id = get_drive_main_folder_id()
+    if not main_folder_id:
+        raise RuntimeError('SHERIA CENTRIC folder has not been created')
+    case_data = get_case_client(job['case_id'])
+    if not case_data:
+        raise LookupError('Client information not found for this case')
+    client_folder_name = get_user_folder_name(case_data.get('client_phone'), case_data.get('client_full_name'), 'client')
+    
+    service = build_drive_service(credentials)
+    client_folder_id = get_or_create_folder(service, main_folder_id, client_folder_name)
+    case_doc_folder_id = get_or_create_folder(service, client_folder_id, 'CLIENT_CASE_DOCUMENT')
+    file_metadata = {'name': job['file_name'], 'parents': [case_doc_folder_id]}
+    if job.get('description'):
+        file_metadata['description'] = job['description']
+    
+    with open(job['spool_path'], 'rb') as stream:
+        media = MediaIoBaseUpload(
+            stream,
+            mimetype=job.get('mime_type') or 'application/octet-stream',
+            chunksize=DRIVE_UPLOAD_CHUNK_SIZE,
+            resumable=True
+        )
+        upload_request = service.files().create(body=file_metadata, media_body=media, fields=DRIVE_DOCUMENT_FIELDS)
+        try:
+            response = None
+            if job.get('resumable_uri'):
+                # Resume the session from an earlier attempt at the offset Drive reports
+                total_size = os.fstat(stream.fileno()).st_size
+                received, response = query_drive_upload_session(credentials, job['resumable_uri'], total_size)
+                if received is None:
+                    _save_drive_upload_progress(job, None, 0)
+                else:
+                    upload_request.resumable_uri = job['resumable_uri']
+                    upload_request.resumable_progress = received
+            while response is None:
+                status, response = upload_request.next_chunk(num_retries=3)
+                if status:
+                    _save_drive_upload_progress(job, upload_request.resumable_uri, status.resumable_progress)
+            record_uploaded_document(
+                response, case_doc_folder_id, case_data['client_table_id'], job['case_id'],
+                sha256=file_sha256(stream), uploaded_by_id=job.get('created_by_id')
+            )
+            return response
+        except HttpError as error:
+            if is_drive_not_found(error):
+                # Expired upload session or a folder deleted in Drive: start clean on the next attempt
+                forget_drive_folder(case_doc_folder_id)
+                forget_drive_folder(client_folder_id)
+                _save_drive_upload_progress(job, None, 0)
+            elif upload_request.resumable_uri:
+                _save_drive_upload_progress(job, upload_request.resumable_uri, upload_request.resumable_progress)
+            raise
+
+def _record_drive_upload_result(job, response=None, error=None):
+    """
+    Mark a job completed, or schedule its retry with exponential backoff (failed once attempts run out).
+    Nothing is written if another worker has since reclaimed the job.
+    """
+    connection = get_db_connection()
+    if not connection:
+        return
+    finished = False
+    try:
+        with connection.cursor() as cursor:
+            attempts = (job.get('attempts') or 0) + 1
+            if error is None:
+                file_id = response.get('id')
+                cursor.execute("""
+                    UPDATE drive_upload_jobs
+                    SET status = 'completed', attempts = %s, drive_file_id = %s, drive_file_url = %s,
+                        bytes_uploaded = file_size, resumable_uri = NULL, last_error = NULL,
+                        claimed_by = NULL, completed_at = UTC_TIMESTAMP()
+                    WHERE id = %s AND claimed_by = %s
+                """, (attempts, file_id, response.get('webViewLink', f"https://drive.google.com/file/d/{file_id}/view"),
+                      job['id'], job['claimed_by']))
+                finished = cursor.rowcount == 1
+            elif _is_permanent_drive_upload_failure(error) or attempts >= DRIVE_UPLOAD_MAX_ATTEMPTS:
+                cursor.execute("""
+                    UPDATE drive_upload_jobs
+                    SET status = 'failed', attempts = %s, last_error = %s, claimed_by = NULL
+                    WHERE id = %s AND claimed_by = %s
+                """, (attempts, str(error)[:2000], job['id'], job['claimed_by']))
+                finished = cursor.rowcount == 1
+            else:
+                delay = min(DRIVE_UPLOAD_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), DRIVE_UPLOAD_RETRY_MAX_SECONDS)
+                cursor.execute("""
+                    UPDATE drive_upload_jobs
+                    SET status = 'queued', attempts = %s, last_error = %s, claimed_by = NULL,
+                        next_attempt_at = UTC_TIMESTAMP() + INTERVAL %s SECOND
+                    WHERE id = %s AND claimed_by = %s
+                """, (attempts, str(error)[:2000], delay, job['id'], job['claimed_by']))
+        connection.commit()
+    finally:
+        connection.close()
+    if not finished:
+        return
+    # Completed or given up: the spooled copy is no longer needed
+    try:
+        os.remove(job['spool_path'])
+    except OSError:
+        pass
+
+def _run_drive_upload_job(job):
+    try:
+        response = _upload_drive_job(job)
+    except Exception as e:
+        print(f"Drive upload job {job['id']} failed: {e}")
+        _record_drive_upload_result(job, error=e)
+    else:
+        _record_drive_upload_result(job, response=response)
+
+def process_drive_uploads():
+    """Claim due upload jobs and push them to Drive in parallel; returns how many were attempted"""
+    connection = get_db_connection()
+    if not connection:
+        return 0
+    try:
+        claim_token = f"{os.getpid()}-{secrets.token_hex(8)}"
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            jobs = _claim_drive_upload_jobs(cursor, claim_token)
+        connection.commit()
+    finally:
+        connection.close()
+    if not jobs:
+        return 0
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        list(executor.map(_run_drive_upload_job, jobs))
+    return len(jobs)
+
+def _drive_upload_worker_loop():
+    while True:
+        try:
+            attempted = process_drive_uploads()
+        except Exception as e:
+            print(f"Drive upload worker error: {e}")
+            attempted = 0
+        if not attempted:
+            # Sleep until the next poll, or until enqueue_drive_upload() signals a new job
+            _drive_upload_wakeup.wait(DRIVE_UPLOAD_POLL_SECONDS)
+            _drive_upload_wakeup.clear()
+
+def start_drive_upload_worker():
+    """Push spooled uploads to Drive on a daemon thread (also picks up retries and jobs left by restarted processes)"""
+    start_background_thread('drive-upload-worker', _drive_upload_worker_loop)
+
+@app.route('/api/case/<int:case_id>/upload-document-async', methods=['POST'])
+def upload_case_document_async(case_id):
+    """Accept a case document into the upload spool and return a job ID; the Drive transfer runs in the background"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    if not get_drive_settings():
+        return jsonify({'success': False, 'error': 'Google Drive not connected. Please connect Google Drive in Documents Settings.'}), 400
+    if not get_drive_main_folder_id():
+        return jsonify({'success': False, 'error': 'SHERIA CENTRIC folder not found. Please create it in Documents Settings.'}), 400
+    if not get_case_client_folder_name(case_id):
+        return jsonify({'success': False, 'error': 'Case or client information not found'}), 404
+    
+    file = request.files.get('document_file')
+    if not file or file.filename == '':
+        return jsonify({'success': False, 'error': 'No file selected'}), 400
+    if not allowed_document_file(file.filename):
+        return jsonify({'success': False, 'error': 'Invalid file type. Allowed: PDF, DOC, DOCX, JPG, JPEG, PNG'}), 400
+    
+    job_id = enqueue_drive_upload(
+        case_id,
+        file,
+        secure_filename(file.filename),
+        request.form.get('description', '').strip(),
+        session.get('employee_id')
+    )
+    if not job_id:
+        return jsonify({'success': False, 'error': 'Could not queue the upload'}), 500
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('api_drive_upload_status', job_id=job_id)
+    }), 202
+
+@app.route('/api/uploads/<int:job_id>')
+def api_drive_upload_status(job_id):
+    """Status and progress of a background Drive upload"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    start_drive_upload_worker()
+    job = get_drive_upload_status(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    file_size = job.get('file_size') or 0
+    job['progress'] = 100 if job['status'] == 'completed' else (
+        int(job['bytes_uploaded'] * 100 / file_size) if file_size else 0
+    )
+    for key in ('next_attempt_at', 'created_at', 'completed_at'):
+        if job.get(key):
+            job[key] = job[key].isoformat()
+    return jsonify({'success': True, 'upload': job})
+
+@app.route('/api/case/<int:case_id>/upload-document', methods=['POST'])
 def upload_case_document(case_id):
     """Upload a document for a specific case to Google Drive"""
     if 'employee_id' not in session:
@@ -7823,35 +9426,6 @@ def upload_case_document(case_id):
     try:
         # Get Google Drive service
         service = get_google_drive_service()
-        if not service:
-            # Try loading from database
-            connection = get_db_connection()
-            if connection:
-                try:
-                    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                        cursor.execute("""
-                            SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                                   google_drive_scopes
-                            FROM company_settings 
-                            ORDER BY id DESC LIMIT 1
-                        """)
-                        settings = cursor.fetchone()
-                        if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                            scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                            session['google_drive_credentials'] = {
-                                'token': settings['google_drive_token'],
-                                'refresh_token': settings['google_drive_refresh_token'],
-                                'token_uri': settings.get('google_drive_token_uri'),
-                                'client_id': GOOGLE_CLIENT_ID,
-                                'client_secret': GOOGLE_CLIENT_SECRET,
-                                'scopes': scopes
-                            }
-                            service = get_google_drive_service()
-                except Exception as e:
-                    print(f"Error loading credentials: {e}")
-                finally:
-                    connection.close()
-        
         if not service:
             print("ERROR: Google Drive service not available")
             return jsonify({'success': False, 'error': 'Google Drive not connected. Please connect Google Drive in Documents Settings.'}), 400
@@ -7884,17 +9458,7 @@ def upload_case_document(case_id):
                     return jsonify({'success': False, 'error': 'Client information not found for this case'}), 404
                 
                 # Get main folder ID
-                main_folder_id = session.get('google_drive_main_folder_id')
-                if not main_folder_id:
-                    cursor.execute("""
-                        SELECT google_drive_main_folder_id
-                        FROM company_settings 
-                        ORDER BY id DESC LIMIT 1
-                    """)
-                    settings = cursor.fetchone()
-                    if settings and settings.get('google_drive_main_folder_id'):
-                        main_folder_id = settings['google_drive_main_folder_id']
-                        session['google_drive_main_folder_id'] = main_folder_id
+                main_folder_id = get_drive_main_folder_id()
                 
                 # If folder doesn't exist, create it automatically
                 if not main_folder_id:
@@ -7911,16 +9475,9 @@ def upload_case_document(case_id):
                         ).execute()
                         
                         main_folder_id = folder.get('id')
-                        session['google_drive_main_folder_id'] = main_folder_id
                         
                         # Save to database
-                        cursor.execute("""
-                            UPDATE company_settings 
-                            SET google_drive_main_folder_id = %s,
-                                updated_at = CURRENT_TIMESTAMP
-                            WHERE id = (SELECT id FROM (SELECT id FROM company_settings ORDER BY id DESC LIMIT 1) AS sub)
-                        """, (main_folder_id,))
-                        connection.commit()
+                        save_drive_main_folder_id(main_folder_id)
                         print(f"INFO: Created SHERIA CENTRIC folder with ID: {main_folder_id}")
                     except Exception as create_error:
                         print(f"ERROR: Failed to create SHERIA CENTRIC folder: {create_error}")
@@ -7960,22 +9517,9 @@ def upload_case_document(case_id):
                     print(f"ERROR: Invalid file type: {file.filename}")
                     return jsonify({'success': False, 'error': 'Invalid file type. Allowed: PDF, DOC, DOCX, JPG, JPEG, PNG'}), 400
                 
-                # Read file content
-                file_content = file.read()
                 file_name = secure_filename(file.filename)
                 description = request.form.get('description', '').strip()
-                
-                # Determine MIME type
-                file_ext = file_name.rsplit('.', 1)[1].lower() if '.' in file_name else ''
-                mime_types = {
-                    'pdf': 'application/pdf',
-                    'doc': 'application/msword',
-                    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                    'jpg': 'image/jpeg',
-                    'jpeg': 'image/jpeg',
-                    'png': 'image/png'
-                }
-                mime_type = mime_types.get(file_ext, 'application/octet-stream')
+                mime_type = document_mime_type(file_name)
                 
                 # Create file metadata
                 file_metadata = {
@@ -7985,21 +9529,28 @@ def upload_case_document(case_id):
                 if description:
                     file_metadata['description'] = description
                 
-                # Upload to Google Drive
-                media = MediaIoBaseUpload(
-                    BytesIO(file_content),
-                    mimetype=mime_type,
-                    resumable=True
-                )
+                sha256 = file_sha256(file.stream)
                 
-                uploaded_file = service.files().create(
-                    body=file_metadata,
-                    media_body=media,
-                    fields='id, name, webViewLink, webContentLink'
-                ).execute()
+                # Stream the spooled upload to Google Drive in resumable chunks
+                try:
+                    uploaded_file = upload_stream_to_drive(service, file.stream, file_metadata, mime_type)
+                except HttpError as upload_error:
+                    if not is_drive_not_found(upload_error):
+                        raise
+                    # A cached folder was deleted in Drive: drop it, resolve the folders again and retry once
+                    forget_drive_folder(case_doc_folder_id)
+                    forget_drive_folder(client_folder_id)
+                    client_folder_id = get_or_create_folder(service, main_folder_id, client_folder_name)
+                    case_doc_folder_id = get_or_create_folder(service, client_folder_id, 'CLIENT_CASE_DOCUMENT')
+                    file_metadata['parents'] = [case_doc_folder_id]
+                    uploaded_file = upload_stream_to_drive(service, file.stream, file_metadata, mime_type)
                 
                 file_id = uploaded_file.get('id')
                 file_url = uploaded_file.get('webViewLink', f"https://drive.google.com/file/d/{file_id}/view")
+                record_uploaded_document(
+                    uploaded_file, case_doc_folder_id, case_data['client_table_id'], case_id,
+                    sha256=sha256, uploaded_by_id=session.get('employee_id')
+                )
                 
                 return jsonify({
                     'success': True,
@@ -8031,6 +9582,157 @@ def upload_case_document(case_id):
             'error': f'Upload failed: {error_message}'
         }), status_code
 
+# ==================== BATCH CASE DOCUMENT UPLOAD ====================
+
+# Files in one batch are sent to Drive in parallel, each thread on its own Drive client
+DRIVE_BATCH_UPLOAD_CONCURRENCY = int(os.getenv('DRIVE_BATCH_UPLOAD_CONCURRENCY', '4'))
+DRIVE_BATCH_MAX_FILES = int(os.getenv('DRIVE_BATCH_MAX_FILES', '50'))
+# Limit on the unpacked size of a whole batch, so a small archive can't fill the disk
+DRIVE_BATCH_MAX_UNPACKED_BYTES = int(os.getenv('DRIVE_BATCH_MAX_UNPACKED_MB', '500')) * 1024 * 1024
+
+def collect_batch_upload_files(files, entries):
+    """
+    Expand the uploaded files (zip archives are unpacked) into (name, stream, error) entries,
+    appended to entries as they are opened so the caller can close every stream even if this raises.
+    Zip members are copied to spooled temporary files. Raises ValueError when the batch exceeds
+    DRIVE_BATCH_MAX_FILES or DRIVE_BATCH_MAX_UNPACKED_BYTES; archives are checked from their
+    directory before anything is extracted.
+    """
+    file_count = 0
+    total_bytes = 0
+    for file in files:
+        if not file or not file.filename:
+            continue
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = []
+                    for member in archive.infolist():
+                        if member.is_dir():
+                            continue
+                        file_count += 1
+                        total_bytes += member.file_size
+                        if file_count > DRIVE_BATCH_MAX_FILES:
+                            raise ValueError(f'Too many files (maximum {DRIVE_BATCH_MAX_FILES} per batch)')
+                        if total_bytes > DRIVE_BATCH_MAX_UNPACKED_BYTES:
+                            raise ValueError('Batch is too large once unpacked')
+                        members.append(member)
+                    for member in members:
+                        member_name = secure_filename(os.path.basename(member.filename))
+                        if not member_name or not allowed_document_file(member_name):
+                            entries.append((member.filename, None, 'Invalid file type'))
+                            continue
+                        stream = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+                        try:
+                            with archive.open(member) as source:
+                                shutil.copyfileobj(source, stream)
+                        except (RuntimeError, NotImplementedError, zlib.error, zipfile.BadZipFile, EOFError) as e:
+                            # Encrypted member, unsupported compression or corrupt data
+                            stream.close()
+                            entries.append((member.filename, None, f'Could not extract file: {e}'))
+                            continue
+                        entries.append((member_name, stream, None))
+            except zipfile.BadZipFile:
+                entries.append((file.filename, None, 'Not a valid zip archive'))
+            continue
+        file_count += 1
+        if file_count > DRIVE_BATCH_MAX_FILES:
+            raise ValueError(f'Too many files (maximum {DRIVE_BATCH_MAX_FILES} per batch)')
+        if not allowed_document_file(file.filename):
+            entries.append((file.filename, None, 'Invalid file type'))
+            continue
+        entries.append((secure_filename(file.filename), file.stream, None))
+
+def _upload_batch_file(credentials, folder_id, file_name, stream, description, client_id, case_id, uploaded_by_id):
+    """Upload one file of a batch; runs on a pool thread, so it builds that thread's Drive client"""
+    file_metadata = {'name': file_name, 'parents': [folder_id]}
+    if description:
+        file_metadata['description'] = description
+    try:
+        sha256 = file_sha256(stream)
+        uploaded_file = upload_stream_to_drive(
+            build_drive_service(credentials), stream, file_metadata, document_mime_type(file_name)
+        )
+        record_uploaded_document(uploaded_file, folder_id, client_id, case_id, sha256=sha256, uploaded_by_id=uploaded_by_id)
+    except HttpError as error:
+        error_details = error.error_details[0] if error.error_details else {}
+        return {'file_name': file_name, 'success': False,
+                'error': f"Google Drive API error: {error_details.get('reason', str(error))}"}
+    except Exception as e:
+        return {'file_name': file_name, 'success': False, 'error': str(e)}
+    file_id = uploaded_file.get('id')
+    return {
+        'file_name': file_name,
+        'success': True,
+        'file_id': file_id,
+        'file_url': uploaded_file.get('webViewLink', f"https://drive.google.com/file/d/{file_id}/view")
+    }
+
+@app.route('/api/case/<int:case_id>/upload-documents', methods=['POST'])
+def upload_case_documents_batch(case_id):
+    """Upload several documents (or a zip of them) for a case; returns a result per file"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    # Credentials, case and folders are resolved once for the whole batch
+    credentials = get_drive_credentials()
+    if not credentials:
+        return jsonify({'success': False, 'error': 'Google Drive not connected. Please connect Google Drive in Documents Settings.'}), 400
+    main_folder_id = get_drive_main_folder_id()
+    if not main_folder_id:
+        return jsonify({'success': False, 'error': 'SHERIA CENTRIC folder not found. Please create it in Documents Settings.'}), 400
+    case_data = get_case_client(case_id)
+    if not case_data:
+        return jsonify({'success': False, 'error': 'Case or client information not found'}), 404
+    client_folder_name = get_user_folder_name(case_data.get('client_phone'), case_data.get('client_full_name'), 'client')
+    
+    entries = []
+    try:
+        try:
+            collect_batch_upload_files(request.files.getlist('document_files'), entries)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        if not entries:
+            return jsonify({'success': False, 'error': 'No files provided'}), 400
+        
+        service = build_drive_service(credentials)
+        client_folder_id = get_or_create_folder(service, main_folder_id, client_folder_name)
+        case_doc_folder_id = get_or_create_folder(service, client_folder_id, 'CLIENT_CASE_DOCUMENT')
+        description = request.form.get('description', '').strip()
+        
+        results = [None] * len(entries)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(DRIVE_BATCH_UPLOAD_CONCURRENCY, len(entries)))) as executor:
+            for index, (file_name, stream, error) in enumerate(entries):
+                if error:
+                    results[index] = {'file_name': file_name, 'success': False, 'error': error}
+                    continue
+                futures[executor.submit(
+                    _upload_batch_file, credentials, case_doc_folder_id, file_name, stream, description,
+                    case_data['client_table_id'], case_id, session.get('employee_id')
+                )] = index
+            for future, index in futures.items():
+                results[index] = future.result()
+        
+        uploaded = sum(1 for result in results if result['success'])
+        return jsonify({
+            'success': uploaded == len(results),
+            'uploaded': uploaded,
+            'failed': len(results) - uploaded,
+            'results': results
+        })
+    except HttpError as error:
+        print(f"Google Drive API error: {error}")
+        error_details = error.error_details[0] if error.error_details else {}
+        return jsonify({'success': False, 'error': f"Google Drive API error: {error_details.get('reason', str(error))}"}), 500
+    except Exception as e:
+        print(f"Error uploading documents: {e}")
+        return jsonify({'success': False, 'error': f'Upload failed: {e}'}), 500
+    finally:
+        for _, stream, _ in entries:
+            if stream is not None:
+                stream.close()
+
 @app.route('/documents_settings')
 def documents_settings():
     """Documents Settings page"""
@@ -8046,43 +9748,6 @@ def documents_settings():
         flash('You do not have permission to access this page', 'error')
         return redirect(url_for('dashboard'))
     
-    # Load Google Drive credentials from database into session if not already loaded
-    if 'google_drive_credentials' not in session:
-        connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT google_drive_token, google_drive_refresh_token, google_drive_token_uri,
-                               google_drive_scopes, google_drive_account_email, google_drive_account_name,
-                               google_drive_account_picture, google_drive_main_folder_id
-                        FROM company_settings 
-                        ORDER BY id DESC LIMIT 1
-                    """)
-                    settings = cursor.fetchone()
-                    
-                    if settings and settings.get('google_drive_token') and settings.get('google_drive_refresh_token'):
-                        scopes = json.loads(settings['google_drive_scopes']) if settings.get('google_drive_scopes') else []
-                        session['google_drive_credentials'] = {
-                            'token': settings['google_drive_token'],
-                            'refresh_token': settings['google_drive_refresh_token'],
-                            'token_uri': settings.get('google_drive_token_uri'),
-                            'client_id': GOOGLE_CLIENT_ID,
-                            'client_secret': GOOGLE_CLIENT_SECRET,
-                            'scopes': scopes
-                        }
-                        session['google_drive_account'] = {
-                            'email': settings.get('google_drive_account_email'),
-                            'name': settings.get('google_drive_account_name'),
-                            'picture': settings.get('google_drive_account_picture')
-                        }
-                        if settings.get('google_drive_main_folder_id'):
-                            session['google_drive_main_folder_id'] = settings['google_drive_main_folder_id']
-            except Exception as e:
-                print(f"Error loading Google Drive credentials: {e}")
-            finally:
-                connection.close()
-    
     company_settings = get_company_settings()
     if not company_settings:
         company_settings = {'company_name': 'BAUNI LAW GROUP'}
@@ -8285,6 +9950,29 @@ def view_client_document_type(client_id, document_type):
             }
             document_type_name = document_type_names.get(document_type, document_type)
             
+            # Index the client's folder on first visit; later Drive edits arrive through the changes consumer
+            service = get_google_drive_service()
+            main_folder_id = get_drive_main_folder_id()
+            if service and main_folder_id:
+                try:
+                    client_folder_id = get_or_create_folder(
+                        service, main_folder_id,
+                        get_user_folder_name(client.get('phone_number'), client.get('full_name'), 'client')
+                    )
+                    document_folder_id = get_or_create_folder(service, client_folder_id, document_type)
+                    ensure_drive_folder_indexed(service, document_folder_id, client_id, document_type)
+                except Exception as e:
+                    print(f"Error refreshing document index for client {client_id}: {e}")
+            
+            # Document list comes from the local index, filtered and sorted in MySQL
+            documents = get_indexed_documents(
+                client_id,
+                document_type,
+                search=request.args.get('q', '').strip(),
+                sort=request.args.get('sort', 'modified'),
+                order=request.args.get('order', 'desc')
+            )
+            
             company_settings = get_company_settings()
             if not company_settings:
                 company_settings = {'company_name': 'BAUNI LAW GROUP'}
@@ -8294,6 +9982,7 @@ def view_client_document_type(client_id, document_type):
                                  client_id=client_id,
                                  document_type=document_type,
                                  document_type_name=document_type_name,
+                                 documents=documents,
                                  company_settings=company_settings)
     except Exception as e:
         print(f"Error fetching client documents: {e}")
@@ -8411,7 +10100,7 @@ def registration_documents():
                          company_settings=company_settings,
                          employees=employees_with_docs)
 
-@app.route('/download_document/<document_type>/<filename>')
+@app.route('/download_document/<document_type>/<path:filename>')
 def download_document(document_type, filename):
     """Download employee document"""
     if 'employee_id' not in session:
@@ -8426,14 +10115,25 @@ def download_document(document_type, filename):
         flash('You do not have permission to access this page', 'error')
         return redirect(url_for('dashboard'))
     
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    stored_path = resolve_upload_path(filename)
     
-    if os.path.exists(filepath):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+    if stored_path:
+        return storage_response(stored_path, as_attachment=True)
     else:
         flash('Document not found', 'error')
         return redirect(url_for('document_management'))
 
+@app.route('/uploads/<path:stored_path>')
+def uploaded_file(stored_path):
+    """Serve a profile picture or uploaded document to signed-in employees and clients"""
+    if 'employee_id' not in session and 'client_id' not in session:
+        return redirect(url_for('login'))
+    
+    resolved_path = resolve_upload_path(stored_path)
+    if not resolved_path:
+        return 'File not found', 404
+    return storage_response(resolved_path)
+
 @app.route('/download_employee_contract')
 def download_employee_contract():
     """Allow employees to download their own employment contract"""
@@ -8461,11 +10161,10 @@ def download_employee_contract():
                 flash('No contract file found. Please upload your contract first.', 'error')
                 return redirect(url_for('onboarding'))
             
-            filename = employee['employment_contract']
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            stored_path = resolve_upload_path(employee['employment_contract'])
             
-            if os.path.exists(filepath):
-                return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+            if stored_path:
+                return storage_response(stored_path, as_attachment=True)
             else:
                 flash('Contract file not found on server', 'error')
                 return redirect(url_for('onboarding'))
@@ -8837,77 +10536,24 @@ def communication_messaging():
         email_accounts = get_email_accounts_from_db()
         email_settings = get_email_settings()
         
-        # Also fetch from cPanel if settings are configured
-        cpanel_emails = []
-        if email_settings:
-            try:
-                result = list_email_accounts(
-                    email_settings['cpanel_api_token'],
-                    email_settings['cpanel_domain'],
-                    email_settings['cpanel_user'],
-                    email_settings['cpanel_api_port']
-                )
-                if result.get('status') == 1 and 'data' in result:
-                    for account in result['data']:
-                        email_addr = account.get('email', '')
-                        if email_addr:
-                            # Check if already in email_accounts
-                            if not any(ea.get('email_address') == email_addr for ea in email_accounts):
-                                cpanel_emails.append({
-                                    'email_address': email_addr,
-                                    'is_cpanel': True,
-                                    'disk_used': account.get('humandiskused', '0 MB'),
-                                    'disk_quota': account.get('humandiskquota', '250 MB')
-                                })
-            except Exception as e:
-                print(f"Error fetching cPanel emails: {e}")
-        
-        # Combine all emails
-        all_email_accounts = email_accounts + cpanel_emails
+        # Also include cPanel-only mailboxes (cached listing, refreshed in the background)
+        all_email_accounts = merge_cpanel_email_accounts(email_accounts, get_cpanel_email_accounts(email_settings))
         
-        # Fetch all emails from all email accounts
+        # Sync every mailbox into the local cache in parallel (bounded by a deadline),
+        # then render the first page of the firm-wide inbox from the cache
+        has_more_emails = False
         if email_settings:
-            for email_account in all_email_accounts:
-                email_address = email_account.get('email_address') or email_account.get('email', '')
-                if not email_address:
-                    continue
-                
-                # Get password for this email account
-                password = email_settings.get('main_email_password', '')
-                if email_account.get('email_password'):
-                    password = email_account['email_password']
-                
-                if password:
-                    try:
-                        # Fetch emails from this account
-                        emails = fetch_emails_from_imap(
-                            email_address,
-                            password,
-                            email_settings.get('imap_host', 'mail.baunilawgroup.com'),
-                            int(email_settings.get('imap_port', 993)),
-                            bool(email_settings.get('imap_use_ssl', True)),
-                            limit=200  # Fetch more emails per account
-                        )
-                        
-                        # Add email address to each email for identification
-                        for email in emails:
-                            email['account_email'] = email_address
-                        
-                        all_emails.extend(emails)
-                    except Exception as e:
-                        print(f"Error fetching emails for {email_address}: {e}")
-                        import traceback
-                        print(traceback.format_exc())
-        
-        # Sort all emails by date (newest first)
-        all_emails.sort(key=lambda x: x.get('date', ''), reverse=True)
+            mailboxes = get_firm_mailboxes(email_settings, all_email_accounts)
+            sync_all_mailboxes(mailboxes, email_settings)
+            all_emails, has_more_emails = get_latest_communications([m[0] for m in mailboxes])
         
         return render_template('communication_messaging.html', 
                              company_settings=company_settings,
                              communication_type=communication_type,
                              email_accounts=all_email_accounts,
                              employees=employees,
-                             all_emails=all_emails)
+                             all_emails=all_emails,
+                             has_more_emails=has_more_emails)
     elif communication_type == 'webapp':
         # Fetch client messages
         connection = get_db_connection()
@@ -8984,33 +10630,8 @@ def employee_communication_settings():
     email_accounts = get_email_accounts_from_db()
     email_settings = get_email_settings()
     
-    # Also fetch from cPanel if settings are configured
-    cpanel_emails = []
-    if email_settings:
-        try:
-            result = list_email_accounts(
-                email_settings['cpanel_api_token'],
-                email_settings['cpanel_domain'],
-                email_settings['cpanel_user'],
-                email_settings['cpanel_api_port']
-            )
-            if result.get('status') == 1 and 'data' in result:
-                for account in result['data']:
-                    email_addr = account.get('email', '')
-                    if email_addr:
-                        # Check if already in email_accounts
-                        if not any(ea.get('email_address') == email_addr for ea in email_accounts):
-                            cpanel_emails.append({
-                                'email_address': email_addr,
-                                'is_cpanel': True,
-                                'disk_used': account.get('humandiskused', '0 MB'),
-                                'disk_quota': account.get('humandiskquota', '250 MB')
-                            })
-        except Exception as e:
-            print(f"Error fetching cPanel emails: {e}")
-    
-    # Combine all emails
-    all_emails = email_accounts + cpanel_emails
+    # Also include cPanel-only mailboxes (cached listing, refreshed in the background)
+    all_emails = merge_cpanel_email_accounts(email_accounts, get_cpanel_email_accounts(email_settings))
     
     company_settings = get_company_settings()
     if not company_settings:
@@ -9093,172 +10714,330 @@ def save_email_settings(cpanel_user, cpanel_domain, cpanel_api_token, cpanel_api
         if connection:
             connection.close()
 
+# ==================== BACKGROUND THREADS ====================
+
+# name -> (pid, thread); keyed by pid so workers are restarted in each forked Passenger process
+_background_threads = {}
+_background_threads_lock = threading.Lock()
+
+def start_background_thread(name, target, *args):
+    """Start a named daemon thread once per process (no-op if it is already running)"""
+    pid = os.getpid()
+    with _background_threads_lock:
+        existing = _background_threads.get(name)
+        if existing and existing[0] == pid and existing[1].is_alive():
+            return existing[1]
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        _background_threads[name] = (pid, thread)
+        return thread
+
+# Idle timeouts enforced by the background connection reaper (no housekeeping in the request path)
+CONNECTION_REAPER_INTERVAL_SECONDS = int(os.environ.get('CONNECTION_REAPER_INTERVAL_SECONDS', '60'))
+CPANEL_SESSION_MAX_IDLE_SECONDS = int(os.environ.get('CPANEL_SESSION_MAX_IDLE_SECONDS', '1800'))
+
 # Connection pool for persistent connections
 _cpanel_sessions = {}
-_email_connections = {}
+_cpanel_sessions_lock = threading.Lock()
 
 def get_cpanel_session(api_token, domain, user, api_port):
     """Get or create a persistent cPanel API session"""
     session_key = f"{user}@{domain}:{api_port}"
+    start_connection_reaper()
     
-    if session_key not in _cpanel_sessions:
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    with _cpanel_sessions_lock:
+        if session_key not in _cpanel_sessions:
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            
+            session = requests.Session()
+            session.headers.update({
+                'Authorization': f'cpanel {user}:{api_token}'
+            })
+            session.verify = False
+            _cpanel_sessions[session_key] = {
+                'session': session,
+                'last_used': datetime.now(),
+                'api_token': api_token
+            }
         
-        session = requests.Session()
-        session.headers.update({
-            'Authorization': f'cpanel {user}:{api_token}'
-        })
-        session.verify = False
-        _cpanel_sessions[session_key] = {
-            'session': session,
-            'last_used': datetime.now(),
-            'api_token': api_token
-        }
-    
-    # Update last used time
-    _cpanel_sessions[session_key]['last_used'] = datetime.now()
-    return _cpanel_sessions[session_key]['session']
+        # Update last used time
+        _cpanel_sessions[session_key]['last_used'] = datetime.now()
+        return _cpanel_sessions[session_key]['session']
 
 def close_cpanel_session(api_token, domain, user, api_port):
     """Close a cPanel API session"""
     session_key = f"{user}@{domain}:{api_port}"
-    if session_key in _cpanel_sessions:
-        _cpanel_sessions[session_key]['session'].close()
-        del _cpanel_sessions[session_key]
+    with _cpanel_sessions_lock:
+        session_data = _cpanel_sessions.pop(session_key, None)
+    if session_data:
+        session_data['session'].close()
 
-def get_email_connection(email_address, password, smtp_host, smtp_port, use_tls, connection_type='smtp'):
-    """Get or create a persistent email connection (SMTP or IMAP)"""
-    # Ensure all parameters are the correct type
-    email_address = str(email_address) if email_address else ''
-    password = str(password) if password else ''
-    smtp_host = str(smtp_host) if smtp_host else ''
-    smtp_port = int(smtp_port) if smtp_port else (587 if connection_type == 'smtp' else 993)
-    use_tls = bool(use_tls) if use_tls is not None else True
-    
-    conn_key = f"{connection_type}:{email_address}@{smtp_host}:{smtp_port}"
-    
-    if conn_key not in _email_connections:
-        if connection_type == 'smtp':
-            if use_tls:
-                server = smtplib.SMTP(smtp_host, smtp_port)
-                server.starttls()
-            else:
-                server = smtplib.SMTP_SSL(smtp_host, smtp_port)
-            server.login(email_address, password)
-            _email_connections[conn_key] = {
-                'connection': server,
-                'type': 'smtp',
-                'last_used': datetime.now()
-            }
-        elif connection_type == 'imap':
-            if use_tls:
-                mail = imaplib.IMAP4_SSL(smtp_host, smtp_port)
-            else:
-                mail = imaplib.IMAP4(smtp_host, smtp_port)
-            mail.login(email_address, password)
-            _email_connections[conn_key] = {
-                'connection': mail,
-                'type': 'imap',
-                'last_used': datetime.now()
-            }
+def reap_idle_cpanel_sessions(max_idle_seconds=CPANEL_SESSION_MAX_IDLE_SECONDS):
+    """Close cPanel API sessions idle for longer than max_idle_seconds; returns how many were closed"""
+    now = datetime.now()
+    with _cpanel_sessions_lock:
+        expired_keys = [
+            key for key, session_data in _cpanel_sessions.items()
+            if (now - session_data['last_used']).total_seconds() > max_idle_seconds
+        ]
+        expired = [_cpanel_sessions.pop(key) for key in expired_keys]
+    for session_data in expired:
+        try:
+            session_data['session'].close()
+        except Exception:
+            pass
+    return len(expired)
+
+# Email connection pool settings
+EMAIL_POOL_MAX_PER_HOST = int(os.environ.get('EMAIL_POOL_MAX_PER_HOST', '4'))
+EMAIL_POOL_CHECKOUT_TIMEOUT = int(os.environ.get('EMAIL_POOL_CHECKOUT_TIMEOUT', '30'))
+EMAIL_SOCKET_TIMEOUT = int(os.environ.get('EMAIL_SOCKET_TIMEOUT', '30'))
+# Connections used more recently than this are handed out without a NOOP/RSET round trip
+EMAIL_POOL_HEALTHCHECK_AFTER_SECONDS = 10
+EMAIL_POOL_MAX_IDLE_SECONDS = int(os.environ.get('EMAIL_POOL_MAX_IDLE_SECONDS', '1800'))
+
+# Idle connections per account key; open connection counts per (type, host, port)
+_email_pool_lock = threading.Condition()
+_email_pool_idle = {}
+_email_pool_open_per_host = {}
+
+class EmailPoolExhausted(TimeoutError):
+    """No pooled connection slot for the host became free within EMAIL_POOL_CHECKOUT_TIMEOUT"""
+
+def _email_pool_keys(email_address, host, port, connection_type):
+    return f"{connection_type}:{email_address}@{host}:{port}", f"{connection_type}:{host}:{port}"
+
+def _open_email_connection(email_address, password, host, port, use_tls, connection_type):
+    """Open and authenticate a new SMTP or IMAP connection"""
+    if connection_type == 'smtp':
+        if use_tls:
+            server = smtplib.SMTP(host, port, timeout=EMAIL_SOCKET_TIMEOUT)
+            server.starttls()
+        else:
+            server = smtplib.SMTP_SSL(host, port, timeout=EMAIL_SOCKET_TIMEOUT)
+        server.login(email_address, password)
+        return server
+    if use_tls:
+        mail = imaplib.IMAP4_SSL(host, port, timeout=EMAIL_SOCKET_TIMEOUT)
     else:
-        # Update last used time
-        _email_connections[conn_key]['last_used'] = datetime.now()
-        # For IMAP connections, verify the connection is still alive
-        if connection_type == 'imap':
-            conn = _email_connections[conn_key]['connection']
+        mail = imaplib.IMAP4(host, port, timeout=EMAIL_SOCKET_TIMEOUT)
+    mail.login(email_address, password)
+    return mail
+
+def _close_email_entry(entry):
+    """Best-effort QUIT/LOGOUT of a pooled connection"""
+    conn = entry['connection']
+    try:
+        if entry['type'] == 'smtp':
+            conn.quit()
+        else:
             try:
-                # Test connection with NOOP command
-                conn.noop()
-            except Exception:
-                # Connection is dead, recreate it
-                try:
-                    try:
-                        conn.close()
-                    except:
-                        pass
-                    try:
-                        conn.logout()
-                    except:
-                        pass
-                except:
-                    pass
-                # Remove dead connection and create new one
-                del _email_connections[conn_key]
-                if use_tls:
-                    mail = imaplib.IMAP4_SSL(smtp_host, smtp_port)
-                else:
-                    mail = imaplib.IMAP4(smtp_host, smtp_port)
-                mail.login(email_address, password)
-                _email_connections[conn_key] = {
-                    'connection': mail,
-                    'type': 'imap',
-                    'last_used': datetime.now()
-                }
-    
-    return _email_connections[conn_key]['connection']
+                conn.close()  # Close any selected mailbox first
+            except:
+                pass
+            conn.logout()
+    except Exception:
+        pass  # Connection cleanup should be best effort
 
-def close_email_connection(email_address, smtp_host, smtp_port, connection_type='smtp'):
-    """Close an email connection"""
-    conn_key = f"{connection_type}:{email_address}@{smtp_host}:{smtp_port}"
-    if conn_key in _email_connections:
-        conn = _email_connections[conn_key]['connection']
-        conn_type = _email_connections[conn_key]['type']
+def _email_entry_is_healthy(entry):
+    """NOOP for IMAP, RSET for SMTP (also clears any half-finished transaction)"""
+    if (datetime.now() - entry['last_used']).total_seconds() < EMAIL_POOL_HEALTHCHECK_AFTER_SECONDS:
+        return True
+    try:
+        if entry['type'] == 'smtp':
+            code, _ = entry['connection'].rset()
+            return code == 250
+        status, _ = entry['connection'].noop()
+        return status == 'OK'
+    except Exception:
+        return False
+
+def checkout_email_connection(email_address, password, host, port, use_tls, connection_type='smtp'):
+    """
+    Take an exclusive connection for one account out of the pool.
+    
+    A checked-out connection is never shared, so two threads can no longer interleave
+    protocol commands on one session. At most EMAIL_POOL_MAX_PER_HOST connections are
+    open per mail host; callers wait (up to EMAIL_POOL_CHECKOUT_TIMEOUT) for a free slot,
+    and idle connections of other accounts on the same host are closed to make room.
+    Always pair with checkin_email_connection(), or use email_connection().
+    """
+    email_address = str(email_address) if email_address else ''
+    password = str(password) if password else ''
+    host = str(host) if host else ''
+    port = int(port) if port else (587 if connection_type == 'smtp' else 993)
+    use_tls = bool(use_tls) if use_tls is not None else True
+    key, host_key = _email_pool_keys(email_address, host, port, connection_type)
+    start_connection_reaper()
+    
+    deadline = datetime.now().timestamp() + EMAIL_POOL_CHECKOUT_TIMEOUT
+    while True:
+        entry = None
+        victim = None
+        with _email_pool_lock:
+            while True:
+                idle = _email_pool_idle.get(key)
+                if idle:
+                    entry = idle.pop()
+                    break
+                if _email_pool_open_per_host.get(host_key, 0) < EMAIL_POOL_MAX_PER_HOST:
+                    _email_pool_open_per_host[host_key] = _email_pool_open_per_host.get(host_key, 0) + 1
+                    break
+                # Host is at capacity: reuse the slot of an idle connection belonging to another account
+                for other_key, other_idle in _email_pool_idle.items():
+                    if other_idle and other_idle[0]['host_key'] == host_key:
+                        victim = other_idle.pop(0)
+                        break
+                if victim:
+                    break
+                remaining = deadline - datetime.now().timestamp()
+                if remaining <= 0:
+                    raise EmailPoolExhausted(f"No free {connection_type} connection to {host}:{port}")
+                _email_pool_lock.wait(remaining)
+        
+        if victim:
+            _close_email_entry(victim)
+        if entry is not None:
+            if _email_entry_is_healthy(entry):
+                entry['last_used'] = datetime.now()
+                return entry
+            # Dead connection: drop it but keep its slot for the replacement
+            _close_email_entry(entry)
         
         try:
-            if conn_type == 'smtp':
-                conn.quit()
-            elif conn_type == 'imap':
-                try:
-                    # Try to close any selected mailbox first
-                    conn.close()
-                except:
-                    pass  # Ignore errors when closing mailbox
-                try:
-                    conn.logout()
-                except:
-                    pass  # Ignore errors when logging out
-        except Exception as e:
-            # Log but don't raise - connection cleanup should be best effort
-            print(f"Error closing {connection_type} connection: {e}")
-        
-        del _email_connections[conn_key]
+            conn = _open_email_connection(email_address, password, host, port, use_tls, connection_type)
+        except Exception:
+            with _email_pool_lock:
+                _email_pool_open_per_host[host_key] -= 1
+                _email_pool_lock.notify_all()
+            raise
+        now = datetime.now()
+        return {
+            'connection': conn,
+            'type': connection_type,
+            'key': key,
+            'host_key': host_key,
+            'created_at': now,
+            'last_used': now
+        }
 
-def cleanup_idle_connections(max_idle_minutes=30):
-    """Clean up idle connections"""
-    from datetime import timedelta
+def checkin_email_connection(entry, discard=False):
+    """Return a connection to the pool, or close it (discard=True) after a protocol or socket error"""
+    if discard:
+        _close_email_entry(entry)
+        with _email_pool_lock:
+            _email_pool_open_per_host[entry['host_key']] -= 1
+            _email_pool_lock.notify_all()
+        return
+    entry['last_used'] = datetime.now()
+    with _email_pool_lock:
+        _email_pool_idle.setdefault(entry['key'], []).append(entry)
+        _email_pool_lock.notify_all()
+
+@contextmanager
+def email_connection(email_address, password, host, port, use_tls, connection_type='smtp'):
+    """with email_connection(...) as conn: exclusive pooled SMTP/IMAP connection, discarded on error"""
+    entry = checkout_email_connection(email_address, password, host, port, use_tls, connection_type)
+    try:
+        yield entry['connection']
+    except BaseException:
+        # Protocol/socket errors (smtplib.SMTPException, imaplib.IMAP4.error, OSError) and anything
+        # unexpected leave the session in an unknown state: don't hand it to someone else
+        checkin_email_connection(entry, discard=True)
+        raise
+    else:
+        checkin_email_connection(entry)
+
+def close_email_connection(email_address, smtp_host, smtp_port, connection_type='smtp'):
+    """Close all idle pooled connections for one account (e.g. after its password changed)"""
+    smtp_port = int(smtp_port) if smtp_port else (587 if connection_type == 'smtp' else 993)
+    key, host_key = _email_pool_keys(email_address, smtp_host, smtp_port, connection_type)
+    with _email_pool_lock:
+        entries = _email_pool_idle.pop(key, [])
+        if entries:
+            _email_pool_open_per_host[host_key] -= len(entries)
+            _email_pool_lock.notify_all()
+    for entry in entries:
+        _close_email_entry(entry)
+
+def reap_idle_email_connections(max_idle_seconds=EMAIL_POOL_MAX_IDLE_SECONDS):
+    """Close pooled connections idle for longer than max_idle_seconds; returns how many were closed"""
     now = datetime.now()
-    idle_threshold = timedelta(minutes=max_idle_minutes)
-    
-    # Clean cPanel sessions
-    to_remove = []
-    for key, session_data in _cpanel_sessions.items():
-        if now - session_data['last_used'] > idle_threshold:
-            to_remove.append(key)
-    
-    for key in to_remove:
-        _cpanel_sessions[key]['session'].close()
-        del _cpanel_sessions[key]
-    
-    # Clean email connections
-    to_remove = []
-    for key, conn_data in _email_connections.items():
-        if now - conn_data['last_used'] > idle_threshold:
-            to_remove.append(key)
-    
-    for key in to_remove:
-        conn = _email_connections[key]['connection']
-        conn_type = _email_connections[key]['type']
+    expired = []
+    with _email_pool_lock:
+        for key, entries in _email_pool_idle.items():
+            keep = []
+            for entry in entries:
+                if (now - entry['last_used']).total_seconds() > max_idle_seconds:
+                    expired.append(entry)
+                else:
+                    keep.append(entry)
+            entries[:] = keep
+        for entry in expired:
+            _email_pool_open_per_host[entry['host_key']] -= 1
+        if expired:
+            _email_pool_lock.notify_all()
+    # QUIT/LOGOUT outside the lock so a slow server can't stall checkouts
+    for entry in expired:
+        _close_email_entry(entry)
+    return len(expired)
+
+# Per-process reaper metrics, reported by /api/email/connection-stats
+_connection_reaper_stats = {
+    'runs': 0,
+    'last_run_at': None,
+    'last_run_seconds': 0.0,
+    'cpanel_sessions_closed': 0,
+    'email_connections_closed': 0,
+    'errors': 0,
+    'last_error': None
+}
+_connection_reaper_stats_lock = threading.Lock()
+
+def cleanup_idle_connections(cpanel_max_idle_seconds=CPANEL_SESSION_MAX_IDLE_SECONDS,
+                             email_max_idle_seconds=EMAIL_POOL_MAX_IDLE_SECONDS):
+    """One reaper pass over cPanel sessions and pooled email connections; returns counts closed"""
+    started = time.monotonic()
+    cpanel_closed = reap_idle_cpanel_sessions(cpanel_max_idle_seconds)
+    email_closed = reap_idle_email_connections(email_max_idle_seconds)
+    with _connection_reaper_stats_lock:
+        _connection_reaper_stats['runs'] += 1
+        _connection_reaper_stats['last_run_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        _connection_reaper_stats['last_run_seconds'] = round(time.monotonic() - started, 3)
+        _connection_reaper_stats['cpanel_sessions_closed'] += cpanel_closed
+        _connection_reaper_stats['email_connections_closed'] += email_closed
+    return {'cpanel_sessions_closed': cpanel_closed, 'email_connections_closed': email_closed}
+
+def _connection_reaper_loop():
+    while True:
+        time.sleep(CONNECTION_REAPER_INTERVAL_SECONDS)
         try:
-            if conn_type == 'smtp':
-                conn.quit()
-            elif conn_type == 'imap':
-                conn.close()
-                conn.logout()
-        except:
-            pass
-        del _email_connections[key]
+            cleanup_idle_connections()
+        except Exception as e:
+            print(f"Connection reaper error: {e}")
+            with _connection_reaper_stats_lock:
+                _connection_reaper_stats['errors'] += 1
+                _connection_reaper_stats['last_error'] = str(e)
+
+def start_connection_reaper():
+    """Run idle-connection reaping on a daemon timer thread (one per worker process)"""
+    start_background_thread('connection-reaper', _connection_reaper_loop)
+
+def get_connection_pool_stats():
+    """Snapshot of this process's pooled connections and reaper counters"""
+    with _connection_reaper_stats_lock:
+        stats = dict(_connection_reaper_stats)
+    with _cpanel_sessions_lock:
+        stats['cpanel_sessions_open'] = len(_cpanel_sessions)
+    with _email_pool_lock:
+        stats['email_connections_open'] = {k: v for k, v in _email_pool_open_per_host.items() if v}
+        stats['email_connections_idle'] = sum(len(entries) for entries in _email_pool_idle.values())
+    stats['pid'] = os.getpid()
+    stats['reaper_interval_seconds'] = CONNECTION_REAPER_INTERVAL_SECONDS
+    stats['cpanel_max_idle_seconds'] = CPANEL_SESSION_MAX_IDLE_SECONDS
+    stats['email_max_idle_seconds'] = EMAIL_POOL_MAX_IDLE_SECONDS
+    return stats
 
 def cpanel_api_call(api_token, domain, user, api_port, api_module, api_function, **kwargs):
     """Make a cPanel API call using persistent connection"""
@@ -9298,6 +11077,81 @@ def list_email_accounts(api_token, domain, user, api_port):
     except Exception as e:
         return {'error': str(e), 'status': 0}
 
+# cPanel mailbox listing cache: pages render from it; stale entries are refreshed on a background thread
+CPANEL_ACCOUNTS_CACHE_TTL_SECONDS = int(os.environ.get('CPANEL_ACCOUNTS_CACHE_TTL_SECONDS', '300'))
+_cpanel_accounts_cache = {}
+_cpanel_accounts_cache_lock = threading.Lock()
+
+def _cpanel_accounts_cache_key(email_settings):
+    return f"{email_settings['cpanel_user']}@{email_settings['cpanel_domain']}:{email_settings['cpanel_api_port']}"
+
+def _refresh_cpanel_accounts_cache(email_settings):
+    """Fetch the mailbox list from cPanel and store it; returns the accounts, or None on failure"""
+    result = list_email_accounts(
+        email_settings['cpanel_api_token'],
+        email_settings['cpanel_domain'],
+        email_settings['cpanel_user'],
+        email_settings['cpanel_api_port']
+    )
+    if result.get('status') != 1:
+        error_msg = result.get('errors', [{}])[0].get('message', 'Unknown error') if result.get('errors') else result.get('error', 'Failed to fetch from cPanel')
+        print(f"Error fetching cPanel emails: {error_msg}")
+        return None
+    accounts = result.get('data') or []
+    with _cpanel_accounts_cache_lock:
+        _cpanel_accounts_cache[_cpanel_accounts_cache_key(email_settings)] = {
+            'accounts': accounts,
+            'fetched_at': time.monotonic()
+        }
+    return accounts
+
+def get_cpanel_email_accounts(email_settings, force_refresh=False):
+    """
+    cPanel mailbox list (raw UAPI list_pops entries), served from a per-process cache.
+    
+    Fresh entries (younger than CPANEL_ACCOUNTS_CACHE_TTL_SECONDS) are returned as-is; stale
+    ones are returned immediately while a background thread refreshes them. Only a cold
+    cache or force_refresh waits on cPanel. Returns [] if nothing could be fetched.
+    """
+    if not email_settings:
+        return []
+    key = _cpanel_accounts_cache_key(email_settings)
+    with _cpanel_accounts_cache_lock:
+        cached = _cpanel_accounts_cache.get(key)
+    if cached and not force_refresh:
+        if time.monotonic() - cached['fetched_at'] > CPANEL_ACCOUNTS_CACHE_TTL_SECONDS:
+            start_background_thread('cpanel-accounts-refresh', _refresh_cpanel_accounts_cache, dict(email_settings))
+        return cached['accounts']
+    try:
+        accounts = _refresh_cpanel_accounts_cache(email_settings)
+    except Exception as e:
+        print(f"Error fetching cPanel emails: {e}")
+        accounts = None
+    if accounts is None:
+        return cached['accounts'] if cached else []
+    return accounts
+
+def invalidate_cpanel_accounts_cache():
+    """Drop cached cPanel listings (after creating or deleting a mailbox)"""
+    with _cpanel_accounts_cache_lock:
+        _cpanel_accounts_cache.clear()
+
+def merge_cpanel_email_accounts(db_accounts, cpanel_accounts):
+    """DB accounts followed by cPanel-only mailboxes, deduplicated with a set lookup (O(n+m))"""
+    known = {(acc.get('email_address') or '').lower() for acc in db_accounts}
+    merged = list(db_accounts)
+    for account in cpanel_accounts:
+        email_addr = account.get('email', '')
+        if email_addr and email_addr.lower() not in known:
+            known.add(email_addr.lower())
+            merged.append({
+                'email_address': email_addr,
+                'is_cpanel': True,
+                'disk_used': account.get('humandiskused', '0 MB'),
+                'disk_quota': account.get('humandiskquota', '250 MB')
+            })
+    return merged
+
 def delete_email_account(api_token, domain, user, api_port, email_address):
     """Delete an email account via cPanel API"""
     try:
@@ -9355,367 +11209,2022 @@ def save_email_account_to_db(email_address, email_password, display_name, is_mai
             connection.commit()
             return True
     except Exception as e:
-        print(f"Error saving email account: {e}")
-        return False
+        print(f"Error saving email account: {e}")
+        return False
+    finally:
+        if connection:
+            connection.close()
+
+def build_email_message(from_email, to_email, subject, body, html_body=None, sender_name=None):
+    """Build the MIME message sent by send_email_via_smtp() and the outbox worker"""
+    # Ensure all string parameters are actually strings (not ints) to prevent encode errors
+    from_email = str(from_email) if from_email else ''
+    to_email = str(to_email) if to_email else ''
+    subject = str(subject) if subject else ''
+    body = str(body) if body else ''
+    html_body = str(html_body) if html_body else None
+    sender_name = str(sender_name) if sender_name else None
+    
+    msg = MIMEMultipart('alternative')
+    msg['From'] = f"{sender_name} <{from_email}>" if sender_name else from_email
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    
+    # Add plain text and HTML parts
+    if html_body:
+        part1 = MIMEText(body, 'plain')
+        part2 = MIMEText(html_body, 'html')
+        msg.attach(part1)
+        msg.attach(part2)
+    else:
+        msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def send_email_via_smtp(from_email, from_password, to_email, subject, body, 
+                        smtp_host, smtp_port, use_tls, html_body=None, sender_name=None):
+    """Send email via SMTP using persistent connection (inline; prefer enqueue_email() from request handlers)"""
+    try:
+        from_email = str(from_email) if from_email else ''
+        from_password = str(from_password) if from_password else ''
+        smtp_host = str(smtp_host) if smtp_host else ''
+        smtp_port = int(smtp_port) if smtp_port else 587
+        use_tls = bool(use_tls) if use_tls is not None else True
+        
+        msg = build_email_message(from_email, to_email, subject, body, html_body, sender_name)
+        
+        # Exclusive pooled connection; returned to the pool (not quit) afterwards
+        with email_connection(from_email, from_password, smtp_host, smtp_port, use_tls, 'smtp') as server:
+            server.send_message(msg)
+        return True
+    except Exception as e:
+        print(f"Error sending email: {e}")
+        import traceback
+        print(traceback.format_exc())
+        # A failed connection has already been discarded by the pool
+        return False
+
+# ==================== OUTBOUND MAIL QUEUE ====================
+
+# Request handlers insert into email_outbox and return; a per-process worker thread delivers
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '50'))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '6'))
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = int(os.getenv('EMAIL_OUTBOX_RETRY_BASE_SECONDS', '30'))
+EMAIL_OUTBOX_RETRY_MAX_SECONDS = 6 * 3600
+EMAIL_OUTBOX_POLL_SECONDS = 15
+# A row stuck in 'sending' this long belongs to a worker that died mid-batch
+EMAIL_OUTBOX_CLAIM_TIMEOUT_MINUTES = 10
+# Parallel SMTP sessions per sender (bounded again by EMAIL_POOL_MAX_PER_HOST)
+EMAIL_OUTBOX_SMTP_CONNECTIONS = int(os.getenv('EMAIL_OUTBOX_SMTP_CONNECTIONS', '3'))
+# Per recipient domain, so a bulk send doesn't trip provider throttling (e.g. gmail.com)
+EMAIL_DOMAIN_RATE_PER_MINUTE = int(os.getenv('EMAIL_DOMAIN_RATE_PER_MINUTE', '120'))
+# Messages whose domain slot is further away than this are put back in the queue instead of waiting
+EMAIL_DOMAIN_MAX_WAIT_SECONDS = 30
+
+_email_outbox_wakeup = threading.Event()
+_email_domain_next_slot = {}
+_email_domain_lock = threading.Lock()
+
+def enqueue_email(from_email, to_email, subject, body, html_body=None, sender_name=None, created_by_id=None):
+    """Queue an email for background delivery; returns the email_outbox id (None if it could not be stored)"""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO email_outbox
+                (from_email, sender_name, to_email, subject, body, html_body, created_by_id, next_attempt_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP())
+            """, (str(from_email), sender_name, str(to_email), str(subject), str(body), html_body, created_by_id))
+            outbox_id = cursor.lastrowid
+        connection.commit()
+    except Exception as e:
+        print(f"Error queueing email: {e}")
+        return None
+    finally:
+        connection.close()
+    start_email_outbox_worker()
+    _email_outbox_wakeup.set()
+    return outbox_id
+
+def get_outbox_status(outbox_id):
+    """Delivery status of a queued email"""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT id, from_email, to_email, subject, status, attempts, last_error,
+                       next_attempt_at, sent_at, created_by_id, created_at
+                FROM email_outbox WHERE id = %s
+            """, (outbox_id,))
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+def _claim_outbox_batch(cursor, claim_token):
+    """Atomically claim due messages for this worker (safe with several Passenger processes polling)"""
+    cursor.execute("""
+        UPDATE email_outbox
+        SET status = 'sending', claimed_by = %s, claimed_at = UTC_TIMESTAMP()
+        WHERE (status = 'queued' AND next_attempt_at <= UTC_TIMESTAMP())
+           OR (status = 'sending' AND claimed_at < UTC_TIMESTAMP() - INTERVAL %s MINUTE)
+        ORDER BY next_attempt_at
+        LIMIT %s
+    """, (claim_token, EMAIL_OUTBOX_CLAIM_TIMEOUT_MINUTES, EMAIL_OUTBOX_BATCH_SIZE))
+    cursor.execute("""
+        SELECT * FROM email_outbox
+        WHERE claimed_by = %s AND status = 'sending'
+        ORDER BY from_email, id
+    """, (claim_token,))
+    return cursor.fetchall()
+
+def _is_permanent_smtp_failure(error):
+    """5xx replies and refused recipients won't succeed on retry"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+def _record_outbox_result(cursor, row, error=None):
+    """Mark a message sent, or schedule its retry with exponential backoff (failed once attempts run out)"""
+    if error is None:
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'sent', attempts = attempts + 1, sent_at = UTC_TIMESTAMP(),
+                last_error = NULL, claimed_by = NULL
+            WHERE id = %s
+        """, (row['id'],))
+        return
+    attempts = (row.get('attempts') or 0) + 1
+    permanent = _is_permanent_smtp_failure(error)
+    if permanent or attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'failed', attempts = %s, last_error = %s, claimed_by = NULL
+            WHERE id = %s
+        """, (attempts, str(error)[:2000], row['id']))
+        return
+    delay = min(EMAIL_OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), EMAIL_OUTBOX_RETRY_MAX_SECONDS)
+    cursor.execute("""
+        UPDATE email_outbox
+        SET status = 'queued', attempts = %s, last_error = %s, claimed_by = NULL,
+            next_attempt_at = UTC_TIMESTAMP() + INTERVAL %s SECOND
+        WHERE id = %s
+    """, (attempts, str(error)[:2000], delay, row['id']))
+
+def recipient_domain(to_email):
+    """Lower-cased domain of the first address in a To header"""
+    from email.utils import getaddresses
+    addresses = getaddresses([str(to_email or '')])
+    address = addresses[0][1] if addresses else ''
+    return address.rsplit('@', 1)[-1].lower() if '@' in address else ''
+
+def reserve_domain_send_slot(domain, max_wait=EMAIL_DOMAIN_MAX_WAIT_SECONDS):
+    """
+    Reserve the next send slot for a recipient domain (per process).
+    Returns seconds to wait before sending, or None if the next slot is more than
+    max_wait away; nothing is reserved in that case, so the caller can requeue.
+    """
+    interval = 60.0 / max(EMAIL_DOMAIN_RATE_PER_MINUTE, 1)
+    now = time.monotonic()
+    with _email_domain_lock:
+        slot = max(now, _email_domain_next_slot.get(domain, now))
+        if slot - now > max_wait:
+            return None
+        _email_domain_next_slot[domain] = slot + interval
+    return slot - now
+
+def _defer_outbox_rows(cursor, rows, delay_seconds):
+    """Put rate-limited messages back in the queue without counting an attempt"""
+    for row in rows:
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'queued', claimed_by = NULL,
+                next_attempt_at = UTC_TIMESTAMP() + INTERVAL %s SECOND
+            WHERE id = %s
+        """, (int(delay_seconds), row['id']))
+
+def _send_outbox_group(from_email, rows, email_settings):
+    """
+    Deliver all claimed messages from one sender over a single pooled SMTP connection.
+    Returns (results, deferred): error or None per sent row ID, and rows held back by the
+    recipient domain's rate limit.
+    """
+    results = {}
+    deferred = []
+    password = get_email_account_password(from_email, email_settings)
+    smtp_port = int(email_settings['smtp_port']) if email_settings.get('smtp_port') else 587
+    smtp_use_tls = bool(email_settings.get('smtp_use_tls', True))
+    try:
+        with email_connection(from_email, password, email_settings['smtp_host'], smtp_port,
+                              smtp_use_tls, 'smtp') as server:
+            for row in rows:
+                msg = build_email_message(
+                    row['from_email'], row['to_email'], row['subject'], row['body'],
+                    row.get('html_body'), row.get('sender_name') or email_settings.get('sender_name')
+                )
+                # Reserve the recipient domain's next slot now, when this message is actually sent
+                wait = reserve_domain_send_slot(recipient_domain(row['to_email']))
+                if wait is None:
+                    deferred.append(row)
+                    continue
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    server.send_message(msg)
+                    results[row['id']] = None
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                    # Per-message rejection; the session is still usable for the rest of the batch
+                    results[row['id']] = e
+                    server.rset()
+    except Exception as e:
+        # Connection-level failure (login, drop, timeout): everything not yet sent is retried
+        deferred_ids = set(row['id'] for row in deferred)
+        for row in rows:
+            if row['id'] not in results and row['id'] not in deferred_ids:
+                results[row['id']] = e
+    return results, deferred
+
+def process_email_outbox():
+    """Claim and deliver one batch of due messages; returns how many were attempted"""
+    email_settings = get_email_settings()
+    if not email_settings:
+        return 0
+    connection = get_db_connection()
+    if not connection:
+        return 0
+    try:
+        claim_token = f"{os.getpid()}-{secrets.token_hex(8)}"
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            rows = _claim_outbox_batch(cursor, claim_token)
+        connection.commit()
+        if not rows:
+            return 0
+        
+        by_sender = {}
+        for row in rows:
+            by_sender.setdefault(row['from_email'].lower(), []).append(row)
+        
+        # Each sender's rows are dealt round-robin over a few SMTP sessions sent in parallel;
+        # per-domain send slots are reserved by the sending thread, right before each message
+        chunks = []
+        for sender_rows in by_sender.values():
+            sessions = max(1, min(EMAIL_OUTBOX_SMTP_CONNECTIONS, len(sender_rows)))
+            chunks.extend(sender_rows[i::sessions] for i in range(sessions))
+        
+        # All senders share the SMTP host's pool slots, so more threads than slots would only wait on checkout
+        results = {}
+        deferred = []
+        if chunks:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), EMAIL_POOL_MAX_PER_HOST))) as executor:
+                futures = [
+                    executor.submit(_send_outbox_group, chunk[0]['from_email'], chunk, email_settings)
+                    for chunk in chunks
+                ]
+                for future in futures:
+                    chunk_results, chunk_deferred = future.result()
+                    results.update(chunk_results)
+                    deferred.extend(chunk_deferred)
+        
+        # No free pool slot (other threads held them) is our own throttle, not a delivery attempt
+        throttled = [row for chunk in chunks for row in chunk if isinstance(results.get(row['id']), EmailPoolExhausted)]
+        # Rows too far out in their domain's rate limit go back to the queue, also without an attempt
+        deferred_ids = set(row['id'] for row in deferred)
+        with connection.cursor() as cursor:
+            _defer_outbox_rows(cursor, throttled, EMAIL_OUTBOX_POLL_SECONDS)
+            _defer_outbox_rows(cursor, deferred, EMAIL_DOMAIN_MAX_WAIT_SECONDS)
+            for chunk in chunks:
+                for row in chunk:
+                    if row['id'] not in deferred_ids and not isinstance(results.get(row['id']), EmailPoolExhausted):
+                        _record_outbox_result(cursor, row, results.get(row['id']))
+        connection.commit()
+        return len(rows) - len(deferred) - len(throttled)
+    finally:
+        connection.close()
+
+def _email_outbox_worker_loop():
+    while True:
+        try:
+            attempted = process_email_outbox()
+        except Exception as e:
+            print(f"Email outbox worker error: {e}")
+            attempted = 0
+        if not attempted:
+            # Sleep until the next poll, or until enqueue_email() signals new mail
+            _email_outbox_wakeup.wait(EMAIL_OUTBOX_POLL_SECONDS)
+            _email_outbox_wakeup.clear()
+
+def start_email_outbox_worker():
+    """Deliver queued email on a daemon thread (also picks up retries and rows left by restarted processes)"""
+    start_background_thread('email-outbox-worker', _email_outbox_worker_loop)
+
+# ==================== BULK EMAIL (MAIL MERGE) ====================
+
+# Templates are compiled once per job and rendered per recipient; a missing variable skips that recipient
+_mail_merge_env = SandboxedEnvironment(undefined=StrictUndefined, autoescape=False)
+_mail_merge_html_env = SandboxedEnvironment(undefined=StrictUndefined, autoescape=True)
+BULK_EMAIL_INSERT_CHUNK = 500
+
+def get_hearing_notice_recipients(date_from, date_to):
+    """One mail-merge context per upcoming hearing (latest proceeding of each case) with a client email"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT 
+                    cl.email,
+                    cl.full_name AS client_name,
+                    c.id AS case_id,
+                    c.tracking_number,
+                    c.court_case_number,
+                    c.case_type,
+                    c.station,
+                    p.court_activity_type,
+                    p.court_room,
+                    p.judicial_officer,
+                    p.next_court_date,
+                    p.next_attendance,
+                    p.virtual_link
+                FROM case_proceedings p
+                INNER JOIN cases c ON p.case_id = c.id
+                INNER JOIN clients cl ON c.client_id = cl.id
+                WHERE p.next_court_date BETWEEN %s AND %s
+                AND cl.status = 'Active'
+                AND NOT EXISTS (
+                    SELECT 1 FROM case_proceedings p2 
+                    WHERE p2.previous_proceeding_id = p.id
+                )
+                ORDER BY p.next_court_date, c.id
+            """, (date_from, date_to))
+            recipients = cursor.fetchall()
+        for recipient in recipients:
+            if recipient.get('next_court_date'):
+                recipient['next_court_date'] = recipient['next_court_date'].strftime('%d %B %Y')
+        return recipients
+    finally:
+        connection.close()
+
+def render_mail_merge(subject_template, body_template, html_template, recipients):
+    """Yield (recipient, subject, body, html_body, error) for each recipient from templates compiled once"""
+    subject_tpl = _mail_merge_env.from_string(subject_template)
+    body_tpl = _mail_merge_env.from_string(body_template)
+    html_tpl = _mail_merge_html_env.from_string(html_template) if html_template else None
+    for recipient in recipients:
+        if not recipient.get('email'):
+            yield recipient, None, None, None, 'Missing email address'
+            continue
+        try:
+            yield (
+                recipient,
+                subject_tpl.render(recipient).strip(),
+                body_tpl.render(recipient),
+                html_tpl.render(recipient) if html_tpl else None,
+                None
+            )
+        except TemplateError as e:
+            yield recipient, None, None, None, str(e)
+
+def create_bulk_email_job(from_email, subject_template, body_template, recipients, html_template=None,
+                          sender_name=None, name=None, source='recipients', created_by_id=None):
+    """
+    Render a mail merge into email_outbox under one bulk job and wake the outbox worker.
+    Returns (job_id, queued_count, skipped) where skipped lists recipients that failed to render.
+    Raises TemplateError if a template itself does not compile.
+    """
+    # Compile before touching the database so a bad template fails the request cleanly
+    _mail_merge_env.from_string(subject_template)
+    _mail_merge_env.from_string(body_template)
+    if html_template:
+        _mail_merge_html_env.from_string(html_template)
+    
+    connection = get_db_connection()
+    if not connection:
+        return None, 0, []
+    queued = 0
+    skipped = []
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO email_bulk_jobs
+                (name, source, from_email, subject_template, body_template, html_template, created_by_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (name, source, from_email, subject_template, body_template, html_template, created_by_id))
+            job_id = cursor.lastrowid
+            
+            insert_sql = """
+                INSERT INTO email_outbox
+                (from_email, sender_name, to_email, subject, body, html_body, created_by_id, bulk_job_id, next_attempt_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP())
+            """
+            batch = []
+            for recipient, subject, body, html_body, error in render_mail_merge(
+                    subject_template, body_template, html_template, recipients):
+                if error:
+                    skipped.append({'email': recipient.get('email'), 'error': error})
+                    continue
+                batch.append((from_email, sender_name, recipient['email'], subject, body, html_body,
+                              created_by_id, job_id))
+                if len(batch) >= BULK_EMAIL_INSERT_CHUNK:
+                    cursor.executemany(insert_sql, batch)
+                    queued += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(insert_sql, batch)
+                queued += len(batch)
+            
+            cursor.execute("""
+                UPDATE email_bulk_jobs SET total_recipients = %s, skipped_recipients = %s WHERE id = %s
+            """, (queued, len(skipped), job_id))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    
+    start_email_outbox_worker()
+    _email_outbox_wakeup.set()
+    return job_id, queued, skipped
+
+def get_bulk_email_progress(job_id):
+    """Bulk job with per-status outbox counts and percent delivered/finished"""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT id, name, source, from_email, total_recipients, skipped_recipients, created_by_id, created_at
+                FROM email_bulk_jobs WHERE id = %s
+            """, (job_id,))
+            job = cursor.fetchone()
+            if not job:
+                return None
+            cursor.execute("""
+                SELECT status, COUNT(*) AS count FROM email_outbox
+                WHERE bulk_job_id = %s GROUP BY status
+            """, (job_id,))
+            counts = {'queued': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+            for row in cursor.fetchall():
+                counts[row['status']] = row['count']
+        total = job['total_recipients'] or 0
+        finished = counts['sent'] + counts['failed']
+        job['counts'] = counts
+        job['percent_complete'] = round(finished * 100.0 / total, 1) if total else 100.0
+        job['done'] = finished >= total
+        if job.get('created_at'):
+            job['created_at'] = job['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+        return job
+    finally:
+        connection.close()
+
+def fetch_emails_from_imap(email_address, password, imap_host, imap_port, use_ssl, limit=50):
+    """Fetch emails from IMAP server using a pooled connection (not stored in DB, fetched on trigger)"""
+    try:
+        # Headers for the newest messages in one UID FETCH, then only their text parts (no attachment bytes)
+        emails = fetch_email_headers_from_imap(email_address, password, imap_host, imap_port, use_ssl, limit)
+        content = fetch_email_content_from_imap(
+            email_address, password, imap_host, imap_port, use_ssl, [e['uid'] for e in emails]
+        )
+        for e in emails:
+            item = content.get(e['uid'], {})
+            e['body'] = item.get('body', '')  # Text body for conversation view
+            e['attachments'] = item.get('attachments', [])
+        return emails
+    except Exception as e:
+        print(f"Error fetching emails: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return []
+
+# ==================== IMAP LIST-MODE FETCH ====================
+
+# Header fields requested for list views; bodies are only fetched when a conversation is opened
+EMAIL_LIST_HEADER_FIELDS = 'FROM TO SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES'
+
+_IMAP_FETCH_START_RE = re.compile(rb'^(\d+) \(')
+_IMAP_LITERAL_KEY_RE = re.compile(rb'((?:BODY|BINARY)\[[^\]]*\](?:<\d+>)?|RFC822(?:\.HEADER|\.TEXT)?)\s*\{\d+\}\s*$')
+_IMAP_UID_RE = re.compile(rb'\bUID (\d+)')
+_IMAP_FLAGS_RE = re.compile(rb'\bFLAGS \(([^)]*)\)')
+_IMAP_INTERNALDATE_RE = re.compile(rb'\bINTERNALDATE "([^"]+)"')
+_MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+def decode_email_header(value):
+    """Decode an RFC 2047 encoded header (all chunks, not just the first) into a plain string"""
+    if not value:
+        return ''
+    decoded = []
+    try:
+        for chunk, charset in decode_header(str(value)):
+            if isinstance(chunk, bytes):
+                try:
+                    decoded.append(chunk.decode(charset or 'utf-8', errors='replace'))
+                except LookupError:
+                    decoded.append(chunk.decode('utf-8', errors='replace'))
+            else:
+                decoded.append(chunk)
+    except Exception:
+        return str(value).strip()
+    return ''.join(decoded).strip()
+
+def imap_uid_set(uids):
+    """Compress a list of UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> '1:3,7'"""
+    ranges = []
+    for uid in sorted(set(int(u) for u in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+def split_imap_fetch_response(data):
+    """
+    Group a raw imaplib FETCH response into one entry per message.
+    
+    imaplib returns literals as (metadata, bytes) tuples followed by plain bytes for any
+    items the server sends after the literal, so items for one message can be spread over
+    several list elements. Each entry is {'meta': bytes, 'literals': {section: bytes}}.
+    """
+    messages = []
+    for part in data or []:
+        if isinstance(part, tuple):
+            meta, literal = part[0], part[1]
+        else:
+            meta, literal = part, None
+        if not isinstance(meta, bytes):
+            continue
+        if _IMAP_FETCH_START_RE.match(meta):
+            messages.append({'meta': b'', 'literals': {}})
+        elif not messages:
+            continue
+        current = messages[-1]
+        current['meta'] += meta
+        if literal is not None:
+            key_match = _IMAP_LITERAL_KEY_RE.search(meta)
+            key = key_match.group(1).decode('ascii', errors='replace') if key_match else 'BODY[]'
+            current['literals'][key] = literal
+    return messages
+
+def parse_message_ids(value):
+    """Extract <message-id> tokens from a Message-ID, In-Reply-To or References header, in order"""
+    return _MESSAGE_ID_RE.findall(str(value or ''))[:100]
+
+def _parse_imap_fetch_meta(meta):
+    """Extract UID, FLAGS and INTERNALDATE from the metadata of a single FETCH response"""
+    uid_match = _IMAP_UID_RE.search(meta)
+    flags_match = _IMAP_FLAGS_RE.search(meta)
+    date_match = _IMAP_INTERNALDATE_RE.search(meta)
+    return {
+        'uid': int(uid_match.group(1)) if uid_match else None,
+        'flags': flags_match.group(1).decode('ascii', errors='replace').split() if flags_match else [],
+        'internal_date': date_match.group(1).decode('ascii', errors='replace') if date_match else ''
+    }
+
+def _find_fetch_literal(literals, prefix):
+    """Return the first literal whose section name starts with prefix (servers may echo sections differently)"""
+    for key, value in literals.items():
+        if key.upper().startswith(prefix):
+            return value
+    return None
+
+def extract_email_text_body(email_message):
+    """Return the text/plain body of a parsed message (same rules as the full RFC822 fetch)"""
+    body = ""
+    if email_message.is_multipart():
+        for part in email_message.walk():
+            if part.get_content_type() == "text/plain":
+                try:
+                    body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                except:
+                    body = str(part.get_payload())
+                break
+    else:
+        try:
+            body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+        except:
+            body = str(email_message.get_payload())
+    return body or ''
+
+def build_email_summary(uid, fetch_meta, header_bytes, folder='INBOX'):
+    """Build the list-view dict for one message from its FETCH metadata and header block"""
+    headers = email.message_from_bytes(header_bytes or b'')
+    flags = fetch_meta.get('flags', [])
+    message_ids = parse_message_ids(headers.get('Message-ID'))
+    in_reply_to = parse_message_ids(headers.get('In-Reply-To'))
+    return {
+        'id': str(uid),
+        'uid': uid,
+        'folder': folder,
+        'subject': decode_email_header(headers.get('Subject')) or '(No Subject)',
+        'from': decode_email_header(headers.get('From')) or 'Unknown',
+        'to': decode_email_header(headers.get('To')),
+        'date': headers.get('Date', ''),
+        'message_id': message_ids[0] if message_ids else (headers.get('Message-ID') or '').strip(),
+        'in_reply_to': in_reply_to[0] if in_reply_to else '',
+        'references': parse_message_ids(headers.get('References')),
+        'flags': flags,
+        'seen': '\\Seen' in flags,
+        'internal_date': fetch_meta.get('internal_date', '')
+    }
+
+def _imap_quote_mailbox(folder):
+    """Quote a mailbox name as an IMAP quoted string; names that can't be quoted raise ValueError"""
+    folder = str(folder)
+    if not folder or any(ch in folder for ch in '\r\n\0'):
+        raise ValueError('Invalid folder name')
+    return '"' + folder.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def select_imap_folder(mail, folder='INBOX', readonly=True):
+    """SELECT (or EXAMINE when readonly) a folder on an open IMAP connection"""
+    status, data = mail.select(_imap_quote_mailbox(folder), readonly=readonly)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"Failed to select {folder}")
+    return mail
+
+@contextmanager
+def imap_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder='INBOX', readonly=True):
+    """with imap_mailbox(...) as mail: exclusive pooled IMAP connection with folder selected"""
+    with email_connection(email_address, password, imap_host, imap_port, use_ssl, 'imap') as mail:
+        yield select_imap_folder(mail, folder, readonly)
+
+def fetch_header_summaries(mail, uids, folder='INBOX'):
+    """Fetch list-view summaries for uids on an already selected mailbox in one UID FETCH"""
+    if not uids:
+        return []
+    status, data = mail.uid(
+        'FETCH', imap_uid_set(uids),
+        f'(UID FLAGS INTERNALDATE BODY.PEEK[HEADER.FIELDS ({EMAIL_LIST_HEADER_FIELDS})])'
+    )
+    if status != 'OK':
+        raise Exception(f"Header fetch failed with status: {status}")
+    
+    emails = []
+    for item in split_imap_fetch_response(data):
+        fetch_meta = _parse_imap_fetch_meta(item['meta'])
+        if fetch_meta['uid'] is None:
+            continue
+        header_bytes = _find_fetch_literal(item['literals'], 'BODY[HEADER')
+        emails.append(build_email_summary(fetch_meta['uid'], fetch_meta, header_bytes, folder))
+    return emails
+
+def fetch_email_headers_from_imap(email_address, password, imap_host, imap_port, use_ssl, limit=50,
+                                  folder='INBOX', uids=None):
+    """
+    List-mode fetch: headers, flags and internal date for the newest `limit` messages
+    (or for the given UIDs) in a single UID FETCH round trip. Bodies are not downloaded.
+    """
+    try:
+        with imap_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder) as mail:
+            if uids is None:
+                status, data = mail.uid('SEARCH', None, 'ALL')
+                if status != 'OK' or not data or not data[0]:
+                    return []
+                uids = [int(uid) for uid in data[0].split()]
+                if limit:
+                    uids = uids[-limit:]
+            
+            emails = fetch_header_summaries(mail, uids, folder)
+        # Newest first, matching fetch_emails_from_imap
+        emails.sort(key=lambda x: x['uid'], reverse=True)
+        return emails
+    except Exception as e:
+        print(f"Error fetching email headers: {e}")
+        return []
+
+def fetch_email_content_from_imap(email_address, password, imap_host, imap_port, use_ssl, uids, folder='INBOX'):
+    """
+    Lazily load text bodies and attachment metadata for the given UIDs; returns {uid: {'body', 'attachments'}}.
+    
+    BODYSTRUCTURE is fetched first so only each message's text part is downloaded
+    (BODY.PEEK[1], BODY.PEEK[1.1], ...), grouped into one UID FETCH per section number.
+    Attachment bytes are never fetched here. Messages whose structure can't be parsed fall
+    back to the full RFC822 fetch.
+    """
+    if not uids:
+        return {}
+    try:
+        content = {}
+        with imap_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder) as mail:
+            structures = fetch_message_structures(mail, uids)
+            by_section = {}
+            fallback = [uid for uid in uids if not structures.get(uid)]
+            for uid, parts in structures.items():
+                if not parts:
+                    continue
+                content[uid] = {'body': '', 'attachments': attachment_metadata(parts)}
+                text_part = choose_text_part(parts)
+                if text_part:
+                    by_section.setdefault(text_part['section'], []).append((uid, text_part))
+            
+            for section, entries in by_section.items():
+                payloads = fetch_message_sections(mail, [uid for uid, _ in entries], section)
+                for uid, part in entries:
+                    if uid in payloads:
+                        content[uid]['body'] = decode_body_part(payloads[uid], part['encoding'], part['charset'])
+            
+            if fallback:
+                status, data = mail.uid('FETCH', imap_uid_set(fallback), '(UID BODY.PEEK[])')
+                if status == 'OK':
+                    for item in split_imap_fetch_response(data):
+                        fetch_meta = _parse_imap_fetch_meta(item['meta'])
+                        raw_message = _find_fetch_literal(item['literals'], 'BODY[')
+                        if fetch_meta['uid'] is not None and raw_message is not None:
+                            content[fetch_meta['uid']] = {
+                                'body': extract_email_text_body(email.message_from_bytes(raw_message)),
+                                'attachments': []
+                            }
+        return content
+    except Exception as e:
+        print(f"Error fetching email bodies: {e}")
+        return {}
+
+def fetch_email_bodies_from_imap(email_address, password, imap_host, imap_port, use_ssl, uids, folder='INBOX'):
+    """Lazily load text bodies for the given UIDs; returns {uid: body}"""
+    content = fetch_email_content_from_imap(email_address, password, imap_host, imap_port, use_ssl, uids, folder)
+    return {uid: item['body'] for uid, item in content.items()}
+
+def fetch_email_attachment(email_address, password, imap_host, imap_port, use_ssl, uid, section, folder='INBOX'):
+    """Download one attachment on demand; returns (metadata, decoded bytes) or (None, None)"""
+    with imap_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder) as mail:
+        parts = fetch_message_structures(mail, [uid]).get(uid) or []
+        part = next((p for p in parts if p['section'] == section and _is_attachment_part(p)), None)
+        if not part:
+            return None, None
+        payload = fetch_message_sections(mail, [uid], section).get(uid)
+    if payload is None:
+        return None, None
+    return attachment_metadata([part])[0], decode_body_part(payload, part['encoding'])
+
+# ==================== BODYSTRUCTURE-BASED FETCH ====================
+
+# Conversation views only download the text part of each message; attachments are listed
+# from BODYSTRUCTURE (name, type, size) and downloaded on demand by section number
+_IMAP_LITERAL_MARKER_RE = re.compile(rb'\{(\d+)\}$')
+_IMAP_TOKEN_RE = re.compile(rb'\s*(\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+)')
+
+def _inline_imap_literals(data):
+    """Rejoin a FETCH response into one bytes string per message, with literals turned into quoted strings"""
+    messages = []
+    for part in data or []:
+        if isinstance(part, tuple):
+            meta, literal = part[0], part[1]
+        else:
+            meta, literal = part, None
+        if not isinstance(meta, bytes):
+            continue
+        if _IMAP_FETCH_START_RE.match(meta):
+            messages.append(b'')
+        elif not messages:
+            continue
+        if literal is not None:
+            meta = _IMAP_LITERAL_MARKER_RE.sub(b'', meta.rstrip())
+            literal = b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+            meta += literal
+        messages[-1] += meta
+    return messages
+
+def parse_imap_list(data, start=0):
+    """
+    Parse an IMAP parenthesized list starting at data[start] == '('.
+    Returns (items, next_index); strings/atoms are str, NIL is None, nested lists are lists.
+    """
+    items = []
+    pos = start + 1
+    while pos < len(data):
+        match = _IMAP_TOKEN_RE.match(data, pos)
+        if not match:
+            break
+        token = match.group(1)
+        if token == b'(':
+            sub, pos = parse_imap_list(data, match.start(1))
+            items.append(sub)
+            continue
+        pos = match.end()
+        if token == b')':
+            return items, pos
+        if token.startswith(b'"'):
+            value = re.sub(rb'\\(.)', rb'\1', token[1:-1])
+            items.append(value.decode('utf-8', errors='replace'))
+        elif token.upper() == b'NIL':
+            items.append(None)
+        else:
+            items.append(token.decode('utf-8', errors='replace'))
+    return items, pos
+
+def _imap_params(value):
+    """("name" "value" ...) -> {'name': 'value'} with lower-cased keys"""
+    if not isinstance(value, list):
+        return {}
+    return {str(value[i]).lower(): value[i + 1] for i in range(0, len(value) - 1, 2) if value[i]}
+
+def _bodystructure_parts(structure, section=''):
+    """Flatten a parsed BODYSTRUCTURE into leaf parts with their FETCH section numbers"""
+    if structure and isinstance(structure[0], list):
+        parts = []
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break  # Multipart subtype and extension data follow the children
+            index += 1
+            parts.extend(_bodystructure_parts(child, f"{section}.{index}" if section else str(index)))
+        return parts
+    
+    if len(structure) < 7:
+        return []
+    content_type = f"{structure[0] or 'text'}/{structure[1] or 'plain'}".lower()
+    params = _imap_params(structure[2])
+    # Extension data starts after the type-specific fields (lines for text, envelope/body/lines for message/rfc822)
+    if content_type.startswith('text/'):
+        extension_start = 8
+    elif content_type == 'message/rfc822':
+        extension_start = 10
+    else:
+        extension_start = 7
+    disposition = structure[extension_start + 1] if len(structure) > extension_start + 1 else None
+    disposition_type = ''
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = str(disposition[0] or '').lower()
+        disposition_params = _imap_params(disposition[1] if len(disposition) > 1 else None)
+    filename = decode_email_header(disposition_params.get('filename') or params.get('name') or '')
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError):
+        size = 0
+    return [{
+        'section': section or '1',
+        'content_type': content_type,
+        'charset': params.get('charset') or 'utf-8',
+        'encoding': str(structure[5] or '7bit').lower(),
+        'size': size,
+        'disposition': disposition_type,
+        'filename': filename
+    }]
+
+def parse_bodystructure(fetch_line):
+    """Leaf parts of the BODYSTRUCTURE in one (literal-inlined) FETCH response line"""
+    position = fetch_line.upper().find(b'BODYSTRUCTURE (')
+    if position < 0:
+        return []
+    structure, _ = parse_imap_list(fetch_line, position + len(b'BODYSTRUCTURE '))
+    return _bodystructure_parts(structure)
+
+def _is_attachment_part(part):
+    if part['disposition'] == 'attachment':
+        return True
+    return bool(part['filename']) and not part['content_type'].startswith('text/')
+
+def choose_text_part(parts):
+    """The part shown as the message body: first inline text/plain, else first inline text/html"""
+    for wanted in ('text/plain', 'text/html'):
+        for part in parts:
+            if part['content_type'] == wanted and not _is_attachment_part(part):
+                return part
+    return None
+
+def attachment_metadata(parts):
+    """Attachment list (no payload bytes) for display and on-demand download"""
+    return [
+        {
+            'section': part['section'],
+            'filename': part['filename'] or f"attachment-{part['section']}",
+            'content_type': part['content_type'],
+            'size': part['size']
+        }
+        for part in parts if _is_attachment_part(part)
+    ]
+
+def decode_body_part(payload, encoding, charset=None):
+    """Undo the Content-Transfer-Encoding of a fetched section; decodes to str when charset is given"""
+    import quopri
+    payload = payload or b''
+    try:
+        if encoding == 'base64':
+            payload = base64.b64decode(payload)
+        elif encoding == 'quoted-printable':
+            payload = quopri.decodestring(payload)
+    except Exception:
+        pass  # Malformed encoding: show what the server sent
+    if charset is None:
+        return payload
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def fetch_message_structures(mail, uids):
+    """{uid: [leaf parts]} for uids on a selected mailbox, from one UID FETCH BODYSTRUCTURE"""
+    if not uids:
+        return {}
+    status, data = mail.uid('FETCH', imap_uid_set(uids), '(UID BODYSTRUCTURE)')
+    if status != 'OK':
+        raise Exception(f"BODYSTRUCTURE fetch failed with status: {status}")
+    structures = {}
+    for line in _inline_imap_literals(data):
+        uid = _parse_imap_fetch_meta(line)['uid']
+        if uid is None:
+            continue
+        try:
+            structures[uid] = parse_bodystructure(line)
+        except Exception as e:
+            print(f"Error parsing BODYSTRUCTURE for UID {uid}: {e}")
+    return structures
+
+def fetch_message_sections(mail, uids, section):
+    """{uid: raw bytes} of one body section for uids, without setting \\Seen"""
+    if not uids:
+        return {}
+    status, data = mail.uid('FETCH', imap_uid_set(uids), f'(UID BODY.PEEK[{section}])')
+    if status != 'OK':
+        raise Exception(f"Section fetch failed with status: {status}")
+    sections = {}
+    for item in split_imap_fetch_response(data):
+        uid = _parse_imap_fetch_meta(item['meta'])['uid']
+        payload = _find_fetch_literal(item['literals'], 'BODY[')
+        if uid is not None and payload is not None:
+            sections[uid] = payload
+    return sections
+
+# ==================== LOCAL MAILBOX CACHE ====================
+
+# Skip the IMAP round trip entirely if the folder was synced this recently
+EMAIL_SYNC_MIN_INTERVAL_SECONDS = int(os.environ.get('EMAIL_SYNC_MIN_INTERVAL_SECONDS', '30'))
+# How long a forced sync (IMAP IDLE notification) waits for a sync of the same mailbox already running
+EMAIL_SYNC_LOCK_WAIT_SECONDS = int(os.environ.get('EMAIL_SYNC_LOCK_WAIT_SECONDS', '30'))
+# How many of the newest messages the first sync of a folder pulls in
+EMAIL_CACHE_INITIAL_SYNC = int(os.environ.get('EMAIL_CACHE_INITIAL_SYNC', '500'))
+# UIDs per UID FETCH command during sync
+EMAIL_SYNC_BATCH_SIZE = 250
+
+def get_email_account_password(email_address, email_settings):
+    """Password for a mailbox: its own email_accounts entry, falling back to the main email password"""
+    password = email_settings.get('main_email_password') if email_settings else None
+    connection = get_db_connection()
+    if not connection:
+        return password
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT email_password FROM email_accounts WHERE email_address = %s", (email_address,))
+            account = cursor.fetchone()
+            if account and account.get('email_password'):
+                password = account['email_password']
+    except Exception as e:
+        print(f"Error getting email account password: {e}")
+    finally:
+        connection.close()
+    return password
+
+def parse_email_date(date_str, internal_date=''):
+    """Parse a Date header (falling back to INTERNALDATE) into a naive UTC datetime for MySQL"""
+    from email.utils import parsedate_to_datetime
+    from datetime import timezone
+    parsed = None
+    if date_str:
+        try:
+            parsed = parsedate_to_datetime(date_str)
+        except (TypeError, ValueError, IndexError):
+            parsed = None
+    if parsed is None and internal_date:
+        try:
+            parsed = datetime.strptime(internal_date.strip(), '%d-%b-%Y %H:%M:%S %z')
+        except ValueError:
+            parsed = None
+    if parsed is None:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def _imap_response_int(mail, code):
+    """Read a numeric untagged response (UIDVALIDITY, UIDNEXT, EXISTS) left by the last SELECT"""
+    typ, data = mail.response(code)
+    values = [v for v in (data or []) if v]
+    if not values:
+        return None
+    try:
+        return int(values[-1])
+    except (TypeError, ValueError):
+        return None
+
+def _get_mailbox_state(cursor, account_email, folder):
+    cursor.execute("""
+        SELECT uidvalidity, last_uid, server_message_count, last_synced_at,
+               last_synced_at > NOW() - INTERVAL %s SECOND AS recently_synced
+        FROM email_mailbox_state
+        WHERE account_email = %s AND folder = %s
+    """, (EMAIL_SYNC_MIN_INTERVAL_SECONDS, account_email, folder))
+    state = cursor.fetchone()
+    # A row created by _lock_mailbox_state() before the first sync carries no sync state yet
+    if state and (state['uidvalidity'] if isinstance(state, dict) else state[0]) is None:
+        return None
+    return state
+
+def _lock_mailbox_state(cursor, account_email, folder):
+    """
+    Lock one mailbox's state row for the rest of the transaction, creating it if needed, so writers
+    of that mailbox's cached messages and contact counts take turns. Keep such transactions short.
+    """
+    cursor.execute("""
+        INSERT INTO email_mailbox_state (account_email, folder) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE account_email = account_email
+    """, (account_email, folder))
+
+def cache_email_summaries(cursor, account_email, folder, uidvalidity, summaries):
+    """
+    Insert list-view summaries into email_messages (existing rows only get their flags refreshed).
+    Returns the summaries that were not cached before.
+    """
+    if not summaries:
+        return []
+    cursor.execute(f"""
+        SELECT uid FROM email_messages
+        WHERE account_email = %s AND folder = %s AND uidvalidity = %s
+        AND uid IN ({', '.join(['%s'] * len(summaries))})
+    """, [account_email, folder, uidvalidity] + [s['uid'] for s in summaries])
+    cached_uids = set(int(row['uid'] if isinstance(row, dict) else row[0]) for row in cursor.fetchall())
+    assign_thread_keys(cursor, account_email, folder, summaries)
+    cursor.executemany("""
+        INSERT INTO email_messages
+            (account_email, folder, uidvalidity, uid, message_id, subject, from_header,
+             to_header, date_header, sent_at, flags, in_reply_to, references_header, thread_key)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE flags = VALUES(flags)
+    """, [(
+        account_email, folder, uidvalidity, s['uid'], s.get('message_id') or None,
+        s.get('subject'), s.get('from'), s.get('to'), (s.get('date') or '')[:255],
+        parse_email_date(s.get('date'), s.get('internal_date')), ' '.join(s.get('flags', [])),
+        s.get('in_reply_to') or None, ' '.join(s.get('references', [])) or None, s['thread_key']
+    ) for s in summaries])
+    merge_threads(cursor, account_email, summaries)
+    return [s for s in summaries if int(s['uid']) not in cached_uids]
+
+def _aggregate_contacts(messages):
+    """Group (from_header, subject, sent_at) tuples by parsed sender address"""
+    from email.utils import parseaddr
+    contacts = {}
+    for from_header, subject, sent_at in messages:
+        name, address = parseaddr(from_header or '')
+        address = (address or from_header or 'Unknown').strip().lower()[:255]
+        contact = contacts.setdefault(address, {
+            'name': None, 'count': 0, 'last_message_at': None, 'last_subject': None
+        })
+        contact['count'] += 1
+        if contact['last_message_at'] is None or (sent_at is not None and sent_at >= contact['last_message_at']):
+            contact['last_message_at'] = sent_at
+            contact['last_subject'] = subject
+            contact['name'] = name[:255] if name else contact['name']
+    return contacts
+
+def update_contact_index(cursor, account_email, summaries):
+    """Fold newly synced inbox messages into email_contacts (counts add up, latest message wins)"""
+    contacts = _aggregate_contacts(
+        (s.get('from'), s.get('subject'), parse_email_date(s.get('date'), s.get('internal_date')))
+        for s in summaries
+    )
+    if not contacts:
+        return
+    # Assignments run left to right, so last_message_at is compared before it is updated
+    cursor.executemany("""
+        INSERT INTO email_contacts
+            (account_email, contact_email, contact_name, message_count, last_message_at, last_subject)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            contact_name = IF(last_message_at IS NULL OR VALUES(last_message_at) >= last_message_at,
+                              COALESCE(VALUES(contact_name), contact_name), contact_name),
+            last_subject = IF(last_message_at IS NULL OR VALUES(last_message_at) >= last_message_at,
+                              VALUES(last_subject), last_subject),
+            message_count = message_count + VALUES(message_count),
+            last_message_at = GREATEST(COALESCE(last_message_at, VALUES(last_message_at)),
+                                       COALESCE(VALUES(last_message_at), last_message_at))
+    """, [(account_email, address, c['name'], c['count'], c['last_message_at'], c['last_subject'])
+          for address, c in contacts.items()])
+
+def rebuild_contact_index(cursor, account_email):
+    """Recompute email_contacts for one mailbox from the cached inbox (after expunges or a UIDVALIDITY reset)"""
+    cursor.execute("""
+        SELECT from_header, subject, sent_at FROM email_messages
+        WHERE account_email = %s AND folder = 'INBOX'
+    """, (account_email,))
+    rows = cursor.fetchall()
+    contacts = _aggregate_contacts(
+        (row['from_header'], row['subject'], row['sent_at']) if isinstance(row, dict) else row
+        for row in rows
+    )
+    cursor.execute("DELETE FROM email_contacts WHERE account_email = %s", (account_email,))
+    if contacts:
+        cursor.executemany("""
+            INSERT INTO email_contacts
+                (account_email, contact_email, contact_name, message_count, last_message_at, last_subject)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, [(account_email, address, c['name'], c['count'], c['last_message_at'], c['last_subject'])
+              for address, c in contacts.items()])
+
+def get_email_contacts(account_email, limit=500):
+    """Contacts panel for one mailbox: a single indexed read of email_contacts, most recent first"""
+    from email.utils import formataddr
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT contact_email, contact_name, message_count, last_message_at, last_subject
+                FROM email_contacts
+                WHERE account_email = %s
+                ORDER BY last_message_at DESC
+                LIMIT %s
+            """, (account_email, int(limit)))
+            return [{
+                'email': formataddr((row['contact_name'], row['contact_email'])) if row.get('contact_name') else row['contact_email'],
+                'address': row['contact_email'],
+                'name': row.get('contact_name'),
+                'count': row['message_count'],
+                'last_date': row['last_message_at'].strftime('%Y-%m-%d %H:%M:%S') if row.get('last_message_at') else '',
+                'last_subject': row.get('last_subject') or 'No Subject'
+            } for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error reading email contacts: {e}")
+        return []
+    finally:
+        connection.close()
+
+def sync_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder='INBOX', force=False):
+    """
+    Incrementally sync one IMAP folder into the local email_messages cache.
+    
+    Only UIDs above the last seen UID are fetched (headers only). A UIDVALIDITY change
+    discards the cached folder. Expunges are detected by comparing the server's message
+    count with the count recorded at the previous sync; only then is the full UID list
+    requested so the vanished messages can be removed.
+    
+    One sync per mailbox runs at a time (a MySQL named lock; callers that find it taken
+    skip, except force=True callers, which wait up to EMAIL_SYNC_LOCK_WAIT_SECONDS so a
+    new-mail notification isn't lost to a sync already in flight). The IMAP round trips happen outside any transaction and the results are
+    written in one short transaction at the end.
+    
+    Returns a dict with 'new', 'expunged' and 'skipped' counts/flags, or None on failure.
+    """
+    result = {'new': 0, 'expunged': 0, 'skipped': False, 'reset': False}
+    lock_name = f'mailbox-sync:{email_address.lower()}/{folder}'
+    if len(lock_name) > 64:
+        # MySQL lock names are limited to 64 characters
+        lock_name = 'mailbox-sync:' + hashlib.sha1(lock_name.encode('utf-8')).hexdigest()
+    with mysql_named_lock(lock_name, EMAIL_SYNC_LOCK_WAIT_SECONDS if force else 0) as acquired:
+        if not acquired:
+            result['skipped'] = True
+            return result
+        
+        connection = get_db_connection()
+        if not connection:
+            return None
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                state = _get_mailbox_state(cursor, email_address, folder)
+            connection.commit()
+            if state and not force and state['recently_synced']:
+                result['skipped'] = True
+                return result
+            
+            # IMAP phase: no transaction is open while talking to the mail server
+            summaries = []
+            server_uids = None
+            with imap_mailbox(email_address, password, imap_host, imap_port, use_ssl, folder) as mail:
+                uidvalidity = _imap_response_int(mail, 'UIDVALIDITY')
+                uidnext = _imap_response_int(mail, 'UIDNEXT')
+                exists = _imap_response_int(mail, 'EXISTS') or 0
+                if uidvalidity is None:
+                    raise Exception(f"Server did not report UIDVALIDITY for {folder}")
+                
+                if state and state.get('uidvalidity') != uidvalidity:
+                    # UIDs were renumbered - everything cached for this folder is stale
+                    result['reset'] = True
+                    state = None
+                
+                last_uid = int(state['last_uid']) if state else 0
+                previous_count = int(state['server_message_count']) if state else 0
+                
+                new_uids = []
+                if uidnext is None or uidnext > last_uid + 1:
+                    status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+                    if status == 'OK' and data and data[0]:
+                        # "n:*" always matches the highest UID, even when it is <= n
+                        new_uids = sorted(int(uid) for uid in data[0].split() if int(uid) > last_uid)
+                
+                if state is None and len(new_uids) > EMAIL_CACHE_INITIAL_SYNC:
+                    new_uids = new_uids[-EMAIL_CACHE_INITIAL_SYNC:]
+                
+                for i in range(0, len(new_uids), EMAIL_SYNC_BATCH_SIZE):
+                    summaries.extend(fetch_header_summaries(mail, new_uids[i:i + EMAIL_SYNC_BATCH_SIZE], folder))
+                
+                # Without expunges the server count grows by exactly the number of new UIDs
+                if state is not None and exists != previous_count + len(new_uids):
+                    status, data = mail.uid('SEARCH', None, 'ALL')
+                    if status == 'OK':
+                        server_uids = set(int(uid) for uid in (data[0].split() if data and data[0] else []))
+            
+            # Write phase: one short transaction
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                _lock_mailbox_state(cursor, email_address, folder)
+                if result['reset']:
+                    cursor.execute("""
+                        DELETE FROM email_messages WHERE account_email = %s AND folder = %s
+                    """, (email_address, folder))
+                
+                for i in range(0, len(summaries), EMAIL_SYNC_BATCH_SIZE):
+                    inserted = cache_email_summaries(cursor, email_address, folder, uidvalidity,
+                                                     summaries[i:i + EMAIL_SYNC_BATCH_SIZE])
+                    if folder == 'INBOX' and not result['reset']:
+                        update_contact_index(cursor, email_address, inserted)
+                result['new'] = len(summaries)
+                
+                if server_uids is not None:
+                    cursor.execute("""
+                        SELECT uid FROM email_messages
+                        WHERE account_email = %s AND folder = %s AND uidvalidity = %s
+                    """, (email_address, folder, uidvalidity))
+                    gone = [row['uid'] for row in cursor.fetchall() if int(row['uid']) not in server_uids]
+                    for i in range(0, len(gone), 1000):
+                        chunk = gone[i:i + 1000]
+                        cursor.execute(f"""
+                            DELETE FROM email_messages
+                            WHERE account_email = %s AND folder = %s AND uidvalidity = %s
+                            AND uid IN ({', '.join(['%s'] * len(chunk))})
+                        """, [email_address, folder, uidvalidity] + chunk)
+                    result['expunged'] = len(gone)
+                
+                # Counts can only be decremented reliably by recomputing from what is still cached
+                if folder == 'INBOX' and (result['reset'] or result['expunged']):
+                    rebuild_contact_index(cursor, email_address)
+                
+                cursor.execute("""
+                    UPDATE email_mailbox_state
+                    SET uidvalidity = %s, last_uid = %s, server_message_count = %s, last_synced_at = NOW()
+                    WHERE account_email = %s AND folder = %s
+                """, (uidvalidity, max([last_uid] + new_uids), exists, email_address, folder))
+            connection.commit()
+            return result
+        except Exception as e:
+            connection.rollback()
+            print(f"Error syncing mailbox {email_address}/{folder}: {e}")
+            return None
+        finally:
+            connection.close()
+
+def _cached_row_to_email(row):
+    """Convert an email_messages row into the dict shape used by the templates"""
+    return {
+        'id': str(row['uid']),
+        'uid': int(row['uid']),
+        'folder': row['folder'],
+        'account_email': row['account_email'],
+        'uidvalidity': int(row['uidvalidity']),
+        'subject': row.get('subject') or '(No Subject)',
+        'from': row.get('from_header') or 'Unknown',
+        'to': row.get('to_header') or '',
+        'date': row.get('date_header') or '',
+        'sent_at': row['sent_at'].strftime('%Y-%m-%d %H:%M:%S') if row.get('sent_at') else None,
+        'message_id': row.get('message_id') or '',
+        'in_reply_to': row.get('in_reply_to') or '',
+        'references': (row.get('references_header') or '').split(),
+        'thread_key': row.get('thread_key'),
+        'flags': (row.get('flags') or '').split(),
+        'seen': '\\Seen' in (row.get('flags') or ''),
+        'body': row.get('body') if row.get('body_fetched') else None,
+        'attachments': json.loads(row['attachments_json']) if row.get('attachments_json') else []
+    }
+
+def get_cached_emails(account_email, folder='INBOX', limit=100, offset=0):
+    """Read messages for one account from the local cache, newest first"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT m.*
+                FROM email_messages m
+                JOIN email_mailbox_state s
+                    ON s.account_email = m.account_email AND s.folder = m.folder
+                    AND s.uidvalidity = m.uidvalidity
+                WHERE m.account_email = %s AND m.folder = %s
+                ORDER BY m.sent_at DESC, m.uid DESC
+                LIMIT %s OFFSET %s
+            """, (account_email, folder, int(limit), int(offset)))
+            return [_cached_row_to_email(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error reading cached emails: {e}")
+        return []
+    finally:
+        connection.close()
+
+def load_cached_email_bodies(emails, password, imap_host, imap_port, use_ssl):
+    """Fill in 'body' for cached emails, fetching from IMAP (and caching) only those not yet downloaded"""
+    missing = {}
+    for e in emails:
+        if e.get('body') is None:
+            missing.setdefault((e['account_email'], e['folder'], e['uidvalidity']), []).append(e['uid'])
+    
+    for (account_email, folder, uidvalidity), uids in missing.items():
+        content = fetch_email_content_from_imap(account_email, password, imap_host, imap_port, use_ssl, uids, folder)
+        if not content:
+            continue
+        connection = get_db_connection()
+        if connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.executemany("""
+                        UPDATE email_messages
+                        SET body = %s, attachments_json = %s, body_fetched = TRUE
+                        WHERE account_email = %s AND folder = %s AND uidvalidity = %s AND uid = %s
+                    """, [
+                        (item['body'], json.dumps(item['attachments']), account_email, folder, uidvalidity, uid)
+                        for uid, item in content.items()
+                    ])
+                    connection.commit()
+            except Exception as e:
+                print(f"Error caching email bodies: {e}")
+            finally:
+                connection.close()
+        for e in emails:
+            if (e['account_email'], e['folder'], e['uidvalidity']) == (account_email, folder, uidvalidity) and e['uid'] in content:
+                e['body'] = content[e['uid']]['body']
+                e['attachments'] = content[e['uid']]['attachments']
+    
+    for e in emails:
+        if e.get('body') is None:
+            e['body'] = ''
+    return emails
+
+# ==================== FIRM-WIDE MAILBOX FAN-OUT ====================
+
+# Mailboxes synced concurrently (each sync holds one pooled IMAP connection, capped per host by the pool)
+EMAIL_FANOUT_MAX_WORKERS = int(os.environ.get('EMAIL_FANOUT_MAX_WORKERS', str(EMAIL_POOL_MAX_PER_HOST)))
+# Page renders wait at most this long; syncs still running finish in the background
+EMAIL_FANOUT_DEADLINE_SECONDS = int(os.environ.get('EMAIL_FANOUT_DEADLINE_SECONDS', '8'))
+LATEST_COMMUNICATIONS_PER_PAGE = 50
+
+def get_permitted_mailbox_password(email_address, email_settings):
+    """
+    Password for a mailbox the logged-in employee may read, or None.
+    Communications staff may read every firm mailbox; anyone else only their own work email.
+    """
+    user_role = session.get('employee_role')
+    original_role = session.get('original_role')
+    allowed_roles = ['IT Support', 'Firm Administrator', 'Managing Partner']
+    if user_role not in allowed_roles and original_role != 'IT Support':
+        connection = get_db_connection()
+        if not connection:
+            return None
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("SELECT work_email FROM employees WHERE id = %s", (session.get('employee_id'),))
+                employee = cursor.fetchone()
+        finally:
+            connection.close()
+        if not employee or (employee.get('work_email') or '').lower() != email_address.lower():
+            return None
+    for mailbox, password in get_firm_mailboxes(email_settings):
+        if mailbox.lower() == email_address.lower():
+            return password
+    if email_settings and (email_settings.get('main_email') or '').lower() == email_address.lower():
+        return email_settings.get('main_email_password')
+    return None
+
+def get_firm_mailboxes(email_settings, accounts=None):
+    """(email_address, password) for every DB/cPanel mailbox, using the main password when none is stored"""
+    if accounts is None:
+        accounts = merge_cpanel_email_accounts(get_email_accounts_from_db(), get_cpanel_email_accounts(email_settings))
+    mailboxes = []
+    seen = set()
+    for account in accounts:
+        email_address = account.get('email_address') or account.get('email', '')
+        password = account.get('email_password') or (email_settings or {}).get('main_email_password', '')
+        if email_address and password and email_address.lower() not in seen:
+            seen.add(email_address.lower())
+            mailboxes.append((email_address, password))
+    return mailboxes
+
+def sync_all_mailboxes(mailboxes, email_settings, deadline_seconds=EMAIL_FANOUT_DEADLINE_SECONDS):
+    """
+    Incrementally sync many INBOXes into the local cache in parallel.
+    
+    Returns once every sync finished or deadline_seconds passed, with the accounts
+    that 'synced', 'failed' and are still 'pending' (those keep running in the background).
+    """
+    summary = {'synced': [], 'failed': [], 'pending': []}
+    if not mailboxes or not email_settings:
+        return summary
+    imap_host = email_settings.get('imap_host', 'mail.baunilawgroup.com')
+    imap_port = int(email_settings.get('imap_port', 993))
+    imap_use_ssl = bool(email_settings.get('imap_use_ssl', True))
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, min(EMAIL_FANOUT_MAX_WORKERS, len(mailboxes))),
+                                  thread_name_prefix='mailbox-sync')
+    futures = {
+        executor.submit(sync_mailbox, email_address, password, imap_host, imap_port, imap_use_ssl): email_address
+        for email_address, password in mailboxes
+    }
+    done, not_done = wait(futures, timeout=deadline_seconds)
+    # Don't block the caller on stragglers; syncs not yet started are dropped
+    executor.shutdown(wait=False, cancel_futures=True)
+    
+    for future in done:
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error syncing {futures[future]}: {e}")
+            result = None
+        summary['synced' if result is not None else 'failed'].append(futures[future])
+    summary['pending'] = [futures[future] for future in not_done]
+    return summary
+
+def get_latest_communications(account_emails, page=1, per_page=LATEST_COMMUNICATIONS_PER_PAGE):
+    """
+    One page of the firm-wide inbox, newest first, from the local cache.
+    
+    Each account's cached rows are already ordered by parsed send date, so the accounts are
+    combined with a k-way heap merge; no account needs more than page * per_page rows.
+    Returns (emails, has_more).
+    """
+    page = max(1, int(page))
+    offset = (page - 1) * per_page
+    connection = get_db_connection()
+    if not connection or not account_emails:
+        return [], False
+    per_account = []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            for account_email in account_emails:
+                cursor.execute("""
+                    SELECT m.*
+                    FROM email_messages m
+                    JOIN email_mailbox_state s
+                        ON s.account_email = m.account_email AND s.folder = m.folder
+                        AND s.uidvalidity = m.uidvalidity
+                    WHERE m.account_email = %s AND m.folder = 'INBOX'
+                    ORDER BY m.sent_at DESC, m.uid DESC
+                    LIMIT %s
+                """, (account_email, offset + per_page + 1))
+                per_account.append([_cached_row_to_email(row) for row in cursor.fetchall()])
+    finally:
+        connection.close()
+    
+    merged = heapq.merge(*per_account, key=lambda e: (e['sent_at'] or '', e['uid']), reverse=True)
+    window = list(islice(merged, offset, offset + per_page + 1))
+    return window[:per_page], len(window) > per_page
+
+# ==================== SERVER-SIDE CONVERSATION SEARCH ====================
+
+# Common Sent folder names on cPanel/Dovecot, Courier and other servers (used when SPECIAL-USE is absent)
+SENT_FOLDER_CANDIDATES = ['INBOX.Sent', 'Sent', 'Sent Items', 'INBOX.Sent Items', 'Sent Messages', 'INBOX/Sent']
+
+_IMAP_LIST_RE = re.compile(rb'\((?P<flags>[^)]*)\) (?P<delimiter>"[^"]*"|NIL) (?P<name>.+)$')
+_sent_folder_names = {}
+
+def find_sent_folder(mail, email_address):
+    """Locate the Sent folder via the \\Sent SPECIAL-USE flag, falling back to well-known names"""
+    if email_address in _sent_folder_names:
+        return _sent_folder_names[email_address]
+    
+    sent_folder = None
+    try:
+        status, data = mail.list()
+        if status == 'OK':
+            names = []
+            for line in data or []:
+                if not isinstance(line, bytes):
+                    continue
+                match = _IMAP_LIST_RE.match(line)
+                if not match:
+                    continue
+                name = match.group('name').decode('utf-8', errors='replace').strip().strip('"')
+                if b'\\Sent' in match.group('flags'):
+                    sent_folder = name
+                    break
+                names.append(name)
+            if not sent_folder:
+                sent_folder = next((n for n in SENT_FOLDER_CANDIDATES if n in names), None)
+    except Exception as e:
+        print(f"Error listing folders for {email_address}: {e}")
+        return None
+    
+    _sent_folder_names[email_address] = sent_folder
+    return sent_folder
+
+def _imap_search_string(value):
+    """Quote a value for use as an IMAP SEARCH string argument"""
+    return '"' + str(value).replace('\\', '').replace('"', '').strip() + '"'
+
+def search_contact_uids(mail, contact_email):
+    """UID SEARCH OR FROM x TO x on the selected folder; returns a list of matching UIDs"""
+    contact = _imap_search_string(contact_email)
+    status, data = mail.uid('SEARCH', None, 'OR', 'FROM', contact, 'TO', contact)
+    if status != 'OK' or not data or not data[0]:
+        return []
+    return [int(uid) for uid in data[0].split()]
+
+def fetch_internal_dates(mail, uids):
+    """Fetch only INTERNALDATE for uids (a few dozen bytes per message) for ordering; returns {uid: datetime}"""
+    if not uids:
+        return {}
+    status, data = mail.uid('FETCH', imap_uid_set(uids), '(UID INTERNALDATE)')
+    if status != 'OK':
+        return {}
+    dates = {}
+    for item in split_imap_fetch_response(data):
+        fetch_meta = _parse_imap_fetch_meta(item['meta'])
+        if fetch_meta['uid'] is not None:
+            dates[fetch_meta['uid']] = parse_email_date('', fetch_meta['internal_date']) or datetime.min
+    return dates
+
+def _get_cached_emails_by_uid(account_email, folder, uidvalidity, uids):
+    """Read specific UIDs of one folder from the local cache; returns {uid: email}"""
+    if not uids:
+        return {}
+    connection = get_db_connection()
+    if not connection:
+        return {}
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(f"""
+                SELECT * FROM email_messages
+                WHERE account_email = %s AND folder = %s AND uidvalidity = %s
+                AND uid IN ({', '.join(['%s'] * len(uids))})
+            """, [account_email, folder, uidvalidity] + list(uids))
+            return {int(row['uid']): _cached_row_to_email(row) for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error reading cached emails by UID: {e}")
+        return {}
+    finally:
+        connection.close()
+
+def fetch_contact_conversation(email_address, password, imap_host, imap_port, use_ssl, contact_email,
+                               page=1, per_page=50):
+    """
+    Full conversation history with one contact, filtered on the server.
+    
+    Runs UID SEARCH OR FROM x TO x in INBOX and the Sent folder, orders the matches by
+    INTERNALDATE and fetches headers only for the requested page (reusing cached rows
+    and caching the rest). Bodies are left to load_cached_email_bodies().
+    
+    Returns (emails, total_matches).
+    """
+    matches = []  # (internal date, folder, uidvalidity, uid)
+    found = {}
+    try:
+        with email_connection(email_address, password, imap_host, imap_port, use_ssl, 'imap') as mail:
+            select_imap_folder(mail, 'INBOX')
+            folders = ['INBOX']
+            sent_folder = find_sent_folder(mail, email_address)
+            if sent_folder and sent_folder != 'INBOX':
+                folders.append(sent_folder)
+            
+            for folder in folders:
+                if folder != 'INBOX':
+                    select_imap_folder(mail, folder)
+                uidvalidity = _imap_response_int(mail, 'UIDVALIDITY') or 0
+                uids = search_contact_uids(mail, contact_email)
+                for uid, internal_date in fetch_internal_dates(mail, uids).items():
+                    matches.append((internal_date, folder, uidvalidity, uid))
+            
+            matches.sort(key=lambda m: (m[0], m[3]), reverse=True)
+            page = max(int(page or 1), 1)
+            page_matches = matches[(page - 1) * per_page:page * per_page]
+            
+            by_folder = {}
+            for internal_date, folder, uidvalidity, uid in page_matches:
+                by_folder.setdefault((folder, uidvalidity), []).append(uid)
+            
+            for (folder, uidvalidity), uids in by_folder.items():
+                cached = _get_cached_emails_by_uid(email_address, folder, uidvalidity, uids)
+                missing = [uid for uid in uids if uid not in cached]
+                if missing:
+                    select_imap_folder(mail, folder)
+                    summaries = fetch_header_summaries(mail, missing, folder)
+                    connection = get_db_connection()
+                    if connection:
+                        try:
+                            with connection.cursor() as cursor:
+                                if folder == 'INBOX':
+                                    # Same row lock as sync_mailbox's write, so a message is counted by whichever caches it first
+                                    _lock_mailbox_state(cursor, email_address, folder)
+                                inserted = cache_email_summaries(cursor, email_address, folder, uidvalidity, summaries)
+                                if folder == 'INBOX':
+                                    update_contact_index(cursor, email_address, inserted)
+                                connection.commit()
+                        except Exception as e:
+                            print(f"Error caching conversation headers: {e}")
+                        finally:
+                            connection.close()
+                    for s in summaries:
+                        sent_at = parse_email_date(s.get('date'), s.get('internal_date'))
+                        cached[s['uid']] = dict(
+                            s, account_email=email_address, uidvalidity=uidvalidity, body=None,
+                            sent_at=sent_at.strftime('%Y-%m-%d %H:%M:%S') if sent_at else None
+                        )
+                for uid, e in cached.items():
+                    found[(folder, uid)] = e
+    except Exception as e:
+        print(f"Error searching conversation with {contact_email}: {e}")
+        return [], 0
+    
+    emails = [found[(folder, uid)] for _, folder, _, uid in page_matches if (folder, uid) in found]
+    return emails, len(matches)
+
+# ==================== MESSAGE THREADING ====================
+
+def _thread_key(message_id):
+    """Stable CHAR(40) key for the thread rooted at message_id"""
+    return hashlib.sha1(message_id.encode('utf-8', errors='replace')).hexdigest()
+
+def _normalize_message_id(message_id):
+    """Message-IDs are compared case-insensitively, like the table's collation does"""
+    return (message_id or '').strip().lower()
+
+def _message_refs(message):
+    """References followed by In-Reply-To, de-duplicated, oldest ancestor first"""
+    refs = list(message.get('references') or [])
+    if message.get('in_reply_to') and message['in_reply_to'] not in refs:
+        refs.append(message['in_reply_to'])
+    own = message.get('message_id')
+    return [ref for ref in dict.fromkeys(refs) if ref != own]
+
+def _lookup_thread_keys(cursor, account_email, message_ids):
+    """Map already-cached message ids of one account to their thread keys"""
+    known = {}
+    message_ids = list(message_ids)
+    for i in range(0, len(message_ids), 500):
+        chunk = message_ids[i:i + 500]
+        cursor.execute(f"""
+            SELECT message_id, thread_key FROM email_messages
+            WHERE account_email = %s AND thread_key IS NOT NULL
+            AND message_id IN ({', '.join(['%s'] * len(chunk))})
+        """, [account_email] + chunk)
+        for row in cursor.fetchall():
+            message_id, thread_key = (row['message_id'], row['thread_key']) if isinstance(row, dict) else row
+            known[_normalize_message_id(message_id)] = thread_key
+    return known
+
+def assign_thread_keys(cursor, account_email, folder, summaries):
+    """
+    Set 'thread_key' on each summary before it is cached.
+    
+    A message joins the thread of the oldest referenced message that is already cached;
+    otherwise the key is derived from the first References/In-Reply-To id (or its own id),
+    so replies that arrive before their parent still land in the parent's thread.
+    """
+    referenced = set()
+    for s in summaries:
+        referenced.update(_message_refs(s))
+        if s.get('message_id'):
+            referenced.add(s['message_id'])
+    known = _lookup_thread_keys(cursor, account_email, referenced) if referenced else {}
+    
+    for s in sorted(summaries, key=lambda x: x['uid']):
+        refs = [_normalize_message_id(ref) for ref in _message_refs(s)]
+        own_id = _normalize_message_id(s.get('message_id'))
+        thread_key = next((known[ref] for ref in refs if ref in known), None)
+        if thread_key is None and own_id in known:
+            thread_key = known[own_id]
+        if thread_key is None:
+            root = refs[0] if refs else (own_id or f"<{folder}.{s['uid']}@{account_email}>")
+            thread_key = _thread_key(root)
+        s['thread_key'] = thread_key
+        if own_id:
+            known.setdefault(own_id, thread_key)
+
+def merge_threads(cursor, account_email, summaries):
+    """
+    Pull previously cached replies into the thread of a newly arrived parent when their keys differ.
+    Replies are matched on In-Reply-To only; one that names the parent solely in References stays put.
+    """
+    parents = {_normalize_message_id(s['message_id']): s['thread_key'] for s in summaries if s.get('message_id')}
+    if not parents:
+        return
+    ids = list(parents)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cursor.execute(f"""
+            SELECT DISTINCT in_reply_to, thread_key FROM email_messages
+            WHERE account_email = %s AND in_reply_to IN ({', '.join(['%s'] * len(chunk))})
+        """, [account_email] + chunk)
+        for row in cursor.fetchall():
+            in_reply_to, thread_key = (row['in_reply_to'], row['thread_key']) if isinstance(row, dict) else row
+            parent_key = parents.get(_normalize_message_id(in_reply_to))
+            if thread_key and parent_key and thread_key != parent_key:
+                cursor.execute("""
+                    UPDATE email_messages SET thread_key = %s
+                    WHERE account_email = %s AND thread_key = %s
+                """, (parent_key, account_email, thread_key))
+
+def build_thread_tree(messages):
+    """
+    JWZ threading (steps 1-4) over a set of messages: link containers by References and
+    In-Reply-To without creating loops, collect the root set and prune empty containers.
+    Subject-based grouping is intentionally left out. Returns a list of root containers,
+    each {'message': dict or None, 'children': [...]}, siblings ordered by date.
+    """
+    containers = {}
+    
+    def container(message_id):
+        if message_id not in containers:
+            containers[message_id] = {'id': message_id, 'message': None, 'parent': None, 'children': []}
+        return containers[message_id]
+    
+    def is_ancestor(candidate, node):
+        while node is not None:
+            if node is candidate:
+                return True
+            node = node['parent']
+        return False
+    
+    def set_parent(child, parent):
+        if child['parent'] is parent or is_ancestor(child, parent):
+            return
+        if child['parent'] is not None:
+            child['parent']['children'].remove(child)
+        child['parent'] = parent
+        parent['children'].append(child)
+    
+    for message in messages:
+        message_id = message.get('message_id') or f"<{message.get('folder')}.{message.get('uid')}@local>"
+        node = container(message_id)
+        if node['message'] is not None:
+            # Duplicate Message-ID (e.g. the same mail in INBOX and Sent): keep both as siblings
+            node = container(f"{message_id}#{message.get('folder')}.{message.get('uid')}")
+        node['message'] = message
+        
+        previous = None
+        for ref in _message_refs(message):
+            ref_node = container(ref)
+            if previous is not None and ref_node['parent'] is None:
+                set_parent(ref_node, previous)
+            previous = ref_node
+        if previous is not None:
+            set_parent(node, previous)
+    
+    def prune(nodes):
+        pruned = []
+        for node in nodes:
+            node['children'] = prune(node['children'])
+            if node['message'] is None and not node['children']:
+                continue
+            if node['message'] is None and len(node['children']) == 1:
+                # Promote the only child in place of the missing message
+                child = node['children'][0]
+                child['parent'] = node['parent']
+                pruned.append(child)
+                continue
+            pruned.append(node)
+        return pruned
+    
+    def sort_key(node):
+        message = node['message'] or (node['children'][0]['message'] if node['children'] else None) or {}
+        return (message.get('sent_at') or '', message.get('uid') or 0)
+    
+    def sort_siblings(nodes):
+        nodes.sort(key=sort_key)
+        for node in nodes:
+            sort_siblings(node['children'])
+        return nodes
+    
+    roots = prune([node for node in containers.values() if node['parent'] is None])
+    return sort_siblings(roots)
+
+def flatten_thread_tree(roots, depth=0):
+    """Depth-first walk of build_thread_tree() output; each message gets 'depth' for indentation"""
+    flattened = []
+    for node in roots:
+        child_depth = depth
+        if node['message'] is not None:
+            node['message']['depth'] = depth
+            flattened.append(node['message'])
+            child_depth = depth + 1
+        flattened.extend(flatten_thread_tree(node['children'], child_depth))
+    return flattened
+
+def order_emails_by_thread(emails):
+    """Group messages by thread (most recently active thread first), each thread in reply order"""
+    threads = {}
+    for e in emails:
+        threads.setdefault(e.get('thread_key') or f"uid:{e.get('folder')}:{e.get('uid')}", []).append(e)
+    ordered = sorted(
+        threads.values(),
+        key=lambda thread: max(m.get('sent_at') or '' for m in thread),
+        reverse=True
+    )
+    result = []
+    for thread in ordered:
+        result.extend(flatten_thread_tree(build_thread_tree(thread)))
+    return result
+
+def get_thread_emails(account_email, thread_key):
+    """All cached messages of one thread (an indexed read sized by the thread), in reply order"""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT * FROM email_messages
+                WHERE account_email = %s AND thread_key = %s
+            """, (account_email, thread_key))
+            emails = [_cached_row_to_email(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error reading email thread: {e}")
+        return []
     finally:
-        if connection:
-            connection.close()
+        connection.close()
+    return flatten_thread_tree(build_thread_tree(emails))
+
+# ==================== IMAP IDLE LISTENER ====================
+
+# Optional push updates: one IDLE session per work mailbox keeps the cache current and feeds /api/email/events
+EMAIL_IDLE_ENABLED = os.environ.get('EMAIL_IDLE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# RFC 2177: servers may drop an IDLE after 30 minutes, so it is re-issued before then
+EMAIL_IDLE_RENEW_SECONDS = 25 * 60
+# Servers without the IDLE capability are polled instead
+EMAIL_IDLE_POLL_FALLBACK_SECONDS = 120
+EMAIL_EVENTS_BUFFER_SIZE = 500
+# SSE responses end after this long (EventSource reconnects with Last-Event-ID) so worker threads are recycled
+EMAIL_EVENTS_STREAM_SECONDS = 300
+
+_IMAP_IDLE_CHANGE_RE = re.compile(rb'^\* \d+ (EXISTS|EXPUNGE)\b', re.IGNORECASE)
+
+_email_events = deque(maxlen=EMAIL_EVENTS_BUFFER_SIZE)
+_email_events_cond = threading.Condition()
+_email_event_seq = 0
+
+def publish_email_event(event_type, account_email, data=None):
+    """Append an event to this process's in-memory feed and wake waiting SSE streams"""
+    global _email_event_seq
+    with _email_events_cond:
+        _email_event_seq += 1
+        _email_events.append({
+            'id': _email_event_seq,
+            'type': event_type,
+            'account_email': account_email,
+            'data': data or {}
+        })
+        _email_events_cond.notify_all()
 
-def send_email_via_smtp(from_email, from_password, to_email, subject, body, 
-                        smtp_host, smtp_port, use_tls, html_body=None, sender_name=None):
-    """Send email via SMTP using persistent connection"""
+def wait_for_email_events(last_id, timeout):
+    """Events newer than last_id, waiting up to timeout seconds for one to arrive"""
+    with _email_events_cond:
+        if _email_event_seq <= last_id:
+            _email_events_cond.wait(timeout)
+        return [event for event in _email_events if event['id'] > last_id]
+
+def current_email_event_id():
+    with _email_events_cond:
+        return _email_event_seq
+
+def _imap_raw_readline(mail, buffer, deadline):
+    """
+    Next CRLF-terminated line read straight from the socket (not imaplib's buffered file,
+    which can't be polled), or None if deadline passes first. buffer carries leftover bytes.
+    """
+    import select
+    while b'\r\n' not in buffer:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        # SSL sockets may hold decrypted bytes that select() can't see
+        if not (hasattr(mail.sock, 'pending') and mail.sock.pending()):
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable:
+                return None
+        chunk = mail.sock.recv(4096)
+        if not chunk:
+            raise imaplib.IMAP4.abort('Connection closed during IDLE')
+        buffer.extend(chunk)
+    line, _, rest = bytes(buffer).partition(b'\r\n')
+    buffer[:] = rest
+    return line
+
+def imap_idle_wait(mail, timeout):
+    """
+    Send IDLE on a selected mailbox and block until the server reports EXISTS/EXPUNGE
+    or timeout passes, then end it with DONE. Returns True if the mailbox changed.
+    """
+    tag = mail._new_tag()
+    buffer = bytearray()
+    mail.send(tag + b' IDLE\r\n')
+    line = _imap_raw_readline(mail, buffer, time.monotonic() + EMAIL_SOCKET_TIMEOUT)
+    if line is None or not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+    
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        line = _imap_raw_readline(mail, buffer, deadline)
+        if line is None:
+            break
+        if _IMAP_IDLE_CHANGE_RE.match(line):
+            changed = True
+    
+    mail.send(b'DONE\r\n')
+    while True:
+        line = _imap_raw_readline(mail, buffer, time.monotonic() + EMAIL_SOCKET_TIMEOUT)
+        if line is None:
+            raise imaplib.IMAP4.abort('Timed out ending IDLE')
+        if line.startswith(tag + b' '):
+            if not line[len(tag):].strip().upper().startswith(b'OK'):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return changed
+        if _IMAP_IDLE_CHANGE_RE.match(line):
+            changed = True
+
+def get_idle_mailboxes(email_settings):
+    """Mailboxes we can log in to on our own: the main email and active work emails with a stored password"""
+    mailboxes = []
+    if email_settings and email_settings.get('main_email') and email_settings.get('main_email_password'):
+        mailboxes.append(email_settings['main_email'])
+    connection = get_db_connection()
+    if not connection:
+        return mailboxes
     try:
-        # Ensure all string parameters are actually strings (not ints) to prevent encode errors
-        from_email = str(from_email) if from_email else ''
-        from_password = str(from_password) if from_password else ''
-        to_email = str(to_email) if to_email else ''
-        subject = str(subject) if subject else ''
-        body = str(body) if body else ''
-        smtp_host = str(smtp_host) if smtp_host else ''
-        smtp_port = int(smtp_port) if smtp_port else 587
-        use_tls = bool(use_tls) if use_tls is not None else True
-        html_body = str(html_body) if html_body else None
-        sender_name = str(sender_name) if sender_name else None
-        
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{sender_name} <{from_email}>" if sender_name else from_email
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Add plain text and HTML parts
-        if html_body:
-            part1 = MIMEText(body, 'plain')
-            part2 = MIMEText(html_body, 'html')
-            msg.attach(part1)
-            msg.attach(part2)
-        else:
-            msg.attach(MIMEText(body, 'plain'))
-        
-        # Use persistent connection
-        server = get_email_connection(from_email, from_password, smtp_host, smtp_port, use_tls, 'smtp')
-        server.send_message(msg)
-        # Don't quit - keep connection alive
-        return True
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT email_address FROM email_accounts
+                WHERE is_active = TRUE AND email_password IS NOT NULL AND email_password != ''
+            """)
+            seen = set(m.lower() for m in mailboxes)
+            for row in cursor.fetchall():
+                if row['email_address'].lower() not in seen:
+                    seen.add(row['email_address'].lower())
+                    mailboxes.append(row['email_address'])
     except Exception as e:
-        print(f"Error sending email: {e}")
-        import traceback
-        print(traceback.format_exc())
-        # Close connection on error and try to recreate
-        close_email_connection(from_email, smtp_host, smtp_port, 'smtp')
-        return False
+        print(f"Error listing IDLE mailboxes: {e}")
+    finally:
+        connection.close()
+    return mailboxes
+
+def _sync_and_publish(email_address, password, email_settings):
+    """Incremental INBOX sync; publishes a mailbox_updated event when anything changed"""
+    result = sync_mailbox(
+        email_address, password,
+        email_settings['imap_host'], email_settings['imap_port'],
+        email_settings['imap_use_ssl'], 'INBOX', force=True
+    )
+    if result and (result['new'] or result['expunged'] or result['reset']):
+        latest = get_cached_emails(email_address, 'INBOX', limit=min(result['new'], 20)) if result['new'] else []
+        publish_email_event('mailbox_updated', email_address, {
+            'new': result['new'],
+            'expunged': result['expunged'],
+            'reset': result['reset'],
+            'messages': [
+                {'uid': e['uid'], 'from': e['from'], 'subject': e['subject'], 'date': e['date']}
+                for e in latest
+            ]
+        })
 
-def fetch_emails_from_imap(email_address, password, imap_host, imap_port, use_ssl, limit=50):
-    """Fetch emails from IMAP server using persistent connection (not stored in DB, fetched on trigger)"""
-    mail = None
-    try:
-        # Try to use persistent connection, but recreate if there's an issue
+def _imap_idle_listener_loop(email_address):
+    """Hold a dedicated (unpooled) IDLE session for one mailbox, reconnecting with backoff"""
+    failures = 0
+    while True:
+        mail = None
         try:
-            mail = get_email_connection(email_address, password, imap_host, imap_port, use_ssl, 'imap')
-            # Test the connection by selecting INBOX
-            try:
-                # Try to check connection state first
-                try:
-                    mail.noop()  # Send a NOOP command to check if connection is alive
-                except:
-                    pass  # If noop fails, connection is likely dead, will be caught below
-                
-                status, data = mail.select('INBOX')
-                if status != 'OK':
-                    raise Exception("Failed to select INBOX")
-            except (imaplib.IMAP4.error, Exception) as e:
-                # Connection might be bad, close it and recreate
-                error_msg = str(e)
-                # Clean up error message if it contains email data
-                if 'Return-Path' in error_msg or 'unexpected response' in error_msg.lower():
-                    error_msg = "Connection in bad state (received unexpected data)"
-                print(f"Connection test failed, recreating: {error_msg}")
-                close_email_connection(email_address, imap_host, imap_port, 'imap')
-                # Create fresh connection
-                if use_ssl:
-                    mail = imaplib.IMAP4_SSL(imap_host, imap_port)
-                else:
-                    mail = imaplib.IMAP4(imap_host, imap_port)
-                mail.login(email_address, password)
-                status, data = mail.select('INBOX')
-                if status != 'OK':
-                    raise Exception("Failed to select INBOX after reconnect")
-        except Exception as e:
-            # If persistent connection fails, create a new one
-            error_msg = str(e)
-            if 'Return-Path' in error_msg or 'unexpected response' in error_msg.lower():
-                error_msg = "Connection in bad state (received unexpected data)"
-            print(f"Using persistent connection failed, creating new: {error_msg}")
-            close_email_connection(email_address, imap_host, imap_port, 'imap')
-            try:
-                if use_ssl:
-                    mail = imaplib.IMAP4_SSL(imap_host, imap_port)
-                else:
-                    mail = imaplib.IMAP4(imap_host, imap_port)
-                mail.login(email_address, password)
-                status, data = mail.select('INBOX')
-                if status != 'OK':
-                    raise Exception("Failed to select INBOX")
-            except (imaplib.IMAP4.error, ConnectionResetError, OSError) as auth_error:
-                error_msg = str(auth_error)
-                if 'AUTHENTICATIONFAILED' in error_msg or 'Authentication failed' in error_msg:
-                    print(f"Authentication failed: {error_msg}")
-                    raise Exception(f"Email authentication failed. Please check email credentials.")
-                elif 'forcibly closed' in error_msg or 'ConnectionResetError' in str(type(auth_error)):
-                    print(f"Connection reset by server: {error_msg}")
-                    raise Exception(f"Connection to email server was reset. Please try again later.")
-                else:
-                    print(f"Connection error: {error_msg}")
-                    raise Exception(f"Failed to connect to email server: {error_msg}")
-        
-        # Search for all emails - use a more robust approach
-        try:
-            status, messages = mail.search(None, 'ALL')
-            if status != 'OK':
-                raise Exception(f"Search failed with status: {status}")
-            
-            if not messages or not messages[0]:
-                return []  # No emails found
-            
-            email_ids = messages[0].split()
-        except Exception as e:
-            # If search fails, try using a different approach
-            print(f"Search with 'ALL' failed: {e}, trying alternative method")
-            try:
-                # Try searching for recent emails
-                status, messages = mail.search(None, 'RECENT')
-                if status != 'OK' or not messages or not messages[0]:
-                    # If that fails, try to get emails by sequence number
-                    status, data = mail.status('INBOX', '(MESSAGES)')
-                    if status == 'OK' and data:
-                        # Get message count
-                        msg_count = int(data[0].split()[2].strip(b')').decode())
-                        if msg_count == 0:
-                            return []
-                        # Fetch emails by sequence number
-                        email_ids = [str(i).encode() for i in range(1, min(msg_count + 1, limit + 1))]
-                    else:
-                        return []
+            email_settings = get_email_settings()
+            if not email_settings or email_address not in get_idle_mailboxes(email_settings):
+                return  # Account removed or settings cleared: let the thread end
+            password = get_email_account_password(email_address, email_settings)
+            mail = _open_email_connection(
+                email_address, password, email_settings['imap_host'],
+                int(email_settings['imap_port'] or 993), bool(email_settings['imap_use_ssl']), 'imap'
+            )
+            # Servers often advertise IDLE only after authentication
+            status, data = mail.capability()
+            supports_idle = status == 'OK' and b'IDLE' in (data[0] or b'').upper().split()
+            select_imap_folder(mail, 'INBOX')
+            failures = 0
+            while True:
+                _sync_and_publish(email_address, password, email_settings)
+                if supports_idle:
+                    imap_idle_wait(mail, EMAIL_IDLE_RENEW_SECONDS)
                 else:
-                    email_ids = messages[0].split()
-            except Exception as e2:
-                print(f"Alternative search also failed: {e2}")
-                return []
-        
-        # Get the most recent emails (limit)
-        if not email_ids:
-            return []
-        
-        email_ids = email_ids[-limit:] if len(email_ids) > limit else email_ids
-        
-        emails = []
-        connection_recreated = False
-        for email_id in reversed(email_ids):
-            # Check connection state before fetching
-            if connection_recreated:
-                # Verify connection is still good
-                try:
+                    time.sleep(EMAIL_IDLE_POLL_FALLBACK_SECONDS)
                     mail.noop()
-                except:
-                    # Connection is bad again, try to reconnect
-                    try:
-                        close_email_connection(email_address, imap_host, imap_port, 'imap')
-                        if use_ssl:
-                            mail = imaplib.IMAP4_SSL(imap_host, imap_port)
-                        else:
-                            mail = imaplib.IMAP4(imap_host, imap_port)
-                        mail.login(email_address, password)
-                        status, data = mail.select('INBOX')
-                        if status != 'OK':
-                            print("Failed to maintain connection, stopping fetch")
-                            break
-                    except Exception as reconnect_err:
-                        print(f"Failed to maintain connection: {reconnect_err}")
-                        break
-            
-            try:
-                status, msg_data = mail.fetch(email_id, '(RFC822)')
-                if status == 'OK':
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
-                    
-                    # Decode subject
-                    subject_header = email_message.get('Subject', '')
-                    if subject_header:
-                        decoded_subject = decode_header(subject_header)
-                        if decoded_subject and decoded_subject[0][0]:
-                            subject = decoded_subject[0][0]
-                            if isinstance(subject, bytes):
-                                subject = subject.decode(decoded_subject[0][1] or 'utf-8')
-                        else:
-                            subject = ''
-                    else:
-                        subject = '(No Subject)'
-                    
-                    # Get sender
-                    sender = email_message.get('From', 'Unknown')
-                    
-                    # Get recipient
-                    recipient = email_message.get('To', '')
-                    
-                    # Get date
-                    date_str = email_message.get('Date', '')
-                    
-                    # Get body
-                    body = ""
-                    if email_message.is_multipart():
-                        for part in email_message.walk():
-                            content_type = part.get_content_type()
-                            if content_type == "text/plain":
-                                try:
-                                    body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                except:
-                                    body = str(part.get_payload())
-                                break
-                    else:
-                        try:
-                            body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            body = str(email_message.get_payload())
-                    
-                    # Get full body (not truncated)
-                    full_body = body if body else ''
-                    
-                    emails.append({
-                        'id': email_id.decode() if isinstance(email_id, bytes) else str(email_id),
-                        'subject': subject,
-                        'from': sender,
-                        'to': recipient,
-                        'date': date_str,
-                        'body': full_body  # Full body for conversation view
-                    })
-            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, ConnectionResetError, OSError) as e:
-                # Connection error during fetch - try to recreate connection once
-                error_msg = str(e)
-                # Check for various connection state errors
-                is_connection_error = (
-                    'Logging out' in error_msg or 
-                    'socket error: EOF' in error_msg or 
-                    'forcibly closed' in error_msg or
-                    'illegal in state LOGOUT' in error_msg or
-                    'illegal in state' in error_msg or
-                    'LOGOUT' in error_msg and 'state' in error_msg
-                )
-                
-                if is_connection_error:
-                    if not connection_recreated:
-                        print(f"Connection lost during fetch (state error), attempting to reconnect...")
-                        try:
-                            # Close the bad connection
-                            close_email_connection(email_address, imap_host, imap_port, 'imap')
-                            # Recreate connection
-                            if use_ssl:
-                                mail = imaplib.IMAP4_SSL(imap_host, imap_port)
-                            else:
-                                mail = imaplib.IMAP4(imap_host, imap_port)
-                            mail.login(email_address, password)
-                            status, data = mail.select('INBOX')
-                            if status == 'OK':
-                                connection_recreated = True
-                                print("Connection reestablished, continuing to fetch emails...")
-                                # Retry the fetch for this email
-                                try:
-                                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                                    if status == 'OK':
-                                        email_body = msg_data[0][1]
-                                        email_message = email.message_from_bytes(email_body)
-                                        
-                                        # Decode subject
-                                        subject_header = email_message.get('Subject', '')
-                                        if subject_header:
-                                            decoded_subject = decode_header(subject_header)
-                                            if decoded_subject and decoded_subject[0][0]:
-                                                subject = decoded_subject[0][0]
-                                                if isinstance(subject, bytes):
-                                                    subject = subject.decode(decoded_subject[0][1] or 'utf-8')
-                                            else:
-                                                subject = ''
-                                        else:
-                                            subject = '(No Subject)'
-                                        
-                                        sender = email_message.get('From', 'Unknown')
-                                        recipient = email_message.get('To', '')
-                                        date_str = email_message.get('Date', '')
-                                        
-                                        body = ""
-                                        if email_message.is_multipart():
-                                            for part in email_message.walk():
-                                                content_type = part.get_content_type()
-                                                if content_type == "text/plain":
-                                                    try:
-                                                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                                    except:
-                                                        body = str(part.get_payload())
-                                                    break
-                                        else:
-                                            try:
-                                                body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                            except:
-                                                body = str(email_message.get_payload())
-                                        
-                                        full_body = body if body else ''
-                                        
-                                        emails.append({
-                                            'id': email_id.decode() if isinstance(email_id, bytes) else str(email_id),
-                                            'subject': subject,
-                                            'from': sender,
-                                            'to': recipient,
-                                            'date': date_str,
-                                            'body': full_body
-                                        })
-                                        continue  # Successfully fetched, continue to next email
-                                except Exception as retry_error:
-                                    # Skip this email and continue with next
-                                    continue
-                            else:
-                                print("Failed to select INBOX after reconnect")
-                                # Return what we have so far
-                                break
-                        except Exception as reconnect_error:
-                            error_msg = str(reconnect_error)
-                            if 'AUTHENTICATIONFAILED' in error_msg or 'Authentication failed' in error_msg:
-                                print(f"Authentication failed when reconnecting: {error_msg}")
-                            else:
-                                print(f"Failed to reconnect: {error_msg}")
-                            # Return what we have so far
-                            break
-                    else:
-                        # Already recreated once, connection is still bad - stop trying
-                        print(f"Connection still in bad state after reconnect, stopping fetch operation")
-                        break
-                else:
-                    # Other error, skip this email silently
-                    continue
-            except Exception as e:
-                # Other unexpected error, skip this email
-                print(f"Unexpected error fetching email {email_id}: {e}")
-                continue
-        
-        # Don't close - keep connection alive (only if using persistent connection)
-        # If we created a new temporary connection, close it
-        conn_key = f"imap:{email_address}@{imap_host}:{imap_port}"
-        if conn_key not in _email_connections:
-            try:
-                mail.close()
-                mail.logout()
-            except:
-                pass
-        
-        return emails
+        except Exception as e:
+            failures += 1
+            print(f"IMAP IDLE listener error for {email_address}: {e}")
+        finally:
+            if mail is not None:
+                _close_email_entry({'connection': mail, 'type': 'imap'})
+        time.sleep(min(300, 5 * (2 ** min(failures, 6))))
+
+def start_imap_idle_listeners():
+    """Start one IDLE listener thread per work mailbox in this process (only when EMAIL_IDLE_ENABLED)"""
+    if not EMAIL_IDLE_ENABLED:
+        return
+    try:
+        for email_address in get_idle_mailboxes(get_email_settings()):
+            start_background_thread(f'imap-idle:{email_address.lower()}', _imap_idle_listener_loop, email_address)
     except Exception as e:
-        print(f"Error fetching emails: {e}")
-        import traceback
-        print(traceback.format_exc())
-        # Close connection on error
-        try:
-            close_email_connection(email_address, imap_host, imap_port, 'imap')
-        except:
-            pass
-        return []
+        print(f"Error starting IMAP IDLE listeners: {e}")
 
 @app.route('/communication_settings')
 def communication_settings():
@@ -9872,6 +13381,8 @@ def api_create_sub_email():
             save_email_account_to_db(
                 email_address, password, display_name, is_main, session.get('employee_id')
             )
+            invalidate_cpanel_accounts_cache()
+            start_imap_idle_listeners()
             return jsonify({'success': True, 'message': 'Sub-email created successfully'})
         else:
             error_msg = result.get('errors', [{}])[0].get('message', 'Unknown error') if result.get('errors') else 'Failed to create email'
@@ -9893,20 +13404,8 @@ def api_list_sub_emails():
         # Fetch from database
         db_accounts = get_email_accounts_from_db()
         
-        # Fetch from cPanel API
-        cpanel_accounts = []
-        try:
-            result = list_email_accounts(
-                email_settings['cpanel_api_token'],
-                email_settings['cpanel_domain'],
-                email_settings['cpanel_user'],
-                email_settings['cpanel_api_port']
-            )
-            
-            if result.get('status') == 1 and 'data' in result:
-                cpanel_accounts = result['data']
-        except Exception as e:
-            print(f"Error fetching from cPanel: {e}")
+        # cPanel mailbox list (cached; /api/email/sync-cpanel forces a refresh)
+        cpanel_accounts = get_cpanel_email_accounts(email_settings)
         
         # Merge and sync accounts
         db_emails = {acc['email_address']: acc for acc in db_accounts}
@@ -9960,37 +13459,22 @@ def api_sync_cpanel_emails():
         if not email_settings:
             return jsonify({'success': False, 'error': 'Email settings not configured'}), 400
         
-        # Fetch from cPanel
-        result = list_email_accounts(
-            email_settings['cpanel_api_token'],
-            email_settings['cpanel_domain'],
-            email_settings['cpanel_user'],
-            email_settings['cpanel_api_port']
-        )
-        
-        if result.get('status') != 1:
-            error_msg = result.get('errors', [{}])[0].get('message', 'Unknown error') if result.get('errors') else 'Failed to fetch from cPanel'
-            return jsonify({'success': False, 'error': error_msg}), 400
+        # Fetch from cPanel, bypassing (and refreshing) the cached listing
+        cpanel_accounts = _refresh_cpanel_accounts_cache(email_settings)
+        if cpanel_accounts is None:
+            return jsonify({'success': False, 'error': 'Failed to fetch from cPanel'}), 400
         
+        # One query for existing addresses instead of one per cPanel account
+        existing = {(acc.get('email_address') or '').lower() for acc in get_email_accounts_from_db()}
         synced_count = 0
-        if 'data' in result:
-            for account in result['data']:
-                email_addr = account.get('email', '')
-                if email_addr:
-                    # Check if exists in DB
-                    connection = get_db_connection()
-                    if connection:
-                        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                            cursor.execute("SELECT id FROM email_accounts WHERE email_address = %s", (email_addr,))
-                            exists = cursor.fetchone()
-                            
-                            if not exists:
-                                # Add to database
-                                save_email_account_to_db(
-                                    email_addr, '', account.get('domain', ''), False, session.get('employee_id')
-                                )
-                                synced_count += 1
-                        connection.close()
+        for account in cpanel_accounts:
+            email_addr = account.get('email', '')
+            if email_addr and email_addr.lower() not in existing:
+                existing.add(email_addr.lower())
+                save_email_account_to_db(
+                    email_addr, '', account.get('domain', ''), False, session.get('employee_id')
+                )
+                synced_count += 1
         
         return jsonify({'success': True, 'message': f'Synced {synced_count} email accounts from cPanel', 'synced_count': synced_count})
     except Exception as e:
@@ -10032,6 +13516,10 @@ def api_delete_sub_email():
                     cursor.execute("DELETE FROM email_accounts WHERE email_address = %s", (email_address,))
                     connection.commit()
                 connection.close()
+            # Drop pooled sessions for the deleted mailbox
+            close_email_connection(email_address, email_settings['smtp_host'], email_settings['smtp_port'], 'smtp')
+            close_email_connection(email_address, email_settings['imap_host'], email_settings['imap_port'], 'imap')
+            invalidate_cpanel_accounts_cache()
             return jsonify({'success': True, 'message': 'Email account deleted successfully'})
         else:
             error_msg = result.get('errors', [{}])[0].get('message', 'Unknown error') if result.get('errors') else 'Failed to delete email'
@@ -10061,32 +13549,158 @@ def api_send_email():
         if not to_email or not subject or not body:
             return jsonify({'success': False, 'error': 'To, subject, and body are required'}), 400
         
-        # Get password for the from_email
-        connection = get_db_connection()
-        password = email_settings['main_email_password']
-        if connection:
-            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-                cursor.execute("SELECT email_password FROM email_accounts WHERE email_address = %s", (from_email,))
-                account = cursor.fetchone()
-                if account and account['email_password']:
-                    password = account['email_password']
-            connection.close()
+        # Delivery (password lookup, SMTP, retries) happens on the outbox worker thread
+        outbox_id = enqueue_email(
+            from_email, to_email, subject, body, html_body,
+            email_settings.get('sender_name'), session['employee_id']
+        )
         
-        # Ensure port is an integer
-        smtp_port = int(email_settings['smtp_port']) if email_settings.get('smtp_port') else 587
-        smtp_use_tls = bool(email_settings.get('smtp_use_tls', True))
-        sender_name = email_settings.get('sender_name')
+        if outbox_id:
+            return jsonify({
+                'success': True,
+                'message': 'Email queued for delivery',
+                'outbox_id': outbox_id,
+                'status': 'queued'
+            })
+        else:
+            return jsonify({'success': False, 'error': 'Failed to queue email'}), 500
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/bulk', methods=['POST'])
+def api_create_bulk_email():
+    """Queue a mail merge: explicit recipients, or hearing notices from case_proceedings.next_court_date"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        data = request.get_json() or {}
+        email_settings = get_email_settings()
         
-        success = send_email_via_smtp(
-            from_email, password, to_email, subject, body,
-            email_settings['smtp_host'], smtp_port,
-            smtp_use_tls, html_body, sender_name
-        )
+        if not email_settings:
+            return jsonify({'success': False, 'error': 'Email settings not configured'}), 400
         
-        if success:
-            return jsonify({'success': True, 'message': 'Email sent successfully'})
+        subject_template = data.get('subject')
+        body_template = data.get('body')
+        if not subject_template or not body_template:
+            return jsonify({'success': False, 'error': 'Subject and body templates are required'}), 400
+        
+        source = data.get('source', 'recipients')
+        if source == 'hearing_notices':
+            from datetime import date, timedelta
+            date_from = data.get('date_from') or date.today().isoformat()
+            date_to = data.get('date_to') or (date.fromisoformat(date_from) + timedelta(days=7)).isoformat()
+            recipients = get_hearing_notice_recipients(date_from, date_to)
+        elif source == 'recipients':
+            recipients = data.get('recipients') or []
+            if not isinstance(recipients, list):
+                return jsonify({'success': False, 'error': 'Recipients must be a list'}), 400
         else:
-            return jsonify({'success': False, 'error': 'Failed to send email'}), 500
+            return jsonify({'success': False, 'error': f'Unknown recipient source: {source}'}), 400
+        
+        if not recipients:
+            return jsonify({'success': False, 'error': 'No recipients found'}), 400
+        
+        try:
+            job_id, queued, skipped = create_bulk_email_job(
+                data.get('from_email', email_settings['main_email']),
+                subject_template, body_template, recipients,
+                html_template=data.get('html_body'),
+                sender_name=email_settings.get('sender_name'),
+                name=data.get('name'),
+                source=source,
+                created_by_id=session['employee_id']
+            )
+        except TemplateError as e:
+            return jsonify({'success': False, 'error': f'Template error: {e}'}), 400
+        
+        if not job_id:
+            return jsonify({'success': False, 'error': 'Failed to queue bulk email'}), 500
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'queued': queued,
+            'skipped': skipped
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/bulk/<int:job_id>', methods=['GET'])
+def api_bulk_email_progress(job_id):
+    """Progress of a bulk email job (counts by delivery status)"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        start_email_outbox_worker()
+        job = get_bulk_email_progress(job_id)
+        if not job:
+            return jsonify({'success': False, 'error': 'Bulk email job not found'}), 404
+        return jsonify({'success': True, 'job': job})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/events', methods=['GET'])
+def api_email_events():
+    """Server-Sent Events feed of mailbox updates published by the IMAP IDLE listeners"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    if not EMAIL_IDLE_ENABLED:
+        return jsonify({'success': False, 'error': 'Live email updates are not enabled'}), 404
+    
+    start_imap_idle_listeners()
+    account = (request.args.get('account') or '').lower()
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id') or current_email_event_id())
+    except ValueError:
+        last_id = current_email_event_id()
+    
+    def stream(last_id):
+        yield 'retry: 5000\n\n'
+        stream_until = time.monotonic() + EMAIL_EVENTS_STREAM_SECONDS
+        while time.monotonic() < stream_until:
+            events = wait_for_email_events(last_id, 15)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                last_id = event['id']
+                if account and event['account_email'].lower() != account:
+                    continue
+                payload = json.dumps({'account_email': event['account_email'], **event['data']})
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+    
+    return Response(stream_with_context(stream(last_id)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/email/connection-stats', methods=['GET'])
+def api_connection_stats():
+    """Pooled cPanel/SMTP/IMAP connections and idle-reaper metrics for this worker process"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        return jsonify({'success': True, 'stats': get_connection_pool_stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/outbox/<int:outbox_id>', methods=['GET'])
+def api_email_outbox_status(outbox_id):
+    """Delivery status of an email queued by /api/email/send"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        start_email_outbox_worker()
+        item = get_outbox_status(outbox_id)
+        if not item:
+            return jsonify({'success': False, 'error': 'Queued email not found'}), 404
+        for field in ('next_attempt_at', 'sent_at', 'created_at'):
+            if item.get(field):
+                item[field] = item[field].strftime('%Y-%m-%d %H:%M:%S')
+        return jsonify({'success': True, 'email': item})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -10105,6 +13719,8 @@ def api_fetch_emails():
         
         email_address = data.get('email_address', email_settings['main_email'])
         limit = int(data.get('limit', 50))
+        # 'headers' returns list-view data only (no bodies) in a single IMAP round trip
+        mode = data.get('mode', 'full')
         
         # Get password for the email
         connection = get_db_connection()
@@ -10117,13 +13733,113 @@ def api_fetch_emails():
                     password = account['email_password']
             connection.close()
         
-        emails = fetch_emails_from_imap(
-            email_address, password,
+        if mode == 'headers':
+            emails = fetch_email_headers_from_imap(
+                email_address, password,
+                email_settings['imap_host'], email_settings['imap_port'],
+                email_settings['imap_use_ssl'], limit
+            )
+        else:
+            emails = fetch_emails_from_imap(
+                email_address, password,
+                email_settings['imap_host'], email_settings['imap_port'],
+                email_settings['imap_use_ssl'], limit
+            )
+        
+        return jsonify({'success': True, 'emails': emails})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/latest', methods=['GET'])
+def api_latest_communications():
+    """Paginated firm-wide inbox (all mailboxes merged by date) for the communications overview"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        email_settings = get_email_settings()
+        if not email_settings:
+            return jsonify({'success': False, 'error': 'Email settings not configured'}), 400
+        
+        page = request.args.get('page', 1, type=int)
+        mailboxes = get_firm_mailboxes(email_settings)
+        sync = None
+        if request.args.get('sync') == '1':
+            sync = sync_all_mailboxes(mailboxes, email_settings)
+        emails, has_more = get_latest_communications([m[0] for m in mailboxes], page)
+        return jsonify({
+            'success': True,
+            'emails': emails,
+            'page': page,
+            'has_more': has_more,
+            'sync': sync
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/attachment', methods=['GET'])
+def api_email_attachment():
+    """Download one email attachment on demand (fetched by BODYSTRUCTURE section, never cached)"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        email_settings = get_email_settings()
+        if not email_settings:
+            return jsonify({'success': False, 'error': 'Email settings not configured'}), 400
+        
+        account_email = request.args.get('account', '')
+        folder = request.args.get('folder', 'INBOX')
+        uid = request.args.get('uid', type=int)
+        section = request.args.get('section', '')
+        if not account_email or not uid or not re.fullmatch(r'\d+(\.\d+)*', section):
+            return jsonify({'success': False, 'error': 'account, uid and section are required'}), 400
+        try:
+            _imap_quote_mailbox(folder)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Only firm mailboxes the caller may read; never fall back to the main password for others
+        password = get_permitted_mailbox_password(account_email, email_settings)
+        if not password:
+            return jsonify({'success': False, 'error': 'You do not have access to this mailbox'}), 403
+        metadata, payload = fetch_email_attachment(
+            account_email, password,
             email_settings['imap_host'], email_settings['imap_port'],
-            email_settings['imap_use_ssl'], limit
+            email_settings['imap_use_ssl'], uid, section, folder
         )
+        if metadata is None:
+            return jsonify({'success': False, 'error': 'Attachment not found'}), 404
         
-        return jsonify({'success': True, 'emails': emails})
+        return Response(payload, mimetype=metadata['content_type'], headers={
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(metadata['filename'])}"
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/email/thread/<thread_key>', methods=['GET'])
+def api_get_email_thread(thread_key):
+    """Get one cached thread in reply order (bodies loaded on demand)"""
+    if 'employee_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    try:
+        email_settings = get_email_settings()
+        if not email_settings:
+            return jsonify({'success': False, 'error': 'Email settings not configured'}), 400
+        
+        email_address = request.args.get('email_address', email_settings['main_email'])
+        emails = get_thread_emails(email_address, thread_key)
+        if not emails:
+            return jsonify({'success': False, 'error': 'Thread not found'}), 404
+        
+        password = get_email_account_password(email_address, email_settings)
+        load_cached_email_bodies(
+            emails, password,
+            email_settings['imap_host'], email_settings['imap_port'],
+            email_settings['imap_use_ssl']
+        )
+        return jsonify({'success': True, 'thread_key': thread_key, 'emails': emails})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -10208,35 +13924,18 @@ def api_get_employee_communications():
             
             connection.close()
             
-            # Fetch emails
-            emails = fetch_emails_from_imap(
+            # Incremental sync keeps the contact index current
+            sync_mailbox(
                 employee['work_email'], password,
                 email_settings['imap_host'], email_settings['imap_port'],
-                email_settings['imap_use_ssl'], 100
+                email_settings['imap_use_ssl']
             )
-            
-            # Group by contact
-            contacts = {}
-            for email in emails:
-                from_addr = email.get('from', 'Unknown')
-                contact_key = from_addr.lower()
-                
-                if contact_key not in contacts:
-                    contacts[contact_key] = {
-                        'email': from_addr,
-                        'count': 0,
-                        'last_date': email.get('date', ''),
-                        'last_subject': email.get('subject', 'No Subject')
-                    }
-                contacts[contact_key]['count'] += 1
-                if email.get('date', '') > contacts[contact_key]['last_date']:
-                    contacts[contact_key]['last_date'] = email.get('date', '')
-                    contacts[contact_key]['last_subject'] = email.get('subject', 'No Subject')
+            contacts = get_email_contacts(employee['work_email'])
             
             return jsonify({
                 'success': True,
-                'contacts': list(contacts.values()),
-                'total_emails': len(emails)
+                'contacts': contacts,
+                'total_emails': sum(c['count'] for c in contacts)
             })
     except Exception as e:
         import traceback
@@ -11664,14 +15363,6 @@ def api_matters_update(matter_id):
     finally:
         connection.close()
 
-@app.before_request
-def cleanup_idle_connections_before_request():
-    """Clean up idle connections before each request"""
-    try:
-        cleanup_idle_connections(max_idle_minutes=30)
-    except:
-        pass  # Don't fail requests if cleanup fails
-
 # Initialize database when app is loaded (runs for both 'python app.py' and WSGI/Passenger)
 # This ensures tables and migrations are applied on the hosted side too
 try:
@@ -11679,6 +15370,31 @@ try:
 except Exception as e:
     print(f"[WARNING] Database initialization failed (may be first run or DB not configured): {e}")
 
+def start_background_workers():
+    """
+    Drain mail and Drive uploads queued before a restart and start the listeners in this process.
+    Called by the serving entrypoints (passenger_wsgi.py, 'python app.py', 'flask run-workers'),
+    not at import, so one-off CLI commands such as 'flask migrate-uploads' don't spin them up.
+    Enqueue paths still start their worker lazily if it isn't running.
+    """
+    start_email_outbox_worker()
+    start_connection_reaper()
+    start_imap_idle_listeners()
+    start_drive_upload_worker()
+    start_drive_changes_consumer()
+
+@app.cli.command('run-workers')
+def run_workers_command():
+    """Run the background workers in the foreground (for a separate worker process)."""
+    start_background_workers()
+    print("[OK] Background workers running (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == '__main__':
+    start_background_workers()
     app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -5,8 +5,13 @@ import os
 sys.path.insert(0, os.path.dirname(__file__))
 
 # Import the Flask application
-from app import app
+from app import app, start_background_workers
 
 # Passenger requires 'application' variable
 application = app
 
+# Start the queue workers and listeners now rather than on the first request; with smart spawning
+# Passenger forks worker processes from this one, and threads don't survive a fork
+start_background_workers()
+os.register_at_fork(after_in_child=start_background_workers)
+